@@ -0,0 +1,79 @@
+from google.appengine.ext import db
+from google.appengine.api import taskqueue
+import random
+import time
+
+# Number of shards each monster's pending vote counts are spread over. Votes
+# on one monster can be written roughly this many times per second.
+NUM_SHARDS = 20
+
+# Seconds between folds of a monster's shards into the monster itself.
+FOLD_INTERVAL = 10
+
+FOLD_URL = "/tasks/fold-votes"
+
+
+class VoteCounterShard(db.Model):
+  """Vote counts for a monster that haven't been folded into it yet.
+  
+  Key name is "<monster id>:<shard index>". Counts can be negative when a
+  vote changes direction."""
+  ups = db.IntegerProperty(default=0, indexed=False)
+  downs = db.IntegerProperty(default=0, indexed=False)
+  
+  @staticmethod
+  def key_names_for(monster_id):
+    return ["%s:%d" % (monster_id, index) for index in xrange(NUM_SHARDS)]
+
+
+def increment(monster_id, ups=0, downs=0):
+  """Adds to a random shard of monster_id's pending vote counts.
+  
+  May be called inside a cross-group transaction, in which case the shard
+  write becomes part of it."""
+  key_name = "%s:%d" % (monster_id, random.randint(0, NUM_SHARDS - 1))
+  def txn():
+    shard = VoteCounterShard.get_by_key_name(key_name)
+    if not shard:
+      shard = VoteCounterShard(key_name=key_name)
+    shard.ups += ups
+    shard.downs += downs
+    shard.put()
+  if db.is_in_transaction():
+    txn()
+  else:
+    db.run_in_transaction(txn)
+
+
+def drain(monster_id):
+  """Zeroes monster_id's shards and returns what they held as (ups, downs).
+  
+  Must be called inside a cross-group transaction that applies the result."""
+  shards = [shard for shard in 
+            VoteCounterShard.get_by_key_name(
+              VoteCounterShard.key_names_for(monster_id))
+            if shard and (shard.ups or shard.downs)]
+  ups = sum(shard.ups for shard in shards)
+  downs = sum(shard.downs for shard in shards)
+  for shard in shards:
+    shard.ups = 0
+    shard.downs = 0
+  db.put(shards)
+  return ups, downs
+  
+  
+def schedule_fold(monster_id):
+  """Makes sure a fold of monster_id's shards is pending.
+  
+  Folds are named after the FOLD_INTERVAL window they cover and run when the
+  window closes, so any number of votes in one window cause a single fold."""
+  now = time.time()
+  window = int(now) // FOLD_INTERVAL
+  try:
+    taskqueue.add(
+      url=FOLD_URL, 
+      name="fold-%s-%d" % (monster_id, window),
+      countdown=(window + 1) * FOLD_INTERVAL + 1 - now,
+      params={'monster_id': monster_id})
+  except (taskqueue.TaskAlreadyExistsError, taskqueue.TombstonedTaskError):
+    pass
@@ -0,0 +1,225 @@
+"""Deletes monsters and products along with everything that refers to them.
+
+Votes are found with keys-only queries and deleted BATCH_SIZE at a time,
+before the monsters they're on. Each batch of monsters then has its search
+documents removed, its leaderboard entries dropped and its listings'
+generations bumped together. Every deletion is saved as a DeletionJob and
+checkpointed after each batch. The requesting user waits for INLINE_STEPS
+batches, and a chain of tasks finishes the rest, or takes over if the
+request dies, so a request deleting a popular monster or a whole product
+returns quickly."""
+from google.appengine.ext import db
+from google.appengine.api import memcache
+from google.appengine.api import taskqueue
+from data import counters
+from data import generations
+from data import identity
+from data import indexing
+from data import leaderboards
+import itertools
+import time
+import uuid
+
+# Most keys passed to one db.delete.
+BATCH_SIZE = 500
+
+# Monsters deleted together once their votes are gone.
+MONSTER_BATCH_SIZE = 100
+
+# Batches the requesting user waits for before the rest is left to tasks.
+INLINE_STEPS = 4
+
+# Seconds before the first task picks up a deletion, by when the request
+# that started it has finished or died.
+TAKEOVER_COUNTDOWN = 60
+
+DELETE_URL = "/tasks/delete"
+
+# Seconds one deletion task keeps deleting batches before handing off.
+DELETE_BUDGET = 5 * 60
+
+
+class DeletionJob(db.Model):
+  """A deletion being finished in the background. Key name is the job id.
+
+  monster_ids are the monsters still to be deleted; product is the id of the
+  product to delete once they're gone, or None."""
+  monster_ids = db.ListProperty(long, indexed=False)
+  product = db.IntegerProperty(indexed=False)
+  votes = db.IntegerProperty(default=0, indexed=False)
+  monsters = db.IntegerProperty(default=0, indexed=False)
+  tasks = db.IntegerProperty(default=0, indexed=False)
+  done = db.BooleanProperty(default=False, indexed=False)
+  start_time = db.DateTimeProperty(auto_now_add=True)
+  updated = db.DateTimeProperty(auto_now=True, indexed=False)
+
+  def get_progress(self):
+    """Returns a dict describing how far the deletion has got."""
+    return {
+      'job': self.key().name(),
+      'product': self.product,
+      'monsters_left': len(self.monster_ids),
+      'monsters_deleted': self.monsters,
+      'votes_deleted': self.votes,
+      'done': self.done,
+    }
+
+
+def delete_monsters(monster_ids):
+  """Deletes monsters and their votes.
+
+  Returns:
+    The DeletionJob finishing the deletion in the background, or None if it
+    was small enough to finish now."""
+  return _start(DeletionJob(key_name=uuid.uuid4().hex,
+                            monster_ids=list(monster_ids)))
+
+
+def delete_product(product):
+  """Deletes a product, its monsters and their votes, and takes it off the
+  profiles that have access to it.
+
+  Returns:
+    The DeletionJob finishing the deletion in the background, or None if it
+    was small enough to finish now."""
+  # data.models imports this module.
+  from data.models import Monster
+  monster_ids = []
+  query = Monster.all(keys_only=True).filter(
+    "product = ", product.key().id()).order('__key__')
+  while True:
+    keys = query.fetch(BATCH_SIZE)
+    monster_ids.extend(key.id() for key in keys)
+    if len(keys) < BATCH_SIZE:
+      break
+    query.with_cursor(query.cursor())
+  return _start(DeletionJob(key_name=uuid.uuid4().hex,
+                            monster_ids=monster_ids,
+                            product=product.key().id()))
+
+
+def _start(job):
+  """Saves a deletion and does its first INLINE_STEPS batches.
+
+  The first task is scheduled before any are done, so the deletion is
+  finished even if the request dies. A deletion done here is removed, and
+  the task finds nothing to do."""
+  job.put()
+  _schedule_delete(job.key().name(), 0, TAKEOVER_COUNTDOWN)
+  for step in xrange(INLINE_STEPS):
+    if not delete_batch(job):
+      job.delete()
+      return None
+    job.put()
+  return job
+
+
+def run_deletion(job_id, budget=DELETE_BUDGET):
+  """Deletes batches of a DeletionJob for about budget seconds, then
+  schedules the next task if it isn't done."""
+  job = DeletionJob.get_by_key_name(job_id)
+  if not job or job.done:
+    return
+  deadline = time.time() + budget
+  while time.time() < deadline:
+    if not delete_batch(job):
+      job.done = True
+      job.put()
+      return
+    job.put()
+  job.tasks += 1
+  job.put()
+  _schedule_delete(job_id, job.tasks)
+
+
+def delete_batch(job):
+  """Does the next batch of a deletion's work, without saving the job.
+
+  Deletes up to BATCH_SIZE votes on the next MONSTER_BATCH_SIZE monsters,
+  or those monsters once they have none left, or finally the product.
+  Every batch can be safely redone if the job isn't saved after it.
+
+  Returns:
+    Whether there's more to do."""
+  # data.models imports this module.
+  from data.models import Monster, Vote
+  monster_ids = job.monster_ids[:MONSTER_BATCH_SIZE]
+  if not monster_ids:
+    if job.product is not None:
+      return _delete_product(job.product)
+    return False
+
+  # run() sends each query's first batch straight away, so they're in
+  # flight together rather than one after another.
+  queries = [Vote.all(keys_only=True).filter(
+               "monster = ", db.Key.from_path('Monster', monster_id)).run(
+                 limit=BATCH_SIZE, batch_size=BATCH_SIZE)
+             for monster_id in monster_ids]
+  vote_keys = list(itertools.islice(itertools.chain.from_iterable(queries), 
+                                    BATCH_SIZE))
+  if vote_keys:
+    db.delete(vote_keys)
+    job.votes += len(vote_keys)
+    return True
+
+  monsters = [monster for monster in Monster.get_by_id(monster_ids)
+              if monster]
+  indexing.enqueue_delete(monster_ids)
+  namespaces = set()
+  for monster in monsters:
+    namespaces.update(monster.get_listing_namespaces())
+    leaderboards.remove(monster.product, monster.key().id())
+    identity.discard(monster.key())
+  keys = [monster.key() for monster in monsters]
+  for monster_id in monster_ids:
+    keys.extend(db.Key.from_path('VoteCounterShard', key_name)
+                for key_name in counters.VoteCounterShard.key_names_for(
+                  monster_id))
+  for start in xrange(0, len(keys), BATCH_SIZE):
+    db.delete(keys[start:start + BATCH_SIZE])
+  memcache.delete_multi([Monster.get_mem_key_for_id(monster_id)
+                         for monster_id in monster_ids])
+  generations.bump_multi(namespaces)
+  job.monsters += len(monsters)
+  job.monster_ids = job.monster_ids[len(monster_ids):]
+  return bool(job.monster_ids) or job.product is not None
+
+
+def _delete_product(product_id):
+  """Takes a product off up to BATCH_SIZE profiles, or deletes it once it's
+  on none.
+
+  Returns:
+    Whether there's more to do."""
+  # data.models imports this module.
+  from data.models import Product, Profile
+  # The query is eventually consistent, so it may still find profiles that
+  # were already updated.
+  profiles = [profile for profile in 
+              Profile.all().filter("products = ", product_id).fetch(BATCH_SIZE)
+              if product_id in profile.products]
+  if profiles:
+    for profile in profiles:
+      profile.products = [product for product in profile.products
+                          if product != product_id]
+    db.put(profiles)
+    memcache.delete_multi([profile.get_mem_key() for profile in profiles])
+    identity.add_multi(profiles)
+    return True
+  key = db.Key.from_path('Product', product_id)
+  db.delete(key)
+  identity.discard(key)
+  memcache.delete(Product.get_mem_key_for_id(product_id))
+  return False
+
+
+def _schedule_delete(job_id, task_number, countdown=0):
+  # Named so a retried task can't fork the chain.
+  try:
+    taskqueue.add(
+      url=DELETE_URL,
+      name="delete-%s-%d" % (job_id, task_number),
+      params={'job': job_id},
+      countdown=countdown)
+  except (taskqueue.TaskAlreadyExistsError, taskqueue.TombstonedTaskError):
+    pass
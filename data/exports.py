@@ -0,0 +1,276 @@
+"""Exports monsters in the formats data.imports reads.
+
+Exports walk a query in key order, BATCH_SIZE monsters at a time, and
+serialize each batch as it's read, so they use constant memory however many
+monsters there are. iter_export streams one straight into a response. Large
+exports can instead be written in the background by a chain of tasks into
+ExportChunks, checkpointing the query cursor after each, and downloaded
+later a chunk per request, so no response holds more than CHUNK_SIZE bytes,
+see start_export."""
+from google.appengine.ext import db
+from google.appengine.api import taskqueue
+from data.models import Monster, Profile
+import json
+import time
+import uuid
+import xml.etree.cElementTree as ET
+import zlib
+
+# Monsters read per datastore query.
+BATCH_SIZE = 100
+
+# Output bytes an ExportChunk holds before compression. Monster text
+# compresses well, so chunks stay far under the 1MB entity limit.
+CHUNK_SIZE = 512 * 1024
+
+EXPORT_URL = "/tasks/export"
+
+# Seconds one export task keeps writing chunks before handing off.
+EXPORT_BUDGET = 5 * 60
+
+# What can be exported: the public codex, a product, or a creator's monsters.
+CODEX = "codex"
+PRODUCT = "product"
+CREATOR = "creator"
+
+XML = "xml"
+NDJSON = "ndjson"
+
+CONTENT_TYPES = {
+  XML: "application/xml",
+  NDJSON: "application/x-ndjson",
+}
+
+_HEADERS = {
+  XML: '<?xml version="1.0" encoding="utf-8"?>\n<monsters>\n',
+  NDJSON: '',
+}
+
+_FOOTERS = {
+  XML: '</monsters>\n',
+  NDJSON: '',
+}
+
+# Monster list properties, with the tag of their items in the XML format.
+_LISTS = [
+  ('tags', 'tag'),
+  ('damage_tags', 'tag'),
+  ('special_qualities', 'special_quality'),
+  ('moves', 'move'),
+]
+
+_TEXTS = ['name', 'description', 'instinct', 'damage', 'hp', 'armor']
+
+
+def monster_to_record(monster):
+  """Returns a dict of a monster's fields, as in the NDJSON format."""
+  record = {'id': monster.key().id()}
+  for field in _TEXTS:
+    record[field] = getattr(monster, field)
+  for field, item in _LISTS:
+    record[field] = list(getattr(monster, field))
+  return record
+
+
+def monster_to_element(monster):
+  """Returns a <monster> element for a monster, as UploadHandler reads."""
+  element = ET.Element('monster', id=str(monster.key().id()))
+  for field in _TEXTS:
+    value = getattr(monster, field)
+    if value is not None:
+      ET.SubElement(element, field).text = value
+  for field, item in _LISTS:
+    parent = ET.SubElement(element, field)
+    for value in getattr(monster, field):
+      ET.SubElement(parent, item).text = value
+  return element
+
+
+def serialize(monsters, export_format):
+  """Returns a batch of monsters in an export format, as a UTF-8 string."""
+  if export_format == XML:
+    return "".join(ET.tostring(monster_to_element(monster), encoding='utf-8') +
+                   "\n" for monster in monsters)
+  return "".join(json.dumps(monster_to_record(monster)) + "\n"
+                 for monster in monsters)
+
+
+def build_query(scope, scope_id=None, user=None):
+  """Returns a query for the monsters in an export, in key order.
+
+  Args:
+    scope: CODEX, PRODUCT or CREATOR.
+    scope_id: the id of the product, or the key name of the creator.
+    user: the Profile exporting. Product monsters are included in a
+      creator's export only if user is that creator.
+
+  Returns:
+    The query. Callers check the user may see a product before exporting
+    it."""
+  query = Monster.all()
+  if scope == PRODUCT:
+    query.filter("product = ", int(scope_id))
+  elif scope == CREATOR:
+    creator_key = db.Key.from_path('Profile', scope_id)
+    query.filter("creator = ", creator_key)
+    if not user or user.key() != creator_key:
+      query.filter("product = ", -1)
+  else:
+    query.filter("product = ", -1)
+  return query.order('__key__')
+
+
+def iter_batches(query, cursor=None):
+  """Yields lists of up to BATCH_SIZE of query's results and the cursor
+  after each, continuing from cursor."""
+  while True:
+    if cursor:
+      query.with_cursor(cursor)
+    batch = query.fetch(BATCH_SIZE)
+    cursor = query.cursor()
+    if batch:
+      yield batch, cursor
+    if len(batch) < BATCH_SIZE:
+      return
+
+
+def iter_export(query, export_format):
+  """Yields a whole export of query's monsters, a batch at a time.
+
+  Meant to be a response's app_iter, so nothing but the current batch is
+  held in memory."""
+  yield _HEADERS[export_format]
+  for batch, cursor in iter_batches(query):
+    yield serialize(batch, export_format)
+  yield _FOOTERS[export_format]
+
+
+class ExportJob(db.Model):
+  """An export written in the background. Key name is the job id.
+
+  The output is in the job's ExportChunk children, numbered from 0; cursor
+  is where the query continues for the next one."""
+  scope = db.StringProperty()
+  scope_id = db.StringProperty()
+  export_format = db.StringProperty()
+  requester = db.ReferenceProperty(Profile, collection_name='export_jobs')
+  cursor = db.TextProperty()
+  records = db.IntegerProperty(default=0, indexed=False)
+  chunks = db.IntegerProperty(default=0, indexed=False)
+  bytes_written = db.IntegerProperty(default=0, indexed=False)
+  tasks = db.IntegerProperty(default=0, indexed=False)
+  done = db.BooleanProperty(default=False, indexed=False)
+  start_time = db.DateTimeProperty(auto_now_add=True)
+  updated = db.DateTimeProperty(auto_now=True, indexed=False)
+
+  def build_query(self):
+    return build_query(self.scope, self.scope_id, self.requester)
+
+  def get_progress(self):
+    """Returns a dict describing how far the export has got and how fast."""
+    elapsed = (self.updated - self.start_time).total_seconds()
+    return {
+      'job': self.key().name(),
+      'scope': self.scope,
+      'format': self.export_format,
+      'monsters': self.records,
+      'bytes': self.bytes_written,
+      'chunks': self.chunks,
+      'done': self.done,
+      'elapsed_seconds': elapsed,
+      'monsters_per_second': self.records / elapsed if elapsed > 0 else 0.0,
+    }
+
+  def get_chunk(self, index):
+    """Returns a piece of the finished export, or None if there's no such
+    piece. The export is its pieces in order, from 0 to chunks - 1."""
+    if not 0 <= index < self.chunks:
+      return None
+    chunk = ExportChunk.get_by_key_name(str(index), parent=self)
+    return zlib.decompress(chunk.data) if chunk else None
+
+
+class ExportChunk(db.Model):
+  """A piece of an ExportJob's output, compressed. Child of the job; key
+  name is its index."""
+  data = db.BlobProperty()
+
+
+def start_export(scope, scope_id, export_format, requester):
+  """Starts writing an export in the background.
+
+  Returns:
+    The new ExportJob."""
+  job = ExportJob(key_name=uuid.uuid4().hex, scope=scope,
+                  scope_id=scope_id and str(scope_id),
+                  export_format=export_format, requester=requester)
+  job.put()
+  _schedule_export(job.key().name(), 0)
+  return job
+
+
+def run_export(job_id, budget=EXPORT_BUDGET):
+  """Writes chunks of an export for about budget seconds, then schedules
+  the next task if it isn't done."""
+  job = ExportJob.get_by_key_name(job_id)
+  if not job or job.done:
+    return
+  deadline = time.time() + budget
+  while time.time() < deadline:
+    job = write_chunk(job)
+    if job.done:
+      return
+  job.tasks += 1
+  job.put()
+  _schedule_export(job_id, job.tasks)
+
+
+def write_chunk(job):
+  """Writes the next chunk of an export and checkpoints the job past it.
+
+  The chunk and the checkpoint are written in one transaction, and only if
+  no other task got there first, so retries can't skip or repeat monsters.
+
+  Returns:
+    The ExportJob, brought up to date."""
+  parts = [] if job.chunks else [_HEADERS[job.export_format]]
+  size = len(parts[0]) if parts else 0
+  records = 0
+  cursor = job.cursor
+  done = True
+  for batch, cursor in iter_batches(job.build_query(), job.cursor):
+    parts.append(serialize(batch, job.export_format))
+    size += len(parts[-1])
+    records += len(batch)
+    if size >= CHUNK_SIZE and len(batch) == BATCH_SIZE:
+      done = False
+      break
+  if done:
+    parts.append(_FOOTERS[job.export_format])
+  data = "".join(parts)
+
+  index = job.chunks
+  def txn():
+    current = ExportJob.get_by_key_name(job.key().name())
+    if current.chunks != index:
+      return current
+    current.cursor = cursor
+    current.records += records
+    current.chunks += 1
+    current.bytes_written += len(data)
+    current.done = done
+    db.put([current, ExportChunk(parent=current, key_name=str(index),
+                                 data=zlib.compress(data))])
+    return current
+  return db.run_in_transaction(txn)
+
+
+def _schedule_export(job_id, task_number):
+  # Named so a retried task can't fork the chain.
+  try:
+    taskqueue.add(
+      url=EXPORT_URL,
+      name="export-%s-%d" % (job_id, task_number),
+      params={'job': job_id})
+  except (taskqueue.TaskAlreadyExistsError, taskqueue.TombstonedTaskError):
+    pass
@@ -0,0 +1,31 @@
+from google.appengine.api import memcache
+import time
+
+# Listings cached under a generation can live this long, since any write to
+# the listing bumps its generation and orphans them.
+LISTING_TTL = 6 * 60 * 60
+
+
+def _key(namespace):
+  return "generation:%s" % namespace
+
+
+def get(namespace):
+  """Returns the current generation of namespace.
+  
+  Include it in the memcache key of anything cached from the namespace; a
+  bump then invalidates all of it at once without enumerating keys. A counter
+  that has been evicted restarts at the current time rather than 0, so it
+  doesn't come back to a generation that older cache entries still use."""
+  return memcache.incr(_key(namespace), delta=0, 
+                       initial_value=int(time.time()))
+
+
+def bump(namespace):
+  """Atomically moves namespace to a new generation."""
+  memcache.incr(_key(namespace), initial_value=int(time.time()))
+  
+
+def bump_multi(namespaces):
+  memcache.offset_multi(dict((_key(namespace), 1) for namespace in namespaces),
+                        initial_value=int(time.time()))
@@ -0,0 +1,106 @@
+from google.appengine.ext import db
+import threading
+import webob
+
+_local = threading.local()
+
+
+def _entities():
+  return getattr(_local, 'entities', None)
+
+
+def get(key):
+  """Returns the entity with key loaded earlier in this request, or None."""
+  entities = _entities()
+  if entities is None or key is None:
+    return None
+  return entities.get(key)
+
+
+def get_multi(keys):
+  """Returns a dict of key to entity for the keys loaded in this request."""
+  entities = _entities()
+  if not entities:
+    return {}
+  return dict((key, entities[key]) for key in keys if key in entities)
+
+
+def add(entity):
+  """Remembers entity for the rest of the request. Returns entity."""
+  entities = _entities()
+  if entities is not None and entity is not None:
+    entities[entity.key()] = entity
+  return entity
+
+
+def add_multi(entities):
+  for entity in entities:
+    add(entity)
+
+
+def discard(key):
+  """Forgets the entity with key, for example because it was deleted."""
+  entities = _entities()
+  if entities is not None:
+    entities.pop(key, None)
+
+
+class IdentityMapMiddleware(object):
+  """WSGI middleware that gives each request an empty identity map.
+  
+  While a request is running, entities loaded through the model helpers are
+  remembered by key, so resolving the same entity again within the request
+  costs nothing. Outside the middleware the map is inactive and every lookup
+  misses. The map is dropped when the request ends so threads serving later requests
+  never see another request's entities. Attributes of the wrapped app are
+  passed through, so the middleware can stand in for it."""
+  
+  def __init__(self, app):
+    self.app = app
+    
+  def __call__(self, environ, start_response):
+    _local.entities = {}
+    try:
+      return self.app(environ, start_response)
+    finally:
+      _local.entities = None
+      
+  def __getattr__(self, name):
+    return getattr(self.app, name)
+    
+  def get_response(self, *args, **kwargs):
+    """Like webapp2.WSGIApplication.get_response, but through the middleware."""
+    return webob.Request.blank(*args, **kwargs).get_response(self)
+
+
+class ReferenceProperty(db.ReferenceProperty):
+  """A db.ReferenceProperty that resolves through the identity map.
+  
+  Dereferencing first checks for an entity attached with prime, then for the
+  referenced entity in the map, and entities fetched from the datastore are
+  added to it."""
+  
+  def __get__(self, model_instance, model_class):
+    if model_instance is None:
+      return self
+    key = self.get_value_for_datastore(model_instance)
+    entity = getattr(model_instance, self._primed_attr_name(), None)
+    if entity is not None and key is not None and entity.key() == key:
+      return entity
+    entity = get(key)
+    if entity is not None:
+      self.prime(model_instance, entity)
+      return entity
+    return add(super(ReferenceProperty, self).__get__(model_instance, 
+                                                       model_class))
+                                                       
+  def prime(self, model_instance, entity):
+    """Attaches entity as the resolved value of this reference.
+    
+    Dereferencing the property on model_instance then returns entity without
+    any I/O, for as long as the reference still points to it. Used to attach
+    entities fetched in a batch."""
+    setattr(model_instance, self._primed_attr_name(), entity)
+    
+  def _primed_attr_name(self):
+    return '_primed_' + self.name
@@ -0,0 +1,642 @@
+"""Imports monsters from publishers' uploads.
+
+Uploads can be XML, CSV or NDJSON (see iter_records); each is streamed a
+record at a time, so memory doesn't grow with the file, and every format
+maps its records to Monsters the same way, with monster_from_record. They're
+written BATCH_SIZE monsters at a time with Monster.put_multi. An import
+runs as a chain of tasks that checkpoint their progress in an ImportJob, so
+a whole book isn't bound by one request's deadline.
+
+Every upload is validated first, in a pass that streams it without writing
+anything, and only imported if no record has errors. Validation runs as a
+chain of tasks too, checkpointing its report in the ImportJob."""
+from google.appengine.ext import blobstore
+from google.appengine.ext import db
+from google.appengine.api import taskqueue
+from data import nameindex
+from data.models import Monster, Profile
+from monsterrules.core.builder import CoreMonsterBuilder
+import StringIO
+import csv
+import json
+import os
+import time
+import uuid
+import xml.etree.cElementTree as ET
+import zlib
+
+# Monsters written per datastore put.
+BATCH_SIZE = 100
+
+IMPORT_URL = "/tasks/import"
+
+VALIDATE_URL = "/tasks/import/validate"
+
+# Seconds one import task keeps writing batches before handing off, well
+# under the task deadline.
+IMPORT_BUDGET = 5 * 60
+
+# Seconds the upload request itself spends validating and importing before
+# leaving the rest to tasks, well under the request deadline.
+INLINE_BUDGET = 20
+
+# Formats uploads can be in.
+XML = "xml"
+CSV = "csv"
+NDJSON = "ndjson"
+
+# Upload file extensions, mapped to their format.
+EXTENSIONS = {
+  '.xml': XML,
+  '.csv': CSV,
+  '.json': NDJSON,
+  '.jsonl': NDJSON,
+  '.ndjson': NDJSON,
+}
+
+# The fields of a record, whatever the format. Text fields are a string or
+# None; list fields are a list of strings.
+TEXT_FIELDS = ('name', 'description', 'instinct', 'damage', 'hp', 'armor')
+LIST_FIELDS = ('tags', 'damage_tags', 'special_qualities', 'moves')
+TAG_FIELDS = ('tags', 'damage_tags')
+
+# Fields every record needs a value for, and lists that need an item.
+REQUIRED_FIELDS = ('name', 'hp', 'armor', 'damage', 'instinct')
+REQUIRED_LISTS = ('moves',)
+
+# Most records with problems kept in a validation report, to bound its size.
+MAX_REPORTED_RECORDS = 500
+
+# The builder's spelling of each tag, by lower case tag, see normalize_tag.
+_tag_spellings = None
+
+
+class FormatError(ValueError):
+  """Raised when an upload can't be parsed as its format."""
+
+
+class ImportJob(db.Model):
+  """An upload being validated and imported. Key name is the job id.
+
+  The upload is validated first, see validate_upload; report is the JSON of
+  the validation report, as far as it's got, and seen the compressed JSON of
+  the names checked so far. Once it's checked, the upload is imported unless
+  it's a dry run. Records are the upload's monsters,
+  in its import_format; the first records of them have been imported. The
+  ids of the batch being written are allocated and saved in pending_ids
+  first, so a retried batch overwrites the monsters it already wrote instead
+  of duplicating them."""
+  blob = blobstore.BlobReferenceProperty()
+  import_format = db.StringProperty(default=XML)
+  product = db.IntegerProperty()
+  creator = db.ReferenceProperty(Profile, collection_name='import_jobs')
+  records = db.IntegerProperty(default=0, indexed=False)
+  bytes_read = db.IntegerProperty(default=0, indexed=False)
+  pending_ids = db.ListProperty(long, indexed=False)
+  report = db.TextProperty()
+  seen = db.BlobProperty()
+  checked = db.BooleanProperty(default=False, indexed=False)
+  validated = db.BooleanProperty(default=False, indexed=False)
+  dry_run = db.BooleanProperty(default=False, indexed=False)
+  started = db.BooleanProperty(default=False, indexed=False)
+  tasks = db.IntegerProperty(default=0, indexed=False)
+  done = db.BooleanProperty(default=False, indexed=False)
+  start_time = db.DateTimeProperty(auto_now_add=True)
+  updated = db.DateTimeProperty(auto_now=True, indexed=False)
+
+  def get_progress(self):
+    """Returns a dict describing how far the import has got and how fast."""
+    elapsed = (self.updated - self.start_time).total_seconds()
+    return {
+      'job': self.key().name(),
+      'product': self.product,
+      'format': self.import_format,
+      'monsters': self.records,
+      'bytes_read': self.bytes_read,
+      'bytes_total': self.blob.size if self.blob else 0,
+      'tasks': self.tasks,
+      'checked': self.checked,
+      'done': self.done,
+      'elapsed_seconds': elapsed,
+      'monsters_per_second': self.records / elapsed if elapsed > 0 else 0.0,
+    }
+
+  def get_report(self):
+    """Returns the validation report, see validate."""
+    return json.loads(self.report) if self.report else None
+
+  def get_seen(self):
+    """Returns the names checked so far, see check_records."""
+    return json.loads(zlib.decompress(self.seen)) if self.seen else {}
+
+  def set_seen(self, seen):
+    self.seen = db.Blob(zlib.compress(json.dumps(seen)))
+
+
+def iter_monsters(source):
+  """Yields the <monster> elements of an XML upload as they're parsed.
+
+  Each element is cleared and dropped from its parent once the caller moves
+  on, so only one monster is held in memory at a time."""
+  path = []
+  for event, element in ET.iterparse(source, events=('start', 'end')):
+    if event == 'start':
+      path.append(element)
+      continue
+    path.pop()
+    if element.tag == 'monster':
+      yield element
+      element.clear()
+      if path:
+        path[-1].remove(element)
+
+
+def _texts(element, name):
+  """Returns the text of the children of element's name child."""
+  parent = element.find(name)
+  if parent is None:
+    return []
+  return [child.text for child in parent]
+
+
+def normalize_tag(tag):
+  """Returns the form a tag is imported in.
+
+  Whitespace is collapsed, and tags the core builder knows are spelled the
+  way it spells them, so "  hoRDe" is imported as "Horde". Returns "" for
+  tags that are blank."""
+  global _tag_spellings
+  if _tag_spellings is None:
+    _tag_spellings = {}
+    for tags in CoreMonsterBuilder.tag_vocabulary().values():
+      for spelling in tags:
+        _tag_spellings.setdefault(spelling.lower(), spelling)
+  tag = u" ".join((tag or u"").split())
+  return _tag_spellings.get(tag.lower(), tag)
+
+
+def format_for(filename):
+  """Returns the format of an upload by its file name, or None."""
+  return EXTENSIONS.get(os.path.splitext(filename or "")[1].lower())
+
+
+def _record(get):
+  """Returns a record of the values get returns for each field."""
+  record = {}
+  for field in TEXT_FIELDS:
+    value = get(field)
+    record[field] = None if value is None else unicode(value)
+  for field in LIST_FIELDS:
+    value = get(field)
+    if value is None:
+      value = []
+    elif isinstance(value, basestring):
+      value = [value]
+    record[field] = [None if item is None else unicode(item)
+                     for item in value]
+  return record
+
+
+def iter_xml_records(source):
+  """Yields the records of an XML upload, one per <monster> element."""
+  try:
+    for element in iter_monsters(source):
+      yield _record(lambda field: _texts(element, field)
+                    if field in LIST_FIELDS else element.findtext(field))
+  except ET.ParseError as error:
+    raise FormatError(str(error))
+
+
+def iter_ndjson_records(source):
+  """Yields the records of an NDJSON upload, one per line.
+
+  Each line is a JSON object with a key per field, as data.exports writes."""
+  for number, line in enumerate(source, 1):
+    if not line.strip():
+      continue
+    try:
+      values = json.loads(line)
+    except ValueError as error:
+      raise FormatError("Line %d: %s" % (number, error))
+    if not isinstance(values, dict):
+      raise FormatError("Line %d: not a JSON object" % number)
+    yield _record(values.get)
+
+
+def _split_cell(value, field):
+  """Returns the items in a CSV cell of a list field.
+
+  Items are one per line, as spreadsheets write cells with line breaks.
+  Tags may also be separated by commas."""
+  items = value.splitlines()
+  if field in TAG_FIELDS:
+    items = [tag for item in items for tag in item.split(",")]
+  return [item for item in items if item.strip()]
+
+
+def iter_csv_records(source):
+  """Yields the records of a CSV upload, one per row.
+
+  The header row names the fields, and other columns are ignored. Cells of
+  LIST_FIELDS hold an item per line."""
+  reader = csv.DictReader(source)
+  try:
+    if not set(reader.fieldnames or ()) & set(TEXT_FIELDS + LIST_FIELDS):
+      raise FormatError("The header row names none of the fields: %s" %
+                        ", ".join(TEXT_FIELDS + LIST_FIELDS))
+    for row in reader:
+      values = dict((field, (row.get(field) or "").decode('utf-8'))
+                    for field in TEXT_FIELDS + LIST_FIELDS)
+      yield _record(lambda field: _split_cell(values[field], field)
+                    if field in LIST_FIELDS else values[field] or None)
+  except csv.Error as error:
+    raise FormatError("Line %d: %s" % (reader.line_num, error))
+  except UnicodeDecodeError:
+    raise FormatError("Line %d: not UTF-8" % reader.line_num)
+
+
+_READERS = {
+  XML: iter_xml_records,
+  CSV: iter_csv_records,
+  NDJSON: iter_ndjson_records,
+}
+
+
+def iter_records(source, import_format):
+  """Yields the records of an upload as dicts of field to value.
+
+  Raises:
+    FormatError: if the upload stops parsing, after the records before."""
+  if import_format not in _READERS:
+    raise FormatError("Uploads must be %s files" %
+                      ", ".join(sorted(EXTENSIONS)))
+  return _READERS[import_format](source)
+
+
+def monster_from_record(record, product, creator, monster_id=None):
+  """Returns an unsaved Monster for a record of an upload.
+
+  Args:
+    record: the record, see iter_records.
+    product: the id of the product it belongs to, -1 for the core monsters.
+    creator: the Profile of the publisher uploading it.
+    monster_id: the id to give it, or None to have one assigned on put."""
+  if monster_id:
+    monster = Monster(key=db.Key.from_path('Monster', monster_id))
+  else:
+    monster = Monster()
+
+  if product == -1:
+    monster.is_core = True
+  else:
+    monster.product = product
+  monster.creator = creator
+
+  for field in TEXT_FIELDS:
+    setattr(monster, field, record[field])
+  for field in LIST_FIELDS:
+    values = [value for value in record[field] if (value or "").strip()]
+    if field in TAG_FIELDS:
+      values = map(normalize_tag, values)
+    setattr(monster, field, values)
+  return monster
+
+
+def encode_records(records, import_format):
+  """Returns records as an upload in a format, as a UTF-8 string."""
+  if import_format == NDJSON:
+    return "".join(json.dumps(record) + "\n" for record in records)
+  if import_format == CSV:
+    output = StringIO.StringIO()
+    writer = csv.writer(output)
+    writer.writerow(TEXT_FIELDS + LIST_FIELDS)
+    for record in records:
+      writer.writerow(
+        [(record[field] or u"").encode('utf-8') for field in TEXT_FIELDS] +
+        [u"\n".join(record[field]).encode('utf-8') for field in LIST_FIELDS])
+    return output.getvalue()
+  root = ET.Element('monsters')
+  for record in records:
+    element = ET.SubElement(root, 'monster')
+    for field in TEXT_FIELDS:
+      ET.SubElement(element, field).text = record[field]
+    for field in LIST_FIELDS:
+      parent = ET.SubElement(element, field)
+      for item in record[field]:
+        ET.SubElement(parent, 'item').text = item
+  return ET.tostring(root, encoding='utf-8')
+
+
+def benchmark(count=1000):
+  """Times reading, checking and mapping count monsters in each format.
+
+  Writing is the same batched Monster.put_multi whatever the format, so
+  only the parts that differ are timed: the rates don't count datastore or
+  index writes, and the results say so.
+
+  Returns:
+    A dict of 'formats', mapping each format to its upload's size in bytes,
+    the seconds taken and the records and bytes per second, and
+    'includes_writes', which is False."""
+  records = [_record(lambda field: [u"%s %d" % (field, i), u"Large"]
+                     if field in LIST_FIELDS else u"%s %d" % (field, i))
+             for i in xrange(count)]
+  results = {}
+  for import_format in _READERS:
+    data = encode_records(records, import_format)
+    start = time.time()
+    for record in iter_records(StringIO.StringIO(data), import_format):
+      check_record(record)
+      monster_from_record(record, -1, None)
+    seconds = time.time() - start
+    results[import_format] = {
+      'bytes': len(data),
+      'seconds': seconds,
+      'records_per_second': count / seconds if seconds > 0 else 0.0,
+      'bytes_per_second': len(data) / seconds if seconds > 0 else 0.0,
+    }
+  return {'formats': results, 'includes_writes': False}
+
+
+def _product_names(product):
+  """Returns the normalized names of the monsters already in a product.
+
+  Only the names are read, with a projection query."""
+  query = Monster.all(projection=('name',))
+  if product == -1:
+    query.filter('is_core =', True)
+  else:
+    query.filter('product =', product)
+  return set(nameindex.normalize(monster.name)
+             for monster in query.run(batch_size=1000))
+
+
+def check_record(record):
+  """Returns the errors and warnings of one record of an upload.
+
+  Returns:
+    A tuple of two lists of messages: errors, which stop the upload being
+    imported, and warnings about changes the import will make."""
+  errors = []
+  warnings = []
+  for field in REQUIRED_FIELDS:
+    if not (record[field] or "").strip():
+      errors.append("Missing %s" % field)
+  for field in REQUIRED_LISTS:
+    if not [text for text in record[field] if (text or "").strip()]:
+      errors.append("Missing %s" % field)
+  for field in LIST_FIELDS:
+    for text in record[field]:
+      if not (text or "").strip():
+        warnings.append("Skipping a blank entry in %s" % field)
+        continue
+      if field not in TAG_FIELDS:
+        continue
+      tag = normalize_tag(text)
+      if tag != text:
+        warnings.append(u'Importing "%s" in %s as "%s"' % (text, field, tag))
+  return errors, warnings
+
+
+def new_report(import_format):
+  """Returns the report of an upload none of whose records are checked."""
+  return {'format': import_format, 'records': 0, 'errors': 0,
+          'warnings': 0, 'parse_error': None, 'problem_records': 0,
+          'problems': [], 'seconds': 0.0}
+
+
+def check_records(report, seen, existing, source, deadline=None):
+  """Checks the records of an upload that report doesn't count yet.
+
+  Streams can't be resumed mid-document, so the records already checked
+  are parsed again and skipped. At least one record is checked per call.
+
+  Args:
+    report: the report so far, see validate. Updated in place.
+    seen: a dict of the normalized names checked so far to the record
+      they're first in. Updated in place.
+    existing: the normalized names already in the product.
+    source: a file-like object reading the upload.
+    deadline: the time.time() to stop at, or None to check every record.
+
+  Returns:
+    Whether every record is checked, and so the report complete."""
+  start = time.time()
+  skip = report['records']
+  checked = 0
+  try:
+    for record in iter_records(source, report['format']):
+      if skip:
+        skip -= 1
+        continue
+      if checked and deadline is not None and time.time() > deadline:
+        report['seconds'] += time.time() - start
+        return False
+      checked += 1
+      report['records'] += 1
+      number = report['records']
+      errors, warnings = check_record(record)
+      name = nameindex.normalize(record['name'])
+      if name in seen:
+        errors.append("Same name as record %d" % seen[name])
+      elif name and name in existing:
+        errors.append("Already in the product")
+      if name:
+        seen.setdefault(name, number)
+      report['errors'] += len(errors)
+      report['warnings'] += len(warnings)
+      if not errors and not warnings:
+        continue
+      report['problem_records'] += 1
+      if len(report['problems']) < MAX_REPORTED_RECORDS:
+        report['problems'].append({'record': number,
+                                   'name': record['name'],
+                                   'errors': errors, 'warnings': warnings})
+  except FormatError as error:
+    report['parse_error'] = str(error)
+  if not report['records'] and not report['parse_error']:
+    report['parse_error'] = "No monsters found"
+
+  report['seconds'] += time.time() - start
+  seconds = report['seconds']
+  size = source.tell() if hasattr(source, 'tell') else 0
+  report.update({
+    'ok': not report['errors'] and not report['parse_error'],
+    'bytes': size,
+    'records_per_second': report['records'] / seconds if seconds > 0 else 0.0,
+    'bytes_per_second': size / seconds if seconds > 0 else 0.0,
+  })
+  return True
+
+
+def validate(source, product, import_format=XML):
+  """Checks every record of an upload, without writing anything.
+
+  Records are checked for REQUIRED_FIELDS and REQUIRED_LISTS, for tags that
+  will be normalized (see normalize_tag), and for names that appear twice in
+  the upload or are already in the product.
+
+  Args:
+    source: a file-like object reading the upload.
+    product: the id of the product it's for, -1 for the core monsters.
+    import_format: the upload's format, see iter_records.
+
+  Returns:
+    A dict of the format, the number of records, errors and warnings,
+    whether the upload can be imported ('ok'), the FormatError that stopped
+    the check if any, the seconds it took and its throughput. 'problems'
+    lists the records with errors or warnings, by their position in the
+    upload and name, up to MAX_REPORTED_RECORDS of the 'problem_records'."""
+  report = new_report(import_format)
+  check_records(report, {}, _product_names(product), source)
+  return report
+
+
+def validate_upload(blob_info, product, creator, dry_run=False):
+  """Validates an uploaded file, then imports it unless it's a dry run.
+
+  The calling request validates and imports what it can in INLINE_BUDGET
+  seconds, so most files are done by the time it returns; tasks carry on
+  with the rest.
+
+  Returns:
+    A new ImportJob for the upload. Once it's checked, it holds the report,
+    see validate, and it's validated if the upload can be imported."""
+  import_format = format_for(blob_info.filename)
+  job = ImportJob(key_name=uuid.uuid4().hex, blob=blob_info, product=product,
+                  import_format=import_format, creator=creator,
+                  dry_run=dry_run,
+                  report=json.dumps(new_report(import_format)))
+  job.put()
+  run_validation(job.key().name(), INLINE_BUDGET)
+  return ImportJob.get_by_key_name(job.key().name())
+
+
+def run_validation(job_id, budget=IMPORT_BUDGET):
+  """Validates the next part of an upload, for about budget seconds.
+
+  Checkpoints the report and schedules the next task if it runs out of
+  time. Once the upload is checked, imports it in what's left of budget if
+  it passed and isn't a dry run."""
+  job = ImportJob.get_by_key_name(job_id)
+  if not job or job.checked:
+    return
+  deadline = time.time() + budget
+  report = job.get_report()
+  seen = job.get_seen()
+  reader = blobstore.BlobReader(ImportJob.blob.get_value_for_datastore(job))
+  if not check_records(report, seen, _product_names(job.product), reader,
+                       deadline):
+    job.report = json.dumps(report)
+    job.set_seen(seen)
+    job.tasks += 1
+    job.put()
+    _schedule_task(VALIDATE_URL, "validate", job_id, job.tasks)
+    return
+  job.report = json.dumps(report)
+  job.seen = None
+  job.checked = True
+  job.validated = report['ok']
+  job.put()
+  if job.validated and not job.dry_run:
+    start_import(job, max(0, deadline - time.time()))
+
+
+def start_import(job, budget=INLINE_BUDGET):
+  """Starts importing a validated upload.
+
+  The caller imports what it can in budget seconds; tasks carry on with the
+  rest. The job is marked started in a transaction, so only one of two
+  requests starting it at once, say from a double click, runs the import.
+
+  Returns:
+    The ImportJob, brought up to date."""
+  if not job.validated:
+    raise ValueError("Upload %s didn't pass validation" % job.key().name())
+  job_id = job.key().name()
+  def txn():
+    current = ImportJob.get_by_key_name(job_id)
+    if current.started:
+      return None
+    current.started = True
+    current.put()
+    return current
+  current = db.run_in_transaction(txn)
+  if current:
+    if budget:
+      run_import(job_id, budget)
+    else:
+      _schedule_task(IMPORT_URL, "import", job_id, current.tasks)
+  return ImportJob.get_by_key_name(job_id)
+
+
+def run_import(job_id, budget=IMPORT_BUDGET):
+  """Imports the next part of an upload, for about budget seconds.
+
+  Streams can't be resumed mid-document, so the records already imported
+  are parsed again and skipped. Schedules the next task if it runs out of
+  time."""
+  job = ImportJob.get_by_key_name(job_id)
+  if not job or job.done:
+    return
+  reader = blobstore.BlobReader(ImportJob.blob.get_value_for_datastore(job))
+  if not import_records(job, reader, time.time() + budget):
+    job.tasks += 1
+    job.put()
+    _schedule_task(IMPORT_URL, "import", job_id, job.tasks)
+
+
+def import_records(job, source, deadline):
+  """Imports the records of source that job hasn't yet, until deadline.
+
+  Args:
+    job: the ImportJob.
+    source: a file-like object reading the upload.
+    deadline: the time.time() to stop at, after the batch in progress.
+
+  Returns:
+    Whether the import is done."""
+  creator = job.creator
+  skip = job.records
+  batch = []
+  for record in iter_records(source, job.import_format):
+    if skip:
+      skip -= 1
+      continue
+    if not job.pending_ids:
+      start, end = db.allocate_ids(db.Key.from_path('Monster', 1), BATCH_SIZE)
+      job.pending_ids = range(start, end + 1)
+      job.put()
+    batch.append(monster_from_record(record, job.product, creator,
+                                     job.pending_ids[len(batch)]))
+    if len(batch) >= BATCH_SIZE:
+      _write_batch(job, batch, source)
+      batch = []
+      if time.time() > deadline:
+        return False
+  if batch:
+    _write_batch(job, batch, source)
+  job.done = True
+  job.put()
+  return True
+
+
+def _write_batch(job, monsters, source):
+  """Writes a batch of monsters and checkpoints job past them."""
+  Monster.put_multi(monsters)
+  job.records += len(monsters)
+  if hasattr(source, 'tell'):
+    job.bytes_read = source.tell()
+  job.pending_ids = []
+  job.put()
+
+
+def _schedule_task(url, prefix, job_id, task_number):
+  # Named so a retried task can't fork the chain.
+  try:
+    taskqueue.add(
+      url=url,
+      name="%s-%s-%d" % (prefix, job_id, task_number),
+      params={'job': job_id})
+  except (taskqueue.TaskAlreadyExistsError, taskqueue.TombstonedTaskError):
+    pass
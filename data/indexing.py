@@ -0,0 +1,598 @@
+from google.appengine.ext import db
+from google.appengine.api import search
+from google.appengine.api import taskqueue
+from data import localsearch
+from data import nameindex
+from data import searchcache
+import cPickle
+import json
+import logging
+import time
+import uuid
+
+# Pull queue holding the ids of monsters whose documents are out of date.
+QUEUE_NAME = "search-index"
+
+# Most documents search.Index.put and delete accept per call.
+BATCH_SIZE = 200
+
+# Seconds between drains of the queue; writes in one window share a drain.
+DRAIN_INTERVAL = 5
+
+DRAIN_URL = "/tasks/search-index/drain"
+
+# How long one drain request keeps leasing batches before handing off.
+DRAIN_BUDGET = 60
+
+REINDEX_URL = "/tasks/search-index/reindex"
+
+# Monsters each re-index task reads before checkpointing and chaining.
+REINDEX_SLICE_SIZE = 1000
+
+# Seconds Monster.search waits for the search API before answering from the
+# snapshot instead.
+SEARCH_DEADLINE = 2
+
+SNAPSHOT_URL = "/tasks/search-index/snapshot"
+
+# Monsters each snapshot task reads before checkpointing and chaining.
+SNAPSHOT_SLICE_SIZE = 1000
+
+# Most monsters a snapshot holds. Instances load the whole snapshot into
+# memory, and the last task of a rebuild holds every slice at once, so this
+# keeps both well inside an instance's memory. Monsters past it, in key
+# order, are left out and a warning is logged.
+SNAPSHOT_MAX_DOCUMENTS = 100000
+
+# Bytes of snapshot stored per entity, safely under the 1MB entity limit.
+SNAPSHOT_CHUNK_SIZE = 900 * 1024
+
+# Seconds an instance answers from a loaded snapshot before reloading it.
+SNAPSHOT_TTL = 60 * 60
+
+_PUT = "put"
+_DELETE = "delete"
+
+
+# A LocalIndex standing in for the search API, see use_local_index.
+_local_index = None
+
+# The snapshot this instance last loaded and when, see load_snapshot.
+_snapshot = None
+_snapshot_time = 0
+
+
+def use_local_index(index):
+  """Makes the monster index a LocalIndex in this process.
+  
+  Documents are written to and searched in index instead of the search API,
+  for tests and local benchmarks. Pass None to go back to the search API."""
+  global _local_index
+  _local_index = index
+  
+  
+def get_local_index():
+  """Returns the LocalIndex set by use_local_index, or None."""
+  return _local_index
+  
+  
+def get_index():
+  """Returns the index monster documents are written to."""
+  # data.models imports this module.
+  from data.models import _MONSTER_INDEX
+  if _local_index is not None:
+    return _local_index
+  return search.Index(name=_MONSTER_INDEX)
+
+
+def _enqueue(monster_ids, op):
+  now = time.time()
+  tasks = [taskqueue.Task(
+             payload=json.dumps({'op': op, 'id': monster_id, 'time': now}), 
+             method='PULL') 
+           for monster_id in monster_ids]
+  queue = taskqueue.Queue(QUEUE_NAME)
+  # Queue.add takes at most 100 tasks per call.
+  for start in xrange(0, len(tasks), 100):
+    queue.add(tasks[start:start + 100])
+  schedule_drain()
+
+
+def enqueue(monster_ids):
+  """Marks the documents of monster_ids as needing to be rebuilt."""
+  _enqueue(monster_ids, _PUT)
+  
+  
+def enqueue_delete(monster_ids):
+  """Marks the documents of monster_ids as needing to be removed."""
+  _enqueue(monster_ids, _DELETE)
+
+
+def schedule_drain():
+  """Makes sure a drain of the queue is pending.
+  
+  Drains are named after the DRAIN_INTERVAL window they cover and run when
+  the window closes, so a burst of writes causes a single drain."""
+  now = time.time()
+  window = int(now) // DRAIN_INTERVAL
+  try:
+    taskqueue.add(
+      url=DRAIN_URL, 
+      name="search-index-drain-%d" % window,
+      countdown=(window + 1) * DRAIN_INTERVAL + 1 - now)
+  except (taskqueue.TaskAlreadyExistsError, taskqueue.TombstonedTaskError):
+    pass
+
+
+def drain_batch():
+  """Leases up to BATCH_SIZE updates and applies them to the index.
+  
+  Repeated updates to one monster collapse into whichever was enqueued
+  last. Monsters that no longer exist are removed from the index. The
+  batch's names are recorded for the name index, see data.nameindex, and
+  cached search results are invalidated if any document changed.
+  
+  Returns:
+    The number of updates leased; 0 when the queue is empty."""
+  # data.models imports this module.
+  from data.models import Monster
+  
+  queue = taskqueue.Queue(QUEUE_NAME)
+  tasks = queue.lease_tasks(lease_seconds=DRAIN_BUDGET, max_tasks=BATCH_SIZE)
+  if not tasks:
+    return 0
+    
+  latest = {}
+  for task in tasks:
+    update = json.loads(task.payload)
+    current = latest.get(update['id'])
+    if not current or current['time'] <= update['time']:
+      latest[update['id']] = update
+      
+  put_ids = [monster_id for monster_id, op in latest.items() 
+             if op['op'] == _PUT]
+  delete_ids = [monster_id for monster_id, op in latest.items() 
+                if op['op'] == _DELETE]
+  documents = []
+  names = []
+  for monster_id, monster in zip(put_ids, Monster.get_by_id(put_ids)):
+    if monster:
+      documents.append(monster.create_document())
+      names.append((monster_id, monster.name, monster.get_access_atom()))
+    else:
+      delete_ids.append(monster_id)
+      
+  index = get_index()
+  doc_ids = [str(monster_id) for monster_id in delete_ids]
+  if documents:
+    index.put(documents)
+  if doc_ids:
+    index.delete(doc_ids)
+  if searchcache.changed(documents, doc_ids):
+    searchcache.invalidate()
+  nameindex.record(names + [(monster_id, None, None) 
+                            for monster_id in delete_ids])
+  queue.delete_tasks(tasks)
+  return len(tasks)
+  
+  
+def drain(budget=DRAIN_BUDGET):
+  """Drains batches until the queue is empty or budget seconds pass.
+  
+  Returns:
+    True if the queue was emptied."""
+  deadline = time.time() + budget
+  while time.time() < deadline:
+    try:
+      if not drain_batch():
+        return True
+    except search.Error:
+      # The leased updates go back on the queue when their lease expires.
+      logging.exception('Index update failed')
+      return False
+  return False
+
+
+def flush():
+  """Applies every pending update now. For tests and admin tools."""
+  while drain_batch():
+    pass
+
+
+def lag():
+  """Returns how many seconds the index trails the datastore.
+  
+  That's the age of the oldest pending update, or 0 if nothing is pending."""
+  stats = taskqueue.Queue(QUEUE_NAME).fetch_statistics()
+  if not stats.tasks or not stats.oldest_eta_usec:
+    return 0.0
+  return max(0.0, time.time() - stats.oldest_eta_usec / 1e6)
+
+
+class ReindexJob(db.Model):
+  """A rebuild of the whole monster index. Key name is the job id."""
+  start_time = db.DateTimeProperty(auto_now_add=True)
+  shard_count = db.IntegerProperty()
+  
+  def get_shards(self):
+    return [shard for shard in ReindexShard.get_by_key_name(
+              [ReindexShard.key_name_for(self.key().name(), index) 
+               for index in xrange(self.shard_count)]) 
+            if shard]
+            
+  def get_progress(self):
+    """Returns a dict describing how far the job has got and how fast."""
+    shards = self.get_shards()
+    documents = sum(shard.documents for shard in shards)
+    last_update = max([shard.updated for shard in shards] or [self.start_time])
+    elapsed = (last_update - self.start_time).total_seconds()
+    return {
+      'job': self.key().name(),
+      'shards': self.shard_count,
+      'shards_done': len([shard for shard in shards if shard.done]),
+      'documents': documents,
+      'elapsed_seconds': elapsed,
+      'documents_per_second': documents / elapsed if elapsed > 0 else 0.0,
+    }
+
+
+class ReindexShard(db.Model):
+  """One key range of a ReindexJob and its checkpoint.
+  
+  Key name is "<job id>:<shard index>". The range is [start, end); either
+  bound may be None for an open end."""
+  start = db.ReferenceProperty(indexed=False, collection_name='start_set')
+  end = db.ReferenceProperty(indexed=False, collection_name='end_set')
+  cursor = db.TextProperty()
+  documents = db.IntegerProperty(default=0, indexed=False)
+  slices = db.IntegerProperty(default=0, indexed=False)
+  done = db.BooleanProperty(default=False, indexed=False)
+  updated = db.DateTimeProperty(auto_now=True, indexed=False)
+  
+  @staticmethod
+  def key_name_for(job_id, index):
+    return "%s:%d" % (job_id, index)
+
+
+def _split_points(shard_count):
+  """Returns up to shard_count - 1 Monster keys that split it evenly.
+  
+  Uses the __scatter__ property, which the datastore sets on a random sample
+  of entities, so sorting the sample gives approximate quantiles."""
+  from data.models import Monster
+  oversample = 16
+  sample = Monster.all(keys_only=True).order('__scatter__').fetch(
+    shard_count * oversample)
+  sample.sort()
+  step = len(sample) / float(shard_count)
+  return [sample[int(step * index)] for index in xrange(1, shard_count) 
+          if int(step * index) < len(sample)]
+  
+
+def start_reindex(shard_count=8):
+  """Starts rebuilding the index for every monster.
+  
+  The monsters are split into key ranges that re-index in parallel, each as a
+  chain of tasks that checkpoint after every REINDEX_SLICE_SIZE monsters, so
+  the job survives instance restarts and task retries.
+  
+  Returns:
+    The new ReindexJob."""
+  job_id = uuid.uuid4().hex
+  bounds = [None] + sorted(set(_split_points(shard_count))) + [None]
+  job = ReindexJob(key_name=job_id, shard_count=len(bounds) - 1)
+  shards = [ReindexShard(key_name=ReindexShard.key_name_for(job_id, index), 
+                         start=bounds[index], end=bounds[index + 1]) 
+            for index in xrange(job.shard_count)]
+  db.put([job] + shards)
+  for index in xrange(job.shard_count):
+    _schedule_slice(job_id, index, 0)
+  return job
+  
+  
+def _schedule_slice(job_id, index, slice_number):
+  # Named so a retried task can't fork its shard's chain.
+  try:
+    taskqueue.add(
+      url=REINDEX_URL, 
+      name="reindex-%s-%d-%d" % (job_id, index, slice_number),
+      params={'job': job_id, 'shard': index, 'slice': slice_number})
+  except (taskqueue.TaskAlreadyExistsError, taskqueue.TombstonedTaskError):
+    pass
+
+
+def reindex_slice(job_id, index, slice_number=None):
+  """Re-indexes the next REINDEX_SLICE_SIZE monsters of one shard.
+  
+  Documents are built and put BATCH_SIZE at a time, then the shard's cursor
+  is checkpointed and the next slice scheduled. Re-running a slice only puts
+  the same documents again, and cached search results are only invalidated
+  when a document changed.
+  
+  Args:
+    job_id: the key name of the ReindexJob.
+    index: the shard's index.
+    slice_number: the slice the task was scheduled for, or None for
+      whichever is next. A task for a slice the shard has already
+      checkpointed only makes sure the slice after it is scheduled."""
+  from data.models import Monster
+  
+  key_name = ReindexShard.key_name_for(job_id, index)
+  shard = ReindexShard.get_by_key_name(key_name)
+  if not shard or shard.done:
+    return
+  if slice_number is not None and shard.slices != slice_number:
+    if shard.slices == slice_number + 1:
+      _schedule_slice(job_id, index, shard.slices)
+    return
+    
+  query = Monster.all()
+  start = ReindexShard.start.get_value_for_datastore(shard)
+  end = ReindexShard.end.get_value_for_datastore(shard)
+  if start:
+    query.filter('__key__ >= ', start)
+  if end:
+    query.filter('__key__ < ', end)
+  query.order('__key__')
+  if shard.cursor:
+    query.with_cursor(shard.cursor)
+    
+  index_api = get_index()
+  count = 0
+  changed = False
+  batch = []
+  for monster in query.run(limit=REINDEX_SLICE_SIZE, batch_size=BATCH_SIZE):
+    batch.append(monster.create_document())
+    count += 1
+    if len(batch) >= BATCH_SIZE:
+      index_api.put(batch)
+      changed = searchcache.changed(batch) or changed
+      batch = []
+  if batch:
+    index_api.put(batch)
+    changed = searchcache.changed(batch) or changed
+  if changed:
+    searchcache.invalidate()
+    
+  cursor = query.cursor()
+  expected = shard.slices
+  def txn():
+    current = ReindexShard.get_by_key_name(key_name)
+    if current.slices != expected:
+      return current
+    current.cursor = cursor
+    current.documents += count
+    current.slices += 1
+    current.done = count < REINDEX_SLICE_SIZE
+    current.put()
+    return current
+  shard = db.run_in_transaction(txn)
+  if not shard.done:
+    _schedule_slice(job_id, index, shard.slices)
+
+
+class SearchSnapshot(db.Model):
+  """The current version of a snapshot, see save_blob.
+  
+  Key name is the snapshot's name. The data itself is split across
+  SearchSnapshotChunks, so a new version can be written before it's switched
+  to."""
+  generation = db.StringProperty(indexed=False)
+  chunks = db.IntegerProperty(indexed=False)
+  documents = db.IntegerProperty(indexed=False)
+  created = db.DateTimeProperty(auto_now=True, indexed=False)
+  
+  
+class SearchSnapshotChunk(db.Model):
+  """A piece of a snapshot. Key name is "<generation>:<chunk index>"."""
+  data = db.BlobProperty()
+  
+  @staticmethod
+  def key_name_for(generation, index):
+    return "%s:%d" % (generation, index)
+
+
+class SnapshotJob(db.Model):
+  """A rebuild of the search and name snapshots, see start_snapshot.
+  
+  Key name is the job id. Each slice's documents are saved as a snapshot of
+  their own, named by part_name_for, until the last slice combines them."""
+  as_of = db.DateTimeProperty(auto_now_add=True, indexed=False)
+  cursor = db.TextProperty()
+  documents = db.IntegerProperty(default=0, indexed=False)
+  slices = db.IntegerProperty(default=0, indexed=False)
+  # Whether every slice has been read; done once they're combined.
+  scanned = db.BooleanProperty(default=False, indexed=False)
+  done = db.BooleanProperty(default=False, indexed=False)
+  
+  @staticmethod
+  def part_name_for(job_id, slice_number):
+    return "snapshot-part:%s:%d" % (job_id, slice_number)
+
+
+def start_snapshot():
+  """Starts snapshotting every monster into a LocalIndex and a NameIndex.
+  
+  Monster.search answers from the LocalIndex when the search API fails or
+  misses SEARCH_DEADLINE, and Monster.suggest answers from the NameIndex.
+  Cron rebuilds them periodically, see cron.yaml. The monsters are read as
+  a chain of tasks that checkpoint after every SNAPSHOT_SLICE_SIZE, up to
+  SNAPSHOT_MAX_DOCUMENTS.
+  
+  Returns:
+    The new SnapshotJob."""
+  job_id = uuid.uuid4().hex
+  job = SnapshotJob(key_name=job_id)
+  job.put()
+  _schedule_snapshot(job_id, 0)
+  return job
+  
+  
+def _schedule_snapshot(job_id, slice_number):
+  # Named so a retried task can't fork the chain.
+  try:
+    taskqueue.add(
+      url=SNAPSHOT_URL, 
+      name="snapshot-%s-%d" % (job_id, slice_number),
+      params={'job': job_id, 'slice': slice_number})
+  except (taskqueue.TaskAlreadyExistsError, taskqueue.TombstonedTaskError):
+    pass
+    
+    
+def snapshot_slice(job_id, slice_number):
+  """Snapshots the next SNAPSHOT_SLICE_SIZE monsters of a SnapshotJob.
+  
+  The slice is saved as a part and the job's cursor checkpointed, then the
+  next slice is scheduled, or the parts are combined after the last one. A
+  task for a slice the job has already checkpointed only makes sure what
+  follows it happens."""
+  # data.models imports this module.
+  from data.models import Monster, _RETURNED_FIELDS, _SEARCHED_FIELDS
+  
+  job = SnapshotJob.get_by_key_name(job_id)
+  if not job or job.done:
+    return
+  if job.slices != slice_number:
+    if job.slices == slice_number + 1:
+      _continue_snapshot(job)
+    return
+  
+  query = Monster.all().order('__key__')
+  if job.cursor:
+    query.with_cursor(job.cursor)
+  limit = min(SNAPSHOT_SLICE_SIZE, SNAPSHOT_MAX_DOCUMENTS - job.documents)
+  index = localsearch.LocalIndex(_RETURNED_FIELDS, _SEARCHED_FIELDS)
+  names = {}
+  count = 0
+  for monster in query.run(limit=limit, batch_size=BATCH_SIZE):
+    index.put(monster.create_document())
+    if nameindex.normalize(monster.name):
+      names[monster.key().id()] = (monster.name, monster.get_access_atom())
+    count += 1
+  save_blob(SnapshotJob.part_name_for(job_id, slice_number), 
+            cPickle.dumps((index.dumps(), names), cPickle.HIGHEST_PROTOCOL),
+            count)
+  
+  cursor = query.cursor()
+  def txn():
+    current = SnapshotJob.get_by_key_name(job_id)
+    if current.slices != slice_number:
+      return current
+    current.cursor = cursor
+    current.documents += count
+    current.slices += 1
+    current.scanned = (count < limit or 
+                       current.documents >= SNAPSHOT_MAX_DOCUMENTS)
+    current.put()
+    return current
+  job = db.run_in_transaction(txn)
+  if job.documents >= SNAPSHOT_MAX_DOCUMENTS:
+    logging.warning("Snapshot stopped at SNAPSHOT_MAX_DOCUMENTS (%d)", 
+                    SNAPSHOT_MAX_DOCUMENTS)
+  _continue_snapshot(job)
+  
+  
+def _continue_snapshot(job):
+  """Schedules a SnapshotJob's next slice, or combines its parts into the
+  current snapshots once every slice has been read."""
+  from data.models import _MONSTER_INDEX
+  
+  job_id = job.key().name()
+  if not job.scanned:
+    _schedule_snapshot(job_id, job.slices)
+    return
+    
+  part_names = [SnapshotJob.part_name_for(job_id, number) 
+                for number in xrange(job.slices)]
+  indexes = []
+  names = {}
+  for part_name in part_names:
+    data = load_blob(part_name)
+    if data is None:
+      raise ValueError("Snapshot part %s is missing" % part_name)
+    index_data, entries = cPickle.loads(data)
+    indexes.append(index_data)
+    names.update(entries)
+  save_blob(_MONSTER_INDEX, localsearch.LocalIndex.concat(indexes), 
+            job.documents)
+  nameindex.save(nameindex.NameIndex.from_entries(names), job.as_of)
+  job.done = True
+  job.put()
+  for part_name in part_names:
+    delete_blob(part_name)
+  
+  
+def save_blob(name, data, documents):
+  """Saves data as the current version of the snapshot called name.
+  
+  The data is split into SNAPSHOT_CHUNK_SIZE chunks, so it can be larger than
+  an entity. The previous version is deleted once this one is current.
+  
+  Args:
+    name: the snapshot's name.
+    data: the snapshot, a string.
+    documents: how many documents it holds, for reporting."""
+  generation = uuid.uuid4().hex
+  chunks = [SearchSnapshotChunk(
+              key_name=SearchSnapshotChunk.key_name_for(generation, number), 
+              data=db.Blob(data[start:start + SNAPSHOT_CHUNK_SIZE]))
+            for number, start in enumerate(
+              xrange(0, len(data), SNAPSHOT_CHUNK_SIZE))]
+  # Chunks go one per RPC to stay under the request size limit.
+  for chunk in chunks:
+    chunk.put()
+    
+  previous = SearchSnapshot.get_by_key_name(name)
+  SearchSnapshot(key_name=name, generation=generation, 
+                 chunks=len(chunks), documents=documents).put()
+  if previous:
+    db.delete(_chunk_keys(previous))
+               
+               
+def _chunk_keys(pointer):
+  return [db.Key.from_path(
+            'SearchSnapshotChunk', 
+            SearchSnapshotChunk.key_name_for(pointer.generation, number)) 
+          for number in xrange(pointer.chunks)]
+          
+          
+def delete_blob(name):
+  """Deletes the snapshot called name, if there is one."""
+  pointer = SearchSnapshot.get_by_key_name(name)
+  if pointer:
+    db.delete([pointer.key()] + _chunk_keys(pointer))
+               
+               
+def load_blob(name):
+  """Returns the data of the current version of the snapshot called name.
+  
+  Returns:
+    The data, or None if there's no such snapshot or it was replaced while
+    being read."""
+  pointer = SearchSnapshot.get_by_key_name(name)
+  if not pointer:
+    return None
+  chunks = SearchSnapshotChunk.get_by_key_name(
+    [SearchSnapshotChunk.key_name_for(pointer.generation, number) 
+     for number in xrange(pointer.chunks)])
+  if None in chunks:
+    return None
+  return "".join(chunk.data for chunk in chunks)
+  
+  
+def load_snapshot():
+  """Returns the current snapshot as a LocalIndex, or None if there's none.
+  
+  The snapshot is kept in instance memory for SNAPSHOT_TTL seconds."""
+  from data.models import _MONSTER_INDEX
+  global _snapshot, _snapshot_time
+  
+  if _snapshot is not None and time.time() - _snapshot_time < SNAPSHOT_TTL:
+    return _snapshot
+  data = load_blob(_MONSTER_INDEX)
+  if not data:
+    # Missing, or replaced while we were reading it; keep what we had.
+    return _snapshot
+  _snapshot = localsearch.LocalIndex.loads(data)
+  _snapshot_time = time.time()
+  return _snapshot
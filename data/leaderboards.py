@@ -0,0 +1,258 @@
+from google.appengine.ext import db
+from google.appengine.api import memcache
+from google.appengine.api import taskqueue
+import heapq
+import json
+import logging
+import time
+
+# Number of monsters kept on each board.
+BOARD_SIZE = 50
+
+# Kinds of board. Each product (and the public codex, product -1) has one
+# board of each kind.
+TOP = "top"
+RECENT = "recent"
+KINDS = (TOP, RECENT)
+
+# Pull queue holding board updates that haven't been applied yet.
+QUEUE_NAME = "leaderboards"
+
+# Seconds between applications of the queued updates; updates in one window
+# share one write per board.
+APPLY_INTERVAL = 5
+
+APPLY_URL = "/tasks/leaderboards/apply"
+
+# How long one apply request keeps leasing batches before handing off.
+APPLY_BUDGET = 60
+
+# Most updates leased per batch.
+APPLY_BATCH_SIZE = 1000
+
+
+class Leaderboard(db.Model):
+  """The BOARD_SIZE best monsters of one product by one measure.
+  
+  Key name is "<kind>:<product id>". Entries are kept in parallel lists,
+  best first."""
+  monster_ids = db.ListProperty(long, indexed=False)
+  values = db.ListProperty(float, indexed=False)
+  
+  @staticmethod
+  def key_name_for(kind, product):
+    return "%s:%s" % (kind, product)
+    
+  def entries(self):
+    return zip(self.values, self.monster_ids)
+    
+  def set_entries(self, entries):
+    entries = sorted(entries, reverse=True)[:BOARD_SIZE]
+    self.values = [value for value, monster_id in entries]
+    self.monster_ids = [monster_id for value, monster_id in entries]
+
+
+def _mem_key(key_name):
+  return "leaderboard:%s" % key_name
+
+
+def get_entries(kind, products):
+  """Reads the boards of kind for products.
+  
+  Boards are read with one memcache get_multi; any misses are fetched with
+  one datastore get and cached.
+  
+  Returns:
+    A dict of product to that board's [(value, monster id)], best first."""
+  key_names = dict((product, Leaderboard.key_name_for(kind, product)) 
+                   for product in products)
+  cached = memcache.get_multi([_mem_key(key_name) 
+                               for key_name in key_names.values()])
+  missing = [key_name for key_name in key_names.values() 
+             if _mem_key(key_name) not in cached]
+  if missing:
+    fetched = {}
+    for key_name, board in zip(missing, 
+                               Leaderboard.get_by_key_name(missing)):
+      fetched[_mem_key(key_name)] = board.entries() if board else []
+    memcache.set_multi(fetched)
+    cached.update(fetched)
+  return dict((product, cached[_mem_key(key_name)]) 
+              for product, key_name in key_names.items())
+  
+
+def merged(kind, products, limit):
+  """Returns the ids of the best limit monsters across products' boards."""
+  boards = get_entries(kind, products).values()
+  # heapq.merge wants ascending inputs, so merge on negated values.
+  streams = [[(-value, monster_id) for value, monster_id in board] 
+             for board in boards]
+  seen = set()
+  result = []
+  for value, monster_id in heapq.merge(*streams):
+    if monster_id not in seen:
+      seen.add(monster_id)
+      result.append(monster_id)
+      if len(result) >= limit:
+        break
+  return result
+  
+  
+def _modify(kind, product, change):
+  """Applies change to a board's entries in a transaction and re-caches it.
+  
+  Boards are shared by every monster in a product, so a failed transaction is
+  logged rather than retried.
+  
+  Returns:
+    Whether the board was written."""
+  key_name = Leaderboard.key_name_for(kind, product)
+  def txn():
+    board = Leaderboard.get_by_key_name(key_name)
+    if not board:
+      board = Leaderboard(key_name=key_name)
+    board.set_entries(change(board.entries()))
+    board.put()
+    return board
+  try:
+    board = db.run_in_transaction(txn)
+  except db.TransactionFailedError:
+    logging.warning("Leaderboard %s is contended", key_name)
+    memcache.delete(_mem_key(key_name))
+    return False
+  memcache.set(_mem_key(key_name), board.entries())
+  return True
+
+
+def _place(current, entries):
+  """Returns a board's entries with monsters placed at new values.
+  
+  A full board's lowest value is its cutoff. Monsters below it don't join
+  the board, and ones already on it that fall below it are taken off; the
+  next rebuild finds whatever should replace them.
+  
+  Args:
+    current: the board's entries, best first.
+    entries: the new [(value, monster id)]."""
+  values = dict((monster_id, value) for value, monster_id in entries)
+  on_board = set(monster_id for value, monster_id in current)
+  cutoff = current[-1][0] if len(current) >= BOARD_SIZE else None
+  placed = [entry for entry in current if entry[1] not in values]
+  for monster_id, value in values.items():
+    if cutoff is None or value > cutoff or (
+        value == cutoff and monster_id in on_board):
+      placed.append((value, monster_id))
+  return placed
+
+
+def update(kind, product, monster_id, value):
+  """Queues placing a monster on a board with value, see _place.
+  
+  Queued updates are applied together by apply_pending, so saving a monster
+  never writes the shared board itself. Nothing is queued if the update
+  can't change the board."""
+  entries = get_entries(kind, [product])[product]
+  if sorted(_place(entries, [(value, monster_id)]), 
+            reverse=True)[:BOARD_SIZE] == entries:
+    return
+  taskqueue.Queue(QUEUE_NAME).add(taskqueue.Task(
+    payload=json.dumps({'kind': kind, 'product': product, 'id': monster_id,
+                        'value': value, 'time': time.time()}), 
+    method='PULL'))
+  schedule_apply()
+
+
+def schedule_apply(delay=0):
+  """Makes sure an application of the queued updates is pending, delay
+  seconds from now.
+  
+  Applications are named after the APPLY_INTERVAL window they cover and run
+  when the window closes, so a burst of saves and votes writes each board
+  once."""
+  now = time.time() + delay
+  window = int(now) // APPLY_INTERVAL
+  try:
+    taskqueue.add(
+      url=APPLY_URL, 
+      name="leaderboards-apply-%d" % window,
+      countdown=(window + 1) * APPLY_INTERVAL + 1 - now + delay)
+  except (taskqueue.TaskAlreadyExistsError, taskqueue.TombstonedTaskError):
+    pass
+
+
+def apply_batch():
+  """Leases up to APPLY_BATCH_SIZE queued updates and applies them.
+  
+  Each board is written once, with the latest value queued for each of its
+  monsters. The updates of a board whose write fails go back on the queue
+  when their lease expires, and are applied again then.
+  
+  Returns:
+    The number of updates leased; 0 when the queue is empty."""
+  queue = taskqueue.Queue(QUEUE_NAME)
+  tasks = queue.lease_tasks(lease_seconds=APPLY_BUDGET, 
+                            max_tasks=APPLY_BATCH_SIZE)
+  if not tasks:
+    return 0
+  boards = {}
+  for task in tasks:
+    pending = json.loads(task.payload)
+    board = boards.setdefault((pending['kind'], pending['product']), 
+                              ({}, []))
+    latest = board[0].get(pending['id'])
+    if not latest or latest['time'] <= pending['time']:
+      board[0][pending['id']] = pending
+    board[1].append(task)
+  done = []
+  for (kind, product), (updates, board_tasks) in boards.items():
+    entries = [(item['value'], monster_id) 
+               for monster_id, item in updates.items()]
+    if _modify(kind, product, 
+               lambda current, entries=entries: _place(current, entries)):
+      done.extend(board_tasks)
+  if done:
+    queue.delete_tasks(done)
+  if len(done) < len(tasks):
+    schedule_apply(APPLY_BUDGET)
+  return len(tasks)
+
+
+def apply_pending(budget=APPLY_BUDGET):
+  """Applies batches of queued updates until none are left or budget
+  seconds pass.
+  
+  Returns:
+    True if the queue was emptied."""
+  deadline = time.time() + budget
+  while time.time() < deadline:
+    if not apply_batch():
+      return True
+  return False
+  
+  
+def update_multi(kind, product, entries):
+  """Places several monsters on a board at once, as [(value, monster id)].
+  
+  The board is written at most once, however many of them belong there."""
+  current = get_entries(kind, [product])[product]
+  if sorted(_place(current, entries), reverse=True)[:BOARD_SIZE] == current:
+    return
+  _modify(kind, product, lambda current: _place(current, entries))
+  
+  
+def remove(product, monster_id):
+  """Takes a monster off all of a product's boards."""
+  for kind in KINDS:
+    entries = get_entries(kind, [product])[product]
+    if monster_id in [entry[1] for entry in entries]:
+      _modify(kind, product, lambda entries: 
+              [entry for entry in entries if entry[1] != monster_id])
+      
+      
+def replace(kind, product, entries):
+  """Overwrites a board with entries, as [(value, monster id)]."""
+  key_name = Leaderboard.key_name_for(kind, product)
+  board = Leaderboard(key_name=key_name)
+  board.set_entries(entries)
+  board.put()
+  memcache.set(_mem_key(key_name), board.entries())
@@ -0,0 +1,398 @@
+"""An in-process search engine for monster documents.
+
+LocalIndex accepts the same search.Documents as the monster index and
+answers the search box's queries (see data.searchquery) from memory: text
+terms are ranked with BM25 and atom, number and date terms filter. Postings
+are kept as sorted integer arrays of document ordinals.
+
+It stands in for the search API in tests and local benchmarks, and serves
+searches from a snapshot when the search API fails or is too slow, see
+data.indexing.load_snapshot. This module only needs the search API's
+document classes, never the service."""
+from array import array
+from bisect import bisect_left
+import cPickle
+import datetime
+import heapq
+import math
+import re
+import zlib
+
+# BM25 parameters: term frequency saturation and document length
+# normalisation.
+BM25_K1 = 1.2
+BM25_B = 0.75
+
+_TOKEN = re.compile(r'\w+', re.UNICODE)
+_DATE = re.compile(r'^\d{4}-\d{2}-\d{2}$')
+
+_SNAPSHOT_VERSION = 1
+
+
+def tokenize(text):
+  """Splits text into lower case word tokens."""
+  return _TOKEN.findall((text or u"").lower())
+
+
+def _date_number(value):
+  """Returns the number a date is filtered and sorted by."""
+  if isinstance(value, datetime.datetime):
+    value = value.date()
+  return value.toordinal()
+
+
+def _parse_date(value):
+  return datetime.datetime.strptime(value, "%Y-%m-%d").date()
+
+
+def _intersect(left, right):
+  """Returns the ordinals in both of two sorted arrays, as a sorted array."""
+  if len(left) > len(right):
+    left, right = right, left
+  if len(right) < 16 * len(left):
+    # Comparable sizes: hashing beats a binary search per element.
+    return array('i', sorted(set(left).intersection(right)))
+  result = array('i')
+  start = 0
+  for ordinal in left:
+    start = bisect_left(right, ordinal, start)
+    if start == len(right):
+      break
+    if right[start] == ordinal:
+      result.append(ordinal)
+  return result
+
+
+def _remove(postings, ordinal):
+  index = bisect_left(postings, ordinal)
+  if index < len(postings) and postings[index] == ordinal:
+    del postings[index]
+    return index
+  return None
+
+
+_COMPARISONS = {
+  '=': lambda value, bound: value == bound,
+  '>': lambda value, bound: value > bound,
+  '>=': lambda value, bound: value >= bound,
+  '<': lambda value, bound: value < bound,
+  '<=': lambda value, bound: value <= bound,
+}
+
+
+class LocalIndex(object):
+  """An in-memory inverted index of search documents.
+
+  Each document is given an ordinal when it's put. Re-putting a document
+  gives it a new ordinal, so ordinals are only ever appended and every
+  postings array stays sorted without re-sorting.
+
+  Args:
+    stored_fields: the names of the fields returned with results, or None
+      to return them all.
+    text_fields: the names of the text fields ranked by BM25, or None to
+      rank them all. Documents that repeat their text across fields, like
+      monsters' 'stats', should name just one, or every term would count
+      twice."""
+
+  def __init__(self, stored_fields=None, text_fields=None):
+    self.stored_fields = stored_fields
+    self.text_fields = text_fields
+    # doc_id of each ordinal, None once deleted.
+    self._doc_ids = []
+    self._ordinals = {}
+    self._lengths = array('i')
+    self._total_length = 0
+    # term -> (ordinals, term frequencies), parallel sorted arrays.
+    self._postings = {}
+    # (field, value) -> ordinals, for atom fields and facets.
+    self._atoms = {}
+    # field -> {ordinal: number}, for number and date fields.
+    self._numbers = {}
+    # The non-atom field values of each ordinal, for returning.
+    self._stored = []
+    # The term frequencies, atoms and number fields of each ordinal, so it
+    # can be deleted and snapshotted.
+    self._keys = []
+
+  def __len__(self):
+    return len(self._ordinals)
+
+  def put(self, documents):
+    """Adds or replaces search.Documents, like search.Index.put."""
+    from google.appengine.api import search
+    if not isinstance(documents, (list, tuple)):
+      documents = [documents]
+    for document in documents:
+      text = []
+      atoms = []
+      numbers = {}
+      stored = {}
+      for field in document.fields:
+        if isinstance(field, search.AtomField):
+          atoms.append((field.name, field.value))
+          continue
+        if isinstance(field, search.DateField):
+          numbers[field.name] = _date_number(field.value)
+        elif isinstance(field, search.NumberField):
+          numbers[field.name] = field.value
+        elif not self.text_fields or field.name in self.text_fields:
+          text.append(field.value)
+        if not self.stored_fields or field.name in self.stored_fields:
+          stored[field.name] = field.value
+      for facet in document.facets:
+        atoms.append(("facet:" + facet.name, facet.value))
+      self.add(document.doc_id, u" ".join(text), atoms, numbers, stored)
+
+  def add(self, doc_id, text, atoms=(), numbers=None, stored=None):
+    """Adds or replaces one document.
+
+    Args:
+      doc_id: the document's id.
+      text: the document's full text, ranked by BM25.
+      atoms: (field, value) pairs the document can be filtered by exactly.
+      numbers: a dict of field to number the document can be filtered and
+        sorted by.
+      stored: a dict of field to value returned with search results."""
+    self.delete([doc_id])
+    ordinal = len(self._doc_ids)
+    self._doc_ids.append(doc_id)
+    self._ordinals[doc_id] = ordinal
+
+    tokens = tokenize(text)
+    self._lengths.append(len(tokens))
+    self._total_length += len(tokens)
+    frequencies = {}
+    for token in tokens:
+      frequencies[token] = frequencies.get(token, 0) + 1
+    for term, frequency in frequencies.iteritems():
+      postings = self._postings.get(term)
+      if postings is None:
+        postings = self._postings[term] = (array('i'), array('i'))
+      postings[0].append(ordinal)
+      postings[1].append(frequency)
+
+    atoms = set(atoms)
+    for atom in atoms:
+      self._atoms.setdefault(atom, array('i')).append(ordinal)
+    for field, value in (numbers or {}).iteritems():
+      self._numbers.setdefault(field, {})[ordinal] = value
+    self._stored.append(stored or {})
+    self._keys.append((frequencies, list(atoms),
+                       list((numbers or {}).keys())))
+
+  def delete(self, doc_ids):
+    """Removes documents by id, like search.Index.delete."""
+    if isinstance(doc_ids, basestring):
+      doc_ids = [doc_ids]
+    for doc_id in doc_ids:
+      ordinal = self._ordinals.pop(doc_id, None)
+      if ordinal is None:
+        continue
+      terms, atoms, numbers = self._keys[ordinal]
+      for term in terms:
+        ordinals, frequencies = self._postings[term]
+        index = _remove(ordinals, ordinal)
+        del frequencies[index]
+        if not ordinals:
+          del self._postings[term]
+      for atom in atoms:
+        _remove(self._atoms[atom], ordinal)
+        if not self._atoms[atom]:
+          del self._atoms[atom]
+      for field in numbers:
+        del self._numbers[field][ordinal]
+      self._total_length -= self._lengths[ordinal]
+      self._lengths[ordinal] = 0
+      self._doc_ids[ordinal] = None
+      self._stored[ordinal] = None
+      self._keys[ordinal] = ({}, (), ())
+
+  def _all(self):
+    return array('i', sorted(self._ordinals.itervalues()))
+
+  def _matches(self, parsed, restriction):
+    """Returns the sorted ordinals matching a ParsedQuery and restriction."""
+    candidates = None
+    for term in tokenize(u" ".join(parsed.text)):
+      if term not in self._postings:
+        return array('i')
+      ordinals = self._postings[term][0]
+      candidates = (ordinals if candidates is None
+                    else _intersect(candidates, ordinals))
+
+    if restriction:
+      field, values = restriction
+      postings = [self._atoms[(field, value)] for value in values 
+                  if (field, value) in self._atoms]
+      if len(postings) == 1:
+        allowed = postings[0]
+      else:
+        allowed = array('i', sorted(set().union(*postings)))
+      candidates = (allowed if candidates is None
+                    else _intersect(candidates, allowed))
+
+    comparisons = []
+    for field, op, value in parsed.filters:
+      if op == ':':
+        ordinals = self._atoms.get((field, value), array('i'))
+        candidates = (ordinals if candidates is None
+                      else _intersect(candidates, ordinals))
+      elif _DATE.match(value):
+        comparisons.append((field, op, _date_number(_parse_date(value))))
+      else:
+        comparisons.append((field, op, float(value)))
+
+    if candidates is None:
+      candidates = self._all()
+    for field, op, bound in comparisons:
+      values = self._numbers.get(field, {})
+      compare = _COMPARISONS[op]
+      candidates = array('i', [ordinal for ordinal in candidates
+                               if ordinal in values
+                               and compare(values[ordinal], bound)])
+    return candidates
+
+  def _scorer(self, terms):
+    """Returns a function giving the BM25 score of an ordinal for terms."""
+    documents = len(self._ordinals)
+    average_length = float(self._total_length) / max(documents, 1) or 1.0
+    weighted = []
+    for term in terms:
+      ordinals, frequencies = self._postings.get(term, ((), ()))
+      idf = math.log(1 + (documents - len(ordinals) + 0.5) /
+                         (len(ordinals) + 0.5))
+      weighted.append((ordinals, frequencies, idf))
+
+    def score(ordinal):
+      length_norm = BM25_K1 * (1 - BM25_B + BM25_B *
+                               self._lengths[ordinal] / average_length)
+      total = 0.0
+      for ordinals, frequencies, idf in weighted:
+        frequency = frequencies[bisect_left(ordinals, ordinal)]
+        total += idf * frequency * (BM25_K1 + 1) / (frequency + length_norm)
+      return total
+    return score
+
+  def search(self, parsed, limit=20, offset=0, restriction=None,
+             facets=None):
+    """Answers a search box query.
+
+    Args:
+      parsed: the data.searchquery.ParsedQuery to answer.
+      limit: the maximum number of results to return.
+      offset: the number of results to skip.
+      restriction: an optional (atom field, values) pair; only documents
+        with one of the values are matched.
+      facets: an optional dict of facet name to the values to count.
+
+    Returns:
+      A tuple of a list of (doc_id, stored fields) results, the number of
+      matches and a dict of facet name to [(value, count)] with the counts
+      of the facets' values, most frequent first. Results are ordered by
+      the query's sort, else by BM25 score, else newest put first."""
+    matches = self._matches(parsed, restriction)
+
+    if parsed.sort:
+      field, default, descending = parsed.sort
+      values = self._numbers.get(field, {})
+      if isinstance(default, datetime.date):
+        default = _date_number(default)
+      key = lambda ordinal: (values.get(ordinal, default), ordinal)
+    else:
+      score = self._scorer(set(tokenize(u" ".join(parsed.text))))
+      descending = True
+      key = lambda ordinal: (score(ordinal), ordinal)
+    select = heapq.nlargest if descending else heapq.nsmallest
+    ordered = select(offset + limit, matches, key=key)[offset:]
+
+    counts = {}
+    for name, values in (facets or {}).items():
+      counts[name] = []
+      for value in values:
+        ordinals = self._atoms.get(("facet:" + name, value))
+        count = len(_intersect(matches, ordinals)) if ordinals else 0
+        if count:
+          counts[name].append((value, count))
+      counts[name].sort(key=lambda count: -count[1])
+
+    return ([(self._doc_ids[ordinal], self._stored[ordinal])
+             for ordinal in ordered],
+            len(matches), counts)
+
+  def dumps(self):
+    """Returns a compressed snapshot of the index as a string."""
+    live = sorted(self._ordinals.itervalues())
+    state = {
+      'version': _SNAPSHOT_VERSION,
+      'stored_fields': self.stored_fields,
+      'text_fields': self.text_fields,
+      'doc_ids': [self._doc_ids[ordinal] for ordinal in live],
+      'lengths': array('i', [self._lengths[ordinal]
+                             for ordinal in live]).tostring(),
+      'stored': [self._stored[ordinal] for ordinal in live],
+      'keys': [self._keys[ordinal] for ordinal in live],
+      'numbers': [dict((field, self._numbers[field][ordinal])
+                       for field in self._keys[ordinal][2])
+                  for ordinal in live],
+    }
+    # Ordinals are renumbered densely, so the postings are rebuilt on load
+    # rather than stored.
+    return zlib.compress(cPickle.dumps(state, cPickle.HIGHEST_PROTOCOL))
+
+  @staticmethod
+  def loads(data):
+    """Returns the LocalIndex in a snapshot made by dumps."""
+    state = cPickle.loads(zlib.decompress(data))
+    if state['version'] != _SNAPSHOT_VERSION:
+      raise ValueError("Unknown snapshot version %s" % state['version'])
+    index = LocalIndex(state['stored_fields'], state.get('text_fields'))
+    lengths = array('i')
+    lengths.fromstring(state['lengths'])
+    index._lengths = lengths
+    index._total_length = sum(lengths)
+    index._doc_ids = state['doc_ids']
+    index._stored = state['stored']
+    index._keys = state['keys']
+    for ordinal, doc_id in enumerate(index._doc_ids):
+      index._ordinals[doc_id] = ordinal
+    for ordinal, (terms, atoms, numbers) in enumerate(index._keys):
+      for term, frequency in terms.iteritems():
+        postings = index._postings.get(term)
+        if postings is None:
+          postings = index._postings[term] = (array('i'), array('i'))
+        postings[0].append(ordinal)
+        postings[1].append(frequency)
+      for atom in atoms:
+        index._atoms.setdefault(atom, array('i')).append(ordinal)
+      for field, value in state['numbers'][ordinal].iteritems():
+        index._numbers.setdefault(field, {})[ordinal] = value
+    return index
+
+  @staticmethod
+  def concat(snapshots):
+    """Returns a snapshot holding the documents of several made by dumps.
+
+    The postings aren't built, so this takes little more memory than the
+    snapshots. They must share their settings and not share documents."""
+    states = [cPickle.loads(zlib.decompress(data)) for data in snapshots]
+    for state in states:
+      if state['version'] != _SNAPSHOT_VERSION:
+        raise ValueError("Unknown snapshot version %s" % state['version'])
+    combined = dict(states[0], doc_ids=[], lengths="", stored=[], keys=[],
+                    numbers=[])
+    for state in states:
+      for name in ('doc_ids', 'lengths', 'stored', 'keys', 'numbers'):
+        combined[name] += state[name]
+    return zlib.compress(cPickle.dumps(combined, cPickle.HIGHEST_PROTOCOL))
+
+  def save(self, path):
+    """Writes a snapshot of the index to a file."""
+    with open(path, 'wb') as snapshot:
+      snapshot.write(self.dumps())
+
+  @staticmethod
+  def load(path):
+    """Reads a LocalIndex from a snapshot file written by save."""
+    with open(path, 'rb') as snapshot:
+      return LocalIndex.loads(snapshot.read())
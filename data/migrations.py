@@ -0,0 +1,146 @@
+from google.appengine.ext import db
+from google.appengine.api import memcache
+from data.models import Monster, Product, Profile, Vote, _chunks
+import logging
+
+# Number of entities each migration step reads.
+BATCH_SIZE = 100
+
+
+def _copy_vote(vote, voter_key, monster_key):
+  """Returns an unsaved copy of vote keyed for voter_key and monster_key."""
+  return Vote(
+    key_name=Vote.key_name_for(voter_key, monster_key), 
+    voter=voter_key, 
+    monster=monster_key, 
+    creation_time=vote.creation_time, 
+    is_up=vote.is_up)
+
+
+def rekey_votes(cursor=None, batch_size=BATCH_SIZE):
+  """Moves one batch of legacy Votes to their deterministic key names.
+  
+  Votes created before votes were keyed by Vote.key_name_for have numeric
+  ids. Each one is copied to its key name and the original deleted. If a
+  voter managed to vote on the same monster more than once, the most recent
+  vote wins.
+  
+  Args:
+    cursor: the cursor returned by the previous step, or None to start.
+    batch_size: the number of Votes to read.
+    
+  Returns:
+    The cursor to pass to the next step, or None when the migration is done."""
+  query = Vote.all()
+  if cursor:
+    query.with_cursor(cursor)
+  votes = query.fetch(batch_size)
+  
+  replacements = {}
+  stale = []
+  for vote in votes:
+    if vote.key().name():
+      continue
+    stale.append(vote.key())
+    voter_key = Vote.voter.get_value_for_datastore(vote)
+    monster_key = Vote.monster.get_value_for_datastore(vote)
+    if not (voter_key and monster_key):
+      continue
+    key_name = Vote.key_name_for(voter_key, monster_key)
+    current = replacements.get(key_name)
+    if current and current.creation_time > vote.creation_time:
+      continue
+    replacements[key_name] = _copy_vote(vote, voter_key, monster_key)
+      
+  if replacements:
+    key_names = replacements.keys()
+    for key_name, existing in zip(key_names, 
+                                  Vote.get_by_key_name(key_names)):
+      if existing and existing.creation_time > replacements[key_name].creation_time:
+        del replacements[key_name]
+    db.put(replacements.values())
+  if stale:
+    db.delete(stale)
+    
+  if len(votes) < batch_size:
+    return None
+  return query.cursor()
+
+
+def _move_profile(profile, user_id):
+  """Copies profile to key name user_id and re-points everything at it.
+  
+  A profile already at user_id, made before lookups fell back to legacy
+  profiles, is merged into rather than overwritten: it keeps the products
+  and publisher status of both, and the legacy profile's display name."""
+  old_key = profile.key()
+  properties = dict((name, getattr(profile, name)) 
+                    for name in Profile.properties())
+  existing = Profile.get_by_key_name(user_id)
+  if existing:
+    logging.warning("Merging profile %s into %s", old_key.id(), user_id)
+    properties['products'] = profile.products + [
+      product for product in existing.products 
+      if product not in profile.products]
+    properties['is_publisher'] = profile.is_publisher or existing.is_publisher
+    properties['display_name'] = (profile.display_name or 
+                                  existing.display_name)
+  new_key = Profile(key_name=user_id, **properties).put()
+  
+  for monsters in _chunks(Monster.all().filter("creator = ", old_key).run(), 
+                          BATCH_SIZE):
+    for monster in monsters:
+      monster.creator = new_key
+    db.put(monsters)
+    memcache.delete_multi([monster.get_mem_key() for monster in monsters])
+    
+  for products in _chunks(Product.all().filter("creator = ", old_key).run(), 
+                          BATCH_SIZE):
+    for product in products:
+      product.creator = new_key
+    db.put(products)
+    memcache.delete_multi([Product.get_mem_key_for_id(product.key().id()) 
+                           for product in products])
+  
+  for votes in _chunks(Vote.all().filter("voter = ", old_key).run(), 
+                       BATCH_SIZE):
+    db.put([_copy_vote(vote, new_key, Vote.monster.get_value_for_datastore(vote))
+            for vote in votes])
+    db.delete(votes)
+    
+  db.delete(old_key)
+  memcache.delete(profile.get_mem_key())
+
+
+def rekey_profiles(cursor=None, batch_size=10):
+  """Moves one batch of legacy Profiles to key names from user_id().
+  
+  Each profile is copied to its new key, the monsters, products and votes
+  that refer to it are re-pointed (votes are re-keyed, since their key names
+  include the voter) and the original is deleted. Profiles whose account
+  has no user_id are left alone and logged.
+  
+  Args:
+    cursor: the cursor returned by the previous step, or None to start.
+    batch_size: the number of Profiles to read.
+    
+  Returns:
+    The cursor to pass to the next step, or None when the migration is done."""
+  query = Profile.all()
+  if cursor:
+    query.with_cursor(cursor)
+  profiles = query.fetch(batch_size)
+  
+  for profile in profiles:
+    if profile.key().name():
+      continue
+    user_id = profile.account and profile.account.user_id()
+    if not user_id:
+      logging.warning("Profile %s has no user_id, leaving it in place", 
+                      profile.key().id())
+      continue
+    _move_profile(profile, user_id)
+    
+  if len(profiles) < batch_size:
+    return None
+  return query.cursor()
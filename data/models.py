@@ -1,36 +1,80 @@
 from google.appengine.ext import db
 from google.appengine.api import search
+import calendar
+import hashlib
 import logging
+import re
+import time
 import uuid
+from collections import OrderedDict
 from math import sqrt
 import configuration.site
 from google.appengine.api import memcache
+from google.appengine.runtime import apiproxy_errors
+from data import counters
+from data import deletion
+from data import generations
+from data import identity
+from data import indexing
+from data import leaderboards
+from data import nameindex
+from data import searchcache
+from data import searchquery
+
+# Seconds Profile.for_user and get_by_id_safe remember that there's no
+# profile. Saving one forgets it sooner.
+_NO_PROFILE_TTL = 10 * 60
+
+# Integer ids are below this; longer strings of digits, like user_id()s,
+# are only key names.
+_MAX_ID = 2 ** 63
+
 
 class Profile(db.Model):
+  """A user's profile.
+  
+  Profiles are keyed by the account's user_id(), so the current user's
+  profile can be found without a query. See Profile.for_user."""
   account = db.UserProperty()
   display_name = db.StringProperty()
   products = db.ListProperty(long, default=[-1])
   is_publisher = db.BooleanProperty(default=False)
   
+  @staticmethod
+  def new_for_user(user):
+    """Returns a new, unsaved Profile for user."""
+    return Profile(key_name=user.user_id(), account=user)
+  
   @staticmethod
   def for_user(user):
-    key = Profile.all().filter("account = ", user).get(keys_only=True)
-    if not key:
-      return None
+    """Returns user's profile, or None if they haven't made one.
     
-    mem_key = Profile.get_mem_key_for_id(key.id())
-    data = memcache.get(mem_key)
-    if not data:
-      data = Profile.all().filter("account = ", user).get()
-      memcache.add(mem_key, data)
-    return data
+    Profiles that haven't been moved to their user_id() key name yet, see
+    data.migrations.rekey_profiles, are found by a query on account. Its
+    result is cached, including when there's no profile."""
+    if not user:
+      return None
+    profile = Profile.get_by_id_safe(user.user_id())
+    if profile:
+      return profile
+    mem_key = Profile.get_account_mem_key(user.user_id())
+    profile = memcache.get(mem_key)
+    if profile is None:
+      profile = Profile.all().filter("account = ", user).get()
+      memcache.add(mem_key, profile or False, _NO_PROFILE_TTL)
+    return identity.add(profile or None)
     
   def get_mem_key(self):
-    return Profile.get_mem_key_for_id(self.key().id())
+    return Profile.get_mem_key_for_id(self.key().id_or_name())
   
   def put(self):
-    db.Model.put(self)
-    memcache.delete(self.get_mem_key())
+    key = db.Model.put(self)
+    mem_keys = [self.get_mem_key()]
+    if self.account and self.account.user_id():
+      mem_keys.append(Profile.get_account_mem_key(self.account.user_id()))
+    memcache.delete_multi(mem_keys)
+    identity.add(self)
+    return key
     
   def get_products(self):
     result = []
@@ -45,43 +89,132 @@ class Profile(db.Model):
   def has_product(self, product):
     return product.key().id() in self.products
     
-  def get_favorites(self, limit, skip=0, user=None):
+  def get_vote_map(self, monsters):
+    """Returns this profile's votes on monsters, keyed by monster id."""
+    return Vote.get_map(self, monsters)
+    
+  def get_favorites(self, limit, user=None, cursor=None):
+    """Returns a page of the monsters this profile up-voted, newest first.
+    
+    Returns:
+      A tuple of the monsters visible to user and the cursor of the next
+      page, which is None on the last page."""
     query = db.Query(Vote)
     query.filter("voter = ",self)
     query.filter("is_up = ",True)
     query.order("-creation_time")
     
-    result = []
-    for vote in query.run():
-      monster = Monster.get_by_id_safe(vote.monster.key().id(), user)
-      if monster:
-        if skip:
-          skip -= 1
-        else:
-          result.append(monster)
-          if len(result) >= limit:
-            return result
-    return result
+    def resolve(votes):
+      return Monster.get_by_ids_safe(
+        [Vote.monster.get_value_for_datastore(vote).id() for vote in votes], 
+        user)
+    return _fetch_page(query, limit, resolve, cursor)
   
   @staticmethod
   def get_mem_key_for_id(sid):
     return "profile:%s" % sid
     
+  @staticmethod
+  def get_account_mem_key(user_id):
+    return "profile-account:%s" % user_id
+    
   @staticmethod
   def get_by_id_safe(sid, user=None):
+    """Returns the profile with key name sid, or None.
+    
+    Profiles that haven't been moved to key names yet are found by their
+    integer id, whether sid is an int or a string of digits, as in legacy
+    /profile/<id> URLs. Misses are cached too, for _NO_PROFILE_TTL."""
+    keys = []
+    if not isinstance(sid, (int, long)):
+      keys.append(db.Key.from_path('Profile', sid))
+    if unicode(sid).isdigit() and 0 < int(sid) < _MAX_ID:
+      keys.append(db.Key.from_path('Profile', int(sid)))
+    for key in keys:
+      result = identity.get(key)
+      if result:
+        return result
     mem_key = Profile.get_mem_key_for_id(sid)
     result = memcache.get(mem_key)
-    if not result:
-      result = Profile.get_by_id(id)
-      memcache.add(mem_key, result)
-    if not result:
-      return None
-
-    return None
+    if result is None:
+      result = next((profile for profile in db.get(keys) if profile), None)
+      if result:
+        memcache.add(mem_key, result)
+      else:
+        memcache.add(mem_key, False, _NO_PROFILE_TTL)
+    return identity.add(result or None)
 
 
 _MONSTER_INDEX = "monsters"
 
+# Number of keys resolved per batched memcache/datastore round trip when
+# hydrating listing queries.
+_HYDRATION_PAGE_SIZE = 20
+
+# The fields of a monster's search document needed to render its statblock.
+_RETURNED_FIELDS = ['name', 'tags', 'hp', 'armor', 'damage', 'damage_tags', 
+                    'special_qualities', 'instinct', 'description', 'moves', 
+                    'product', 'score', 'is_core', 'edited']
+
+# The text fields of a monster's search document ranked by a LocalIndex.
+# 'stats' already holds the text of all the others.
+_SEARCHED_FIELDS = ['stats']
+
+# Prefix of the cursors of searches answered from a LocalIndex.
+_LOCAL_CURSOR_PREFIX = "local-"
+
+def _fetch_page(query, limit, resolve, cursor=None):
+  """Fetches one page of a query, starting at cursor.
+  
+  resolve is called with each batch of query results and returns the items to
+  show for them, dropping any that shouldn't be shown. Batches are fetched
+  until limit items survive or the query runs out. Each batch asks for only
+  as many results as are still needed, so the cursor never skips over an
+  unshown result. A full page is followed by a count of what's left, so the
+  last page doesn't offer a cursor to an empty one.
+  
+  Returns:
+    A tuple of the items and the cursor of the next page, which is None once
+    the query is exhausted."""
+  result = []
+  while len(result) < limit:
+    if cursor:
+      query.with_cursor(cursor)
+    needed = limit - len(result)
+    batch = query.fetch(needed)
+    cursor = query.cursor()
+    result.extend(resolve(batch))
+    if len(batch) < needed:
+      return result, None
+  query.with_cursor(cursor)
+  if not query.count(1):
+    return result, None
+  return result, cursor
+  
+def _chunks(iterable, size):
+  """Yields lists of up to size consecutive items from iterable."""
+  chunk = []
+  for item in iterable:
+    chunk.append(item)
+    if len(chunk) >= size:
+      yield chunk
+      chunk = []
+  if chunk:
+    yield chunk
+    
+def visibility_digest(user):
+  """Returns a short stand-in for the set of products user can see."""
+  if not user:
+    return "public"
+  return hashlib.sha1(",".join(str(product) for product in 
+                               sorted(user.products))).hexdigest()
+    
+def cursor_digest(cursor):
+  """Returns a short, memcache-key-safe stand-in for a query cursor."""
+  if not cursor:
+    return "first"
+  return hashlib.sha1(cursor).hexdigest()
+
 class Monster(db.Model):
   """Model for a Dungeon World monster"""
   
@@ -98,7 +231,7 @@ class Monster(db.Model):
   moves = db.StringListProperty()
   
   # Monster Builder Properties
-  creator = db.ReferenceProperty(reference_class=Profile)
+  creator = identity.ReferenceProperty(reference_class=Profile)
   creation_time = db.DateTimeProperty(auto_now_add=True)
   creation_rules = db.StringProperty()
   edited = db.BooleanProperty(default=False)
@@ -117,19 +250,105 @@ class Monster(db.Model):
       " ".join(self.moves))).encode('utf-8')
       
   def create_document(self):
+    """Returns the search document for this monster.
+    
+    Besides the full text in 'stats', the document stores everything the
+    statblock shows, so search results can be rendered from the index alone
+    (see MonsterSearchResult). List properties are stored newline-separated."""
     return search.Document(
             doc_id=str(self.key().id()), 
-            fields=[search.TextField(name='stats', value=str(self))])
+            fields=[search.TextField(name='stats', value=str(self)),
+                    search.TextField(name='name', value=self.name or ""),
+                    search.TextField(name='tags', value="\n".join(self.tags)),
+                    search.TextField(name='hp', value=self.hp or ""),
+                    search.TextField(name='armor', value=self.armor or ""),
+                    search.TextField(name='damage', value=self.damage or ""),
+                    search.TextField(name='damage_tags', 
+                                     value="\n".join(self.damage_tags)),
+                    search.TextField(name='special_qualities', 
+                                     value="\n".join(self.special_qualities)),
+                    search.TextField(name='instinct', 
+                                     value=self.instinct or ""),
+                    search.TextField(name='description', 
+                                     value=self.description or ""),
+                    search.TextField(name='moves', value="\n".join(self.moves)),
+                    search.NumberField(name='product', value=self.product),
+                    search.NumberField(name='score', value=self.score or 0.0),
+                    search.NumberField(name='is_core', 
+                                       value=int(bool(self.is_core))),
+                    search.NumberField(name='edited', 
+                                       value=int(bool(self.edited)))] + 
+                   self.get_search_fields(),
+            facets=self.get_search_facets())
+            
+  def get_search_fields(self):
+    """Returns the document fields structured queries filter and sort on.
+    
+    See data.searchquery for the query syntax they support."""
+    fields = [search.AtomField(name='access', value=self.get_access_atom())]
+    fields.extend(search.AtomField(name='tag', 
+                                   value=searchquery.normalize_atom(tag)) 
+                  for tag in self.tags)
+    fields.extend(search.AtomField(name='damage_tag', 
+                                   value=searchquery.normalize_atom(tag)) 
+                  for tag in self.damage_tags)
+    for name, value in [('hp_value', self.hp), ('armor_value', self.armor)]:
+      number = _leading_int(value)
+      if number is not None:
+        fields.append(search.NumberField(name=name, value=number))
+    if self.creation_time:
+      fields.append(search.DateField(name='created', 
+                                     value=self.creation_time.date()))
+    return fields
+    
+  def get_search_facets(self):
+    """Returns the document facets searches count matches by.
+    
+    See data.searchquery.FACETS."""
+    vocabulary = searchquery.facet_vocabulary()
+    tags = [searchquery.normalize_atom(tag) for tag in self.tags]
+    damage_tags = [searchquery.normalize_atom(tag) for tag in self.damage_tags]
+    facets = [search.AtomFacet(name='tag', value=tag) for tag in tags]
+    facets.extend(search.AtomFacet(name='damage_tag', value=tag) 
+                  for tag in damage_tags)
+    for name in ['organization', 'size']:
+      facets.extend(search.AtomFacet(name=name, value=tag) 
+                    for tag in tags if tag in vocabulary[name])
+    return facets
+    
+  def get_access_atom(self):
+    """Returns the value of the document's access field, see
+    get_search_restriction."""
+    if self.product == -1:
+      return "public"
+    return "product-%d" % self.product
+    
+  @staticmethod
+  def get_search_access_atoms(user):
+    """Returns the access field values of the documents user may see."""
+    atoms = ["public"]
+    if user:
+      atoms.extend("product-%d" % product for product in user.products 
+                   if product != -1)
+    return atoms
+    
+  @staticmethod
+  def get_search_restriction(user):
+    """Returns a query string matching the documents user may see."""
+    return "access:(%s)" % " OR ".join(
+      '"%s"' % atom for atom in Monster.get_search_access_atoms(user))
             
   def make_searchable(self):
     try:
-        search.Index(name=_MONSTER_INDEX).put(self.create_document())
+        indexing.get_index().put(self.create_document())
+        searchcache.invalidate()
     except search.Error:
         logging.exception('Put failed')
         
   def make_unsearchable(self):
     try:
-        search.Index(name=_MONSTER_INDEX).delete(self.key().id())
+        indexing.get_index().delete(str(self.key().id()))
+        searchcache.invalidate()
     except search.Error:
         logging.exception('Delete failed')
   
@@ -150,34 +369,157 @@ class Monster(db.Model):
       self.score = ((phat + z*z/(2*n) - z * sqrt((phat*(1-phat)+z*z/(4*n))/n))/(1+z*z/n))
       
         
+  @staticmethod
+  def fold_votes(monster_id):
+    """Moves monster_id's pending vote counts into ups, downs and score.
+    
+    The shards are drained and the monster updated in one cross-group
+    transaction, so counts are never lost or applied twice. The monster is
+    written with db.Model.put; its search document, which stores the score,
+    is rebuilt through the index queue once the transaction commits.
+    
+    Returns:
+      The updated Monster, or None if it no longer exists."""
+    def txn():
+      monster = Monster.get_by_id(monster_id)
+      if not monster:
+        return None
+      ups, downs = counters.drain(monster_id)
+      if not (ups or downs):
+        return monster
+      monster.ups = max((monster.ups or 0) + ups, 0)
+      monster.downs = max((monster.downs or 0) + downs, 0)
+      monster.compute_score()
+      db.Model.put(monster)
+      return monster
+    monster = db.run_in_transaction_options(
+      db.create_transaction_options(xg=True), txn)
+    if monster:
+      memcache.delete(monster.get_mem_key())
+      generations.bump("top")
+      leaderboards.update(leaderboards.TOP, monster.product, monster_id, 
+                          monster.score)
+      indexing.enqueue([monster_id])
+    return monster
+    
   def put_unsearchable(self):
     db.Model.put(self)
     
   def put(self):
     db.Model.put(self)
     memcache.delete(self.get_mem_key())
-    self.make_searchable()
+    generations.bump_multi(self.get_listing_namespaces())
+    identity.add(self)
+    for kind, value in self.get_leaderboard_values().items():
+      leaderboards.update(kind, self.product, self.key().id(), value)
+    indexing.enqueue([self.key().id()])
+    
+  @staticmethod
+  def put_multi(monsters):
+    """Saves monsters with one datastore write, for bulk imports.
+    
+    Does what put does for each monster, but bumps each listing generation,
+    writes each leaderboard and enqueues the index updates once per batch."""
+    if not monsters:
+      return
+    db.put(monsters)
+    memcache.delete_multi([monster.get_mem_key() for monster in monsters])
+    identity.add_multi(monsters)
+    namespaces = set()
+    boards = {}
+    for monster in monsters:
+      namespaces.update(monster.get_listing_namespaces())
+      for kind, value in monster.get_leaderboard_values().items():
+        boards.setdefault((kind, monster.product), []).append(
+          (value, monster.key().id()))
+    generations.bump_multi(namespaces)
+    for (kind, product), entries in boards.items():
+      leaderboards.update_multi(kind, product, entries)
+    indexing.enqueue([monster.key().id() for monster in monsters])
     
   def delete(self):
-    for favorite in Vote.all().filter("monster = ",self).run():
-      favorite.delete()
-    try:
-        search.Index(name=_MONSTER_INDEX).delete(str(self.key().id()))
-    except AssertionError as e:
-      if e.message == 'No api proxy found for service "search"':
-        pass
-      else:
-        raise e
-      
-    db.Model.delete(self)
+    """Deletes this monster and its votes, see data.deletion.
+    
+    Returns:
+      The DeletionJob finishing the deletion in the background, or None if
+      it's done."""
+    return deletion.delete_monsters([self.key().id()])
+    
+  def get_leaderboard_values(self):
+    """Returns the value this monster is ranked by on each kind of board."""
+    return {
+      leaderboards.TOP: self.score or 0.0,
+      leaderboards.RECENT: calendar.timegm(self.creation_time.utctimetuple()) + 
+        self.creation_time.microsecond / 1e6,
+    }
+    
+  @staticmethod
+  def get_leaderboard(kind, limit, user=None):
+    """Returns the best limit monsters visible to user on boards of kind.
+    
+    Reads the public board and the board of each of user's products, merges
+    them and hydrates the winners, so the cost doesn't depend on how many
+    monsters there are."""
+    products = set([-1])
+    if user:
+      products.update(user.products)
+    ids = leaderboards.merged(kind, products, limit)
+    return Monster.get_by_ids_safe(ids, user)
+    
+  @staticmethod
+  def rebuild_leaderboards(product):
+    """Recomputes every board of product from the datastore."""
+    for kind, order in ((leaderboards.TOP, "-score"), 
+                        (leaderboards.RECENT, "-creation_time")):
+      query = Monster.all().filter("product = ", product).order(order)
+      leaderboards.replace(kind, product, 
+        [(monster.get_leaderboard_values()[kind], monster.key().id()) 
+         for monster in query.fetch(leaderboards.BOARD_SIZE)])
+    
+  def get_listing_namespaces(self):
+    """Returns the generation namespaces of the listings this monster is in."""
+    namespaces = ["recent", "top"]
+    creator_key = Monster.creator.get_value_for_datastore(self)
+    if creator_key:
+      namespaces.append("creator:%s" % creator_key.id_or_name())
+    return namespaces
     
   def get_product(self):
-    mem_key = "product:%s" % self.product
-    data = memcache.get(mem_key)
-    if not data:
-      data = Product.get_by_id(self.product)
-      memcache.add(mem_key, data)
-    return data
+    if self.product == -1:
+      return None
+    if hasattr(self, '_prefetched_product'):
+      return self._prefetched_product
+    return Product.get_by_ids_safe([self.product]).get(self.product)
+    
+  @staticmethod
+  def prefetch_references(monsters):
+    """Resolves the creators and products of a list of monsters in batches.
+    
+    Distinct creators are fetched with one datastore get and distinct
+    products with Product.get_by_ids_safe, and the results are attached to
+    the monsters, so monster.creator and monster.get_product() do no I/O
+    afterwards. None entries are ignored."""
+    monsters = [monster for monster in monsters if monster]
+    
+    creator_keys = set(Monster.creator.get_value_for_datastore(monster) 
+                       for monster in monsters)
+    creator_keys.discard(None)
+    creators = identity.get_multi(creator_keys)
+    missing = [key for key in creator_keys if key not in creators]
+    if missing:
+      for creator in db.get(missing):
+        if creator:
+          creators[creator.key()] = identity.add(creator)
+          
+    products = Product.get_by_ids_safe(
+      set(monster.product for monster in monsters if monster.product != -1))
+    
+    for monster in monsters:
+      creator = creators.get(Monster.creator.get_value_for_datastore(monster))
+      if creator:
+        Monster.creator.prime(monster, creator)
+      if monster.product != -1:
+        monster._prefetched_product = products.get(monster.product)
             
   def get_tags(self):
     return ", ".join(self.tags)
@@ -202,96 +544,476 @@ class Monster(db.Model):
     return "/monster/"+str(self.key().id())
     
   def vote(self, profile):
-    return Vote.all().filter("voter = ", profile).filter("monster = ",self).get()
+    return Vote.get_for(profile, self)
      
   def get_mem_key(self):
-     return "monster:%s" % self.key().id()
+     return Monster.get_mem_key_for_id(self.key().id())
    
   @staticmethod 
-  def get_recent(limit, creator=None, user=None, skip=0):
-    query = db.Query(Monster)
+  def get_recent(limit, creator=None, user=None):
+    return Monster.get_recent_page(limit, creator=creator, user=user)[0]
+    
+  @staticmethod 
+  def get_recent_page(limit, creator=None, user=None, cursor=None):
+    """Returns a page of the newest monsters visible to user.
+    
+    The ids on the page are cached under the listing's generation, so the
+    page is only recomputed after a monster in the listing changes.
+    
+    Returns:
+      A tuple of the monsters and the cursor of the next page, which is None
+      on the last page."""
+    if creator:
+      namespace = "creator:%s" % creator.key().id_or_name()
+    else:
+      namespace = "recent"
+    mem_key = "recent:%s:%s:%d:%s:%s" % (
+      namespace, generations.get(namespace), limit, 
+      visibility_digest(user), cursor_digest(cursor))
+      
+    data = memcache.get(mem_key)
+    if data:
+      ids, next_cursor = data
+      return Monster.get_by_ids_safe(ids, user), next_cursor
+    
+    query = db.Query(Monster, keys_only=True)
     if creator:
       query.filter("creator = ",creator)
     query.order("-creation_time")
     
-    result = []
-    for monster_key in query.run(keys_only=True):
-      monster = Monster.get_by_id_safe(monster_key.id(), user)
-      if monster:
-        if skip:
-          skip -= 1
-        else:
-          result.append(monster)
-          if len(result) >= limit:
-            return result
-    return result
+    def resolve(keys):
+      return Monster.get_by_ids_safe([key.id() for key in keys], user)
+    monsters, next_cursor = _fetch_page(query, limit, resolve, cursor)
+    memcache.add(mem_key, 
+                 ([monster.key().id() for monster in monsters], next_cursor), 
+                 generations.LISTING_TTL)
+    return monsters, next_cursor
       
     
   @staticmethod 
-  def get_recent_public(skip=0):
-    mem_key = "recent:%s" % skip
+  def get_recent_public(cursor=None):
+    """Returns a page of the newest public monsters.
+    
+    Pages are cached by the cursor they start at, under the generation of the
+    recent listing.
+    
+    Returns:
+      A tuple of the monsters and the cursor of the next page, which is None
+      on the last page."""
+    mem_key = "recent-public:%s:%s" % (generations.get("recent"), 
+                                       cursor_digest(cursor))
     
     data = memcache.get(mem_key)
     if not data:
       query = db.Query(Monster)
       query.filter("product = ",-1)
       query.order("-creation_time")
-      data = query.fetch(10, offset=skip)
-      memcache.add(mem_key, data, 600)
+      data = _fetch_page(query, 10, lambda monsters: monsters, cursor)
+      memcache.add(mem_key, data, generations.LISTING_TTL)
     return data
   
   @staticmethod 
   def get_top_rated(limit, creator=None, user=None):
-    query = db.Query(Monster)
+    mem_key = "top:%s:%s:%d:%s" % (
+      generations.get("top"), creator and creator.key().id_or_name(), limit, 
+      visibility_digest(user))
+    ids = memcache.get(mem_key)
+    if ids is not None:
+      return Monster.get_by_ids_safe(ids, user)
+      
+    query = db.Query(Monster, keys_only=True)
     if creator:
       query.filter("creator = ",creator)
     
     query.order("-score")
+    monsters = Monster.hydrate_query(query, limit, user=user)
+    memcache.add(mem_key, [monster.key().id() for monster in monsters], 
+                 generations.LISTING_TTL)
+    return monsters
+    
+  @staticmethod
+  def hydrate_query(query, limit, user=None):
+    """Resolves a keys-only query into visible monsters, a page at a time.
+    
+    Keys are pulled in pages of _HYDRATION_PAGE_SIZE and each page is resolved
+    with get_by_ids_safe, so the number of RPCs depends on the number of pages
+    read rather than the number of monsters.
+    
+    Args:
+      query: a keys-only query over Monster.
+      limit: the maximum number of monsters to return.
+      user: the Profile to check product visibility against."""
     result = []
-    for monster_key in query.run(keys_only=True):
-      monster = Monster.get_by_id_safe(monster_key.id(), user)
-      if monster:
+    for page in _chunks(query.run(batch_size=_HYDRATION_PAGE_SIZE), 
+                        _HYDRATION_PAGE_SIZE):
+      ids = [monster_key.id() for monster_key in page]
+      for monster in Monster.get_by_ids_safe(ids, user):
         result.append(monster)
         if len(result) >= limit:
           return result
     return result
     
   @staticmethod
-  def search(query, user=None):
-    raw_results = search.Index(name=_MONSTER_INDEX).search(query)
-    return [Monster.get_by_id_safe(int(result.doc_id), user) for result in raw_results]
+  def search(query, user=None, limit=20, cursor=None):
+    """Returns a page of the monsters matching query that are visible to user.
+    
+    The query is compiled by data.searchquery, so filtering, ordering and
+    paging happen in the index. The results are MonsterSearchResults built
+    from the fields stored in the index, so no monsters are loaded from the
+    datastore. Their products are resolved in one batch.
+    
+    Pages are cached by data.searchcache until the index next changes, so
+    popular queries are answered without calling the search API.
+    
+    If the search API fails or takes longer than indexing.SEARCH_DEADLINE,
+    the search is answered from the latest snapshot of the index instead, see
+    indexing.load_snapshot. Where indexing.use_local_index is in effect, it's
+    always answered from that LocalIndex.
+    
+    Returns:
+      A tuple of the monsters, the cursor of the next page, which is None
+      on the last page, and the facet counts of all the matches: an
+      OrderedDict mapping each facet in data.searchquery.FACETS to a list of
+      (value, count) tuples, most frequent first."""
+    local_index = indexing.get_local_index()
+    if not local_index and cursor and cursor.startswith(_LOCAL_CURSOR_PREFIX):
+      # Paging through results that came from the snapshot.
+      local_index = indexing.load_snapshot()
+      if not local_index:
+        cursor = None
+    if local_index:
+      hits, next_cursor, facets = Monster._search_local(
+        local_index, query, user, limit, cursor)
+    else:
+      start = time.time()
+      cache_key = searchcache.key_for(
+        query, Monster.get_search_access_atoms(user), limit, cursor)
+      cached = searchcache.get(cache_key)
+      try:
+        if cached:
+          hits, next_cursor, facets = cached
+        else:
+          hits, next_cursor, facets = Monster._search_api(
+            query, user, limit, cursor)
+          searchcache.put(cache_key, (hits, next_cursor, facets))
+        searchcache.record(bool(cached), time.time() - start)
+      except (search.Error, apiproxy_errors.DeadlineExceededError):
+        local_index = indexing.load_snapshot()
+        if not local_index:
+          raise
+        logging.warning('Search failed, answering from the snapshot', 
+                        exc_info=True)
+        hits, next_cursor, facets = Monster._search_local(
+          local_index, query, user, limit, None)
+      
+    results = [MonsterSearchResult(doc_id, fields) for doc_id, fields in hits]
+    results = [result for result in results if result.is_visible_to(user)]
+    products = Product.get_by_ids_safe(
+      set(result.product for result in results if result.product != -1))
+    for result in results:
+      if result.product != -1:
+        result._prefetched_product = products.get(result.product)
+    return results, next_cursor, facets
+    
+  @staticmethod
+  def suggest(text, user=None, limit=10):
+    """Returns the names of monsters visible to user that complete text.
+    
+    Answered from this instance's data.nameindex.NameIndex, so prefixes and
+    near misses ("goblinn") both match without a datastore or search call.
+    
+    Returns:
+      A list of (monster id, name) tuples, best first."""
+    return nameindex.get().suggest(
+      text, Monster.get_search_access_atoms(user), limit)
+    
+  @staticmethod
+  def _search_api(query, user, limit, cursor):
+    """Answers Monster.search with the search API.
+    
+    Returns:
+      A tuple of the (doc_id, {field name: value}) hits, the next cursor
+      and the facet counts."""
+    raw_results = search.Index(name=_MONSTER_INDEX).search(
+      searchquery.compile_query(
+        query, limit, cursor, _RETURNED_FIELDS, 
+        Monster.get_search_restriction(user), facets=True), 
+      deadline=indexing.SEARCH_DEADLINE)
+    next_cursor = None
+    if raw_results.cursor:
+      next_cursor = raw_results.cursor.web_safe_string
+    hits = [(document.doc_id, 
+             dict((field.name, field.value) for field in document.fields)) 
+            for document in raw_results]
+            
+    facets = OrderedDict((name, []) for name in searchquery.FACETS)
+    for facet in raw_results.facets:
+      if facet.name in facets:
+        facets[facet.name] = sorted(
+          [(value.label, value.count) for value in facet.values], 
+          key=lambda value: -value[1])
+    return hits, next_cursor, facets
+    
+  @staticmethod
+  def _search_local(local_index, query, user, limit, cursor):
+    """Answers Monster.search with a data.localsearch.LocalIndex.
+    
+    Its cursors are offsets, prefixed with _LOCAL_CURSOR_PREFIX.
+    
+    Returns:
+      The same as Monster._search_api."""
+    offset = 0
+    if cursor and cursor.startswith(_LOCAL_CURSOR_PREFIX):
+      offset = int(cursor[len(_LOCAL_CURSOR_PREFIX):])
+    hits, total, counts = local_index.search(
+      searchquery.parse(query), limit, offset, 
+      ('access', Monster.get_search_access_atoms(user)), 
+      searchquery.facet_vocabulary())
+    next_cursor = None
+    if offset + limit < total:
+      next_cursor = "%s%d" % (_LOCAL_CURSOR_PREFIX, offset + limit)
+    facets = OrderedDict((name, counts.get(name, [])) 
+                         for name in searchquery.FACETS)
+    return hits, next_cursor, facets
+    
+  @staticmethod
+  def get_mem_key_for_id(sid):
+    return "monster:%s" % sid
+    
+  def is_visible_to(self, user):
+    """Returns True if the monster is public or in one of user's products."""
+    if user and (self.product in user.products):
+      return True
+    return self.product == -1
     
   @staticmethod
   def get_by_id_safe(id, user=None):
-    mem_key = "monster:%s" % id
-    result = memcache.get(mem_key)
-    if not result:
-      result = Monster.get_by_id(id)
+    result = identity.get(db.Key.from_path('Monster', id))
     if not result:
-      return None
-    else:
-      memcache.add(mem_key, result)
-    if user and (result.product in user.products):
-      return result
-    elif result.product == -1:
+      mem_key = Monster.get_mem_key_for_id(id)
+      result = memcache.get(mem_key)
+      if not result:
+        result = Monster.get_by_id(id)
+      if not result:
+        return None
+      else:
+        memcache.add(mem_key, result)
+        identity.add(result)
+    if result.is_visible_to(user):
       return result
     
     return None
     
+  @staticmethod
+  def get_by_ids_safe(ids, user=None):
+    """Batched get_by_id_safe.
+    
+    Resolves all of ids with one memcache.get_multi, fetches the misses with a
+    single datastore get and back-fills memcache with one set_multi. Monsters
+    that don't exist or aren't visible to user are dropped; the rest are
+    returned in the order of ids."""
+    if not ids:
+      return []
+    keys = [db.Key.from_path('Monster', sid) for sid in ids]
+    found = identity.get_multi(keys)
+    
+    remaining = [sid for sid, key in zip(ids, keys) if key not in found]
+    if remaining:
+      mem_keys = [Monster.get_mem_key_for_id(sid) for sid in remaining]
+      cached = memcache.get_multi(mem_keys)
+      
+      missing = [sid for sid, mem_key in zip(remaining, mem_keys) 
+                 if mem_key not in cached]
+      if missing:
+        fetched = {}
+        for sid, monster in zip(missing, Monster.get_by_id(missing)):
+          if monster:
+            fetched[Monster.get_mem_key_for_id(sid)] = monster
+        if fetched:
+          memcache.set_multi(fetched)
+          cached.update(fetched)
+          
+      for monster in cached.values():
+        found[monster.key()] = identity.add(monster)
+    
+    return [found[key] for key in keys 
+            if key in found and found[key].is_visible_to(user)]
+    
+
+
+class MonsterSearchResult(object):
+  """A monster as stored in the search index.
+  
+  Has the attributes and methods of Monster that the statblock macro uses,
+  read from the document's returned fields. See Monster.create_document.
+  
+  Args:
+    doc_id: the id of the monster's document.
+    fields: a dict of the document's returned fields' values by name."""
+  
+  def __init__(self, doc_id, fields):
+    self._key = db.Key.from_path('Monster', int(doc_id))
+    self.name = fields.get('name')
+    self.tags = _split_field(fields.get('tags'))
+    self.hp = fields.get('hp')
+    self.armor = fields.get('armor')
+    self.damage = fields.get('damage')
+    self.damage_tags = _split_field(fields.get('damage_tags'))
+    self.special_qualities = _split_field(fields.get('special_qualities'))
+    self.instinct = fields.get('instinct')
+    self.description = fields.get('description')
+    self.moves = _split_field(fields.get('moves'))
+    self.product = int(fields.get('product', -1))
+    self.score = fields.get('score', 0.0)
+    self.is_core = bool(fields.get('is_core'))
+    self.edited = bool(fields.get('edited'))
+    
+  def key(self):
+    return self._key
+    
+  def get_tags(self):
+    return ", ".join(self.tags)
+    
+  def get_damage_tags(self):
+    return ", ".join(self.damage_tags)
+    
+  def get_special_qualities(self):
+    return ", ".join(self.special_qualities)
+    
+  def get_product(self):
+    if self.product == -1:
+      return None
+    if hasattr(self, '_prefetched_product'):
+      return self._prefetched_product
+    return Product.get_by_ids_safe([self.product]).get(self.product)
+    
+  def url(self):
+    return "/monster/"+str(self._key.id())
+    
+  def vote(self, profile):
+    return Vote.get_for(profile, self)
+    
+  def is_visible_to(self, user):
+    """Returns True if the monster is public or in one of user's products."""
+    if user and (self.product in user.products):
+      return True
+    return self.product == -1
+    
+    
+def _leading_int(value):
+  """Returns the number a stat like "12 HP" starts with, or None."""
+  match = re.match(r'\s*(-?\d+)', value or "")
+  if match:
+    return int(match.group(1))
+  return None
+  
+  
+def _split_field(value):
+  """Splits a newline-separated list field of a search document."""
+  if not value:
+    return []
+  return value.split("\n")
 
 
 class Vote(db.Model):
-  voter = db.ReferenceProperty(reference_class=Profile)
-  monster = db.ReferenceProperty(reference_class=Monster)
+  """A profile's up or down vote on a monster.
+  
+  Votes are stored under a key name built from the voter and monster, so
+  there is at most one vote per voter per monster and finding it is a get
+  rather than a query. See Vote.key_name_for."""
+  voter = identity.ReferenceProperty(reference_class=Profile)
+  monster = identity.ReferenceProperty(reference_class=Monster)
   creation_time = db.DateTimeProperty(auto_now_add=True)
   is_up = db.BooleanProperty(default=True)
   
   def is_down(self):
     return not self.is_up
+    
+  @staticmethod
+  def key_name_for(voter_key, monster_key):
+    """Returns the key name of the vote voter_key cast on monster_key."""
+    return "%s:%s" % (voter_key.id_or_name(), monster_key.id_or_name())
+    
+  @staticmethod
+  def get_for(voter, monster):
+    """Returns voter's vote on monster, or None if they haven't voted."""
+    return Vote.get_map(voter, [monster]).get(monster.key().id())
+    
+  @staticmethod
+  def get_map(voter, monsters):
+    """Resolves voter's votes on a list of monsters in one batch.
+    
+    Args:
+      voter: the Profile whose votes should be found.
+      monsters: the monsters to find votes for. None entries are ignored.
+      
+    Returns:
+      A dict mapping monster id to Vote. Monsters voter hasn't voted on are
+      absent."""
+    monsters = [monster for monster in monsters if monster]
+    if not monsters:
+      return {}
+    keys = [db.Key.from_path(
+              'Vote', Vote.key_name_for(voter.key(), monster.key()))
+            for monster in monsters]
+    found = identity.get_multi(keys)
+    missing = [key for key in keys if key not in found]
+    if missing:
+      for vote in db.get(missing):
+        if vote:
+          found[vote.key()] = identity.add(vote)
+    
+    result = {}
+    for monster, key in zip(monsters, keys):
+      if key in found:
+        result[monster.key().id()] = found[key]
+    return result
+    
+  @staticmethod
+  def cast(voter, monster, is_up):
+    """Records voter's vote on monster.
+    
+    The vote and the matching change to the monster's vote counter shards are
+    written in one cross-group transaction; the monster itself is updated
+    when the shards are next folded into it (see Monster.fold_votes). Because
+    the vote's key is derived from voter and monster, concurrent casts can't
+    create a second vote.
+    
+    Returns:
+      The is_up of the vote this one replaced, or None if voter hadn't voted
+      on monster before. If the previous vote already had the same direction,
+      nothing is written."""
+    key_name = Vote.key_name_for(voter.key(), monster.key())
+    monster_id = monster.key().id()
+    def txn():
+      vote = Vote.get_by_key_name(key_name)
+      if not vote:
+        Vote(key_name=key_name, voter=voter, monster=monster, 
+             is_up=is_up).put()
+        if is_up:
+          counters.increment(monster_id, ups=1)
+        else:
+          counters.increment(monster_id, downs=1)
+        return None
+      previous = vote.is_up
+      if previous != is_up:
+        vote.is_up = is_up
+        vote.put()
+        if is_up:
+          counters.increment(monster_id, ups=1, downs=-1)
+        else:
+          counters.increment(monster_id, ups=-1, downs=1)
+      return previous
+    previous = db.run_in_transaction_options(
+      db.create_transaction_options(xg=True), txn)
+    identity.discard(db.Key.from_path('Vote', key_name))
+    if previous != is_up:
+      counters.schedule_fold(monster_id)
+    return previous
 
 class Product(db.Model):
   name = db.StringProperty()
-  creator = db.ReferenceProperty(reference_class=Profile)
+  creator = identity.ReferenceProperty(reference_class=Profile)
   access_code = db.StringProperty()
   description = db.TextProperty()
   link = db.LinkProperty()
@@ -304,4 +1026,40 @@ class Product(db.Model):
   
   @staticmethod
   def get_by_access_code(code):
-    return Product.all().filter("access_code = ", code).get()
\ No newline at end of file
+    return Product.all().filter("access_code = ", code).get()
+    
+  @staticmethod
+  def get_mem_key_for_id(sid):
+    return "product:%s" % sid
+    
+  @staticmethod
+  def get_by_ids_safe(ids):
+    """Resolves a collection of product ids in one batch.
+    
+    Checks the identity map, then memcache with one get_multi, then fetches
+    what's left with one datastore get and back-fills memcache.
+    
+    Returns:
+      A dict of product id to Product for the products that exist."""
+    ids = list(ids)
+    found = {}
+    for product in identity.get_multi(
+        [db.Key.from_path('Product', sid) for sid in ids]).values():
+      found[product.key().id()] = product
+      
+    remaining = [sid for sid in ids if sid not in found]
+    if remaining:
+      cached = memcache.get_multi(
+        [Product.get_mem_key_for_id(sid) for sid in remaining])
+      missing = [sid for sid in remaining 
+                 if Product.get_mem_key_for_id(sid) not in cached]
+      if missing:
+        fetched = dict((Product.get_mem_key_for_id(product.key().id()), product)
+                       for product in Product.get_by_id(missing) if product)
+        if fetched:
+          memcache.set_multi(fetched)
+          cached.update(fetched)
+      for product in cached.values():
+        if product:
+          found[product.key().id()] = identity.add(product)
+    return found
\ No newline at end of file
@@ -0,0 +1,349 @@
+from google.appengine.ext import db
+from array import array
+from bisect import bisect_left, insort
+from collections import defaultdict
+import cPickle
+import datetime
+import heapq
+import json
+import re
+import threading
+import time
+import zlib
+from data import generations
+
+# Name of the snapshot the index is saved under, see data.indexing.save_blob.
+SNAPSHOT_NAME = "monster-names"
+
+# Seconds an instance uses a loaded snapshot (plus changes) before reloading.
+SNAPSHOT_TTL = 60 * 60
+
+# Changes this much older than a snapshot are replayed on top of it anyway,
+# to cover clock skew between the instance that took it and other writers.
+REPLAY_MARGIN = datetime.timedelta(minutes=1)
+
+# Most names checked for typos per suggestion, those sharing the most
+# trigrams with the query first. Bounds the cost of short, common queries.
+MAX_FUZZY_CANDIDATES = 100
+
+_SNAPSHOT_VERSION = 1
+
+_WORD = re.compile(r'\w+', re.UNICODE)
+
+
+def normalize(name):
+  """Returns the form names are matched in: lower case words, single
+  spaced."""
+  return u" ".join(_WORD.findall((name or u"").lower()))
+
+
+def _trigrams(normalized):
+  padded = u" %s " % normalized
+  return set(padded[i:i + 3] for i in xrange(len(padded) - 2))
+
+
+def _word_starts(normalized):
+  """Returns the suffixes of a normalized name that start at a word."""
+  return [normalized[match.start():]
+          for match in re.finditer(r'\w+', normalized, re.UNICODE)]
+
+
+def edit_distance(left, right, bound):
+  """Returns the Levenshtein distance of two strings, or bound + 1 if it's
+  more than bound."""
+  if abs(len(left) - len(right)) > bound:
+    return bound + 1
+  previous = range(len(right) + 1)
+  for i, left_char in enumerate(left, 1):
+    current = [i]
+    diagonal = i - 1
+    for j, right_char in enumerate(right):
+      above = previous[j + 1]
+      cost = diagonal if left_char == right_char else diagonal + 1
+      if above + 1 < cost:
+        cost = above + 1
+      if current[j] + 1 < cost:
+        cost = current[j] + 1
+      current.append(cost)
+      diagonal = above
+    if min(current) > bound:
+      return bound + 1
+    previous = current
+  return min(previous[-1], bound + 1)
+
+
+def max_distance(query):
+  """Returns the number of typos tolerated in a normalized query."""
+  if len(query) < 3:
+    return 0
+  if len(query) < 6:
+    return 1
+  return 2
+
+
+class NameIndex(object):
+  """An in-memory index of monster names for autocomplete.
+
+  Prefixes are found by binary search over the sorted word-start suffixes
+  of every name, so "drag" finds "Red Dragon". Typos are found through
+  trigram postings, kept as sorted integer arrays of monster ids, and
+  checked with a bounded edit distance."""
+
+  def __init__(self):
+    # monster id -> (name, access atom)
+    self._entries = {}
+    # Sorted (word-start suffix, monster id) pairs.
+    self._prefixes = []
+    # trigram -> sorted array of monster ids.
+    self._trigrams = {}
+
+  def __len__(self):
+    return len(self._entries)
+
+  def add(self, monster_id, name, access):
+    """Adds or renames a monster.
+
+    Args:
+      monster_id: the monster's id.
+      name: the monster's name.
+      access: the monster's access atom, see Monster.get_access_atom."""
+    self.remove(monster_id)
+    normalized = normalize(name)
+    if not normalized:
+      return
+    self._entries[monster_id] = (name, access)
+    for suffix in _word_starts(normalized):
+      insort(self._prefixes, (suffix, monster_id))
+    for trigram in _trigrams(normalized):
+      postings = self._trigrams.get(trigram)
+      if postings is None:
+        postings = self._trigrams[trigram] = array('l')
+      insort(postings, monster_id)
+
+  def remove(self, monster_id):
+    """Removes a monster, if it's in the index."""
+    entry = self._entries.pop(monster_id, None)
+    if not entry:
+      return
+    normalized = normalize(entry[0])
+    for suffix in _word_starts(normalized):
+      index = bisect_left(self._prefixes, (suffix, monster_id))
+      if (index < len(self._prefixes) and
+          self._prefixes[index] == (suffix, monster_id)):
+        del self._prefixes[index]
+    for trigram in _trigrams(normalized):
+      postings = self._trigrams[trigram]
+      index = bisect_left(postings, monster_id)
+      if index < len(postings) and postings[index] == monster_id:
+        del postings[index]
+      if not postings:
+        del self._trigrams[trigram]
+
+  def suggest(self, text, access_atoms, limit=10):
+    """Returns the names best matching what's been typed so far.
+
+    Names that start a word with text come first, alphabetically. Then come
+    names within max_distance typos of text, or of the start of one of
+    their words, closest first.
+
+    Args:
+      text: the text typed so far.
+      access_atoms: the access atoms of the monsters that may be returned.
+      limit: the maximum number of suggestions.
+
+    Returns:
+      A list of (monster id, name) tuples."""
+    query = normalize(text)
+    if not query:
+      return []
+    access_atoms = set(access_atoms)
+    ranked = {}
+
+    start = bisect_left(self._prefixes, (query,))
+    for suffix, monster_id in self._prefixes[start:]:
+      if not suffix.startswith(query) or len(ranked) >= limit:
+        break
+      name, access = self._entries[monster_id]
+      if access in access_atoms and monster_id not in ranked:
+        ranked[monster_id] = (0, 0, False, name.lower())
+
+    bound = max_distance(query)
+    if len(ranked) < limit and bound:
+      query_trigrams = _trigrams(query)
+      shared = defaultdict(int)
+      for trigram in query_trigrams:
+        for monster_id in self._trigrams.get(trigram, ()):
+          shared[monster_id] += 1
+      # Each typo changes at most three trigrams.
+      needed = max(1, len(query_trigrams) - 3 * bound)
+      candidates = heapq.nlargest(
+        MAX_FUZZY_CANDIDATES, 
+        (item for item in shared.iteritems() if item[1] >= needed), 
+        key=lambda item: item[1])
+      for monster_id, count in candidates:
+        if monster_id in ranked:
+          continue
+        name, access = self._entries[monster_id]
+        if access not in access_atoms:
+          continue
+        normalized = normalize(name)
+        whole = edit_distance(query, normalized, bound)
+        prefix = min(edit_distance(query, suffix[:len(query)], bound)
+                     for suffix in _word_starts(normalized))
+        if min(whole, prefix) <= bound:
+          # A typo of the whole name beats a typo of the start of one.
+          ranked[monster_id] = (1, min(whole, prefix), whole > prefix, 
+                                name.lower())
+
+    best = sorted(ranked.iteritems(), key=lambda item: item[1])[:limit]
+    return [(monster_id, self._entries[monster_id][0])
+            for monster_id, rank in best]
+
+  def copy(self):
+    """Returns an independent copy of the index, to change while other
+    threads go on reading this one."""
+    index = NameIndex()
+    index._entries = dict(self._entries)
+    index._prefixes = list(self._prefixes)
+    index._trigrams = dict((trigram, array('l', postings))
+                           for trigram, postings in self._trigrams.iteritems())
+    return index
+
+  def dumps(self):
+    """Returns a compressed snapshot of the index as a string."""
+    return zlib.compress(cPickle.dumps(
+      {'version': _SNAPSHOT_VERSION, 'entries': self._entries},
+      cPickle.HIGHEST_PROTOCOL))
+
+  @staticmethod
+  def loads(data):
+    """Returns the NameIndex in a snapshot made by dumps."""
+    state = cPickle.loads(zlib.decompress(data))
+    if state['version'] != _SNAPSHOT_VERSION:
+      raise ValueError("Unknown snapshot version %s" % state['version'])
+    return NameIndex.from_entries(state['entries'])
+
+  @staticmethod
+  def from_entries(entries):
+    """Returns a NameIndex of a dict of monster id to (name, access atom)."""
+    index = NameIndex()
+    index._entries = entries
+    # Built in bulk and sorted once; add() per entry would be quadratic.
+    trigrams = {}
+    for monster_id, (name, access) in index._entries.iteritems():
+      normalized = normalize(name)
+      for suffix in _word_starts(normalized):
+        index._prefixes.append((suffix, monster_id))
+      for trigram in _trigrams(normalized):
+        trigrams.setdefault(trigram, []).append(monster_id)
+    index._prefixes.sort()
+    for trigram, monster_ids in trigrams.iteritems():
+      index._trigrams[trigram] = array('l', sorted(monster_ids))
+    return index
+
+
+class NameChange(db.Model):
+  """A batch of changes to monster names since the last snapshot.
+
+  Instances apply them to their NameIndex on top of the snapshot. They're
+  all children of one root, so they can be read with a consistent query;
+  they're written once per index drain, well under one write a second."""
+  created = db.DateTimeProperty(auto_now_add=True)
+  # JSON list of [monster id, name, access atom]; name is null for deletes.
+  entries = db.TextProperty()
+
+
+_CHANGES_ROOT = db.Key.from_path('NameChangeLog', 'monsters')
+
+# This instance's index and how up to date it is, see get. The index is
+# never changed once published: updates are applied to a copy that replaces
+# it, under _lock so only one thread at a time does the work.
+_lock = threading.Lock()
+_index = None
+_index_time = 0
+_applied = None
+_generation = None
+
+
+def record(entries):
+  """Records changes to monster names for every instance's NameIndex.
+
+  Args:
+    entries: (monster id, name, access atom) tuples. Name is None for
+      monsters that were deleted."""
+  if not entries:
+    return
+  NameChange(parent=_CHANGES_ROOT, entries=json.dumps(entries)).put()
+  generations.bump("names")
+
+
+def _apply_changes(index, since):
+  """Applies the NameChanges made since a time to index.
+
+  Returns:
+    The time of the last change applied, or since if there were none."""
+  query = NameChange.all().ancestor(_CHANGES_ROOT).order('created')
+  if since:
+    query.filter('created >=', since)
+  for change in query.run(batch_size=100):
+    for monster_id, name, access in json.loads(change.entries):
+      if name is None:
+        index.remove(monster_id)
+      else:
+        index.add(monster_id, name, access)
+    since = change.created
+  return since
+
+
+def get():
+  """Returns this instance's NameIndex, brought up to date.
+
+  The index is loaded from the latest snapshot every SNAPSHOT_TTL seconds.
+  In between, a memcache generation tells when other instances have
+  recorded changes, and only those are read."""
+  global _index, _index_time, _applied, _generation
+  # data.indexing imports this module.
+  from data import indexing
+
+  generation = generations.get("names")
+  if (_index is not None and generation == _generation and 
+      time.time() - _index_time <= SNAPSHOT_TTL):
+    return _index
+  with _lock:
+    if _index is None or time.time() - _index_time > SNAPSHOT_TTL:
+      data = indexing.load_blob(SNAPSHOT_NAME)
+      if data:
+        as_of, names = cPickle.loads(data)
+        index = NameIndex.loads(names)
+        since = as_of - REPLAY_MARGIN
+      else:
+        index = NameIndex()
+        since = None
+      _applied = _apply_changes(index, since)
+      _index = index
+      _index_time = time.time()
+    elif generation != _generation:
+      index = _index.copy()
+      _applied = _apply_changes(index, _applied)
+      _index = index
+    _generation = generation
+    return _index
+
+
+def save(index, as_of):
+  """Saves a NameIndex built from the datastore as of a time as the
+  snapshot, and deletes the changes it makes redundant."""
+  # data.indexing imports this module.
+  from data import indexing
+
+  indexing.save_blob(SNAPSHOT_NAME,
+                     cPickle.dumps((as_of, index.dumps()),
+                                   cPickle.HIGHEST_PROTOCOL),
+                     len(index))
+  old = NameChange.all(keys_only=True).ancestor(_CHANGES_ROOT).filter(
+    'created <', as_of - REPLAY_MARGIN)
+  while True:
+    keys = old.fetch(500)
+    if not keys:
+      break
+    db.delete(keys)
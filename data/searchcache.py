@@ -0,0 +1,102 @@
+from google.appengine.api import memcache
+import hashlib
+from data import generations
+from data import searchquery
+
+# Generation namespace of the monster index. Bumping it orphans every cached
+# result at once, see invalidate.
+NAMESPACE = "search-index"
+
+_HITS = "search-cache:hits"
+_MISSES = "search-cache:misses"
+_HIT_MILLIS = "search-cache:hit-ms"
+_MISS_MILLIS = "search-cache:miss-ms"
+
+# Digest of what the index holds for a document, see changed.
+_DIGEST = "search-cache:doc:%s"
+
+
+def key_for(query, access_atoms, limit, cursor):
+  """Returns the memcache key of a page of search results.
+  
+  Queries with the same meaning share a key, see ParsedQuery.canonical, and
+  the key includes the index generation, so results cached before the index
+  last changed are never read."""
+  digest = hashlib.sha1(repr((searchquery.parse(query).canonical(), 
+                              sorted(access_atoms), limit, 
+                              cursor or ""))).hexdigest()
+  return "search:%s:%s" % (generations.get(NAMESPACE), digest)
+  
+
+def get(key):
+  """Returns the cached results under key, or None."""
+  return memcache.get(key)
+  
+  
+def put(key, results):
+  memcache.set(key, results, generations.LISTING_TTL)
+
+
+def invalidate():
+  """Orphans every cached result. Call whenever the index changes."""
+  generations.bump(NAMESPACE)
+
+
+def _digest(document):
+  return hashlib.sha1(repr((
+    [(field.name, field.value) for field in document.fields],
+    [(facet.name, facet.value) for facet in document.facets or ()]))
+  ).hexdigest()
+
+
+def changed(documents, deleted_ids=()):
+  """Records what the index now holds for some documents.
+
+  Args:
+    documents: the search.Documents just put.
+    deleted_ids: the ids of the documents just deleted.
+
+  Returns:
+    Whether any of them differ from what was last recorded, so cached
+    results could be stale. Documents whose digest memcache has evicted
+    count as changed."""
+  digests = dict((_DIGEST % document.doc_id, _digest(document)) 
+                 for document in documents)
+  digests.update((_DIGEST % doc_id, "") for doc_id in deleted_ids)
+  if not digests:
+    return False
+  recorded = memcache.get_multi(digests.keys())
+  if recorded == digests:
+    return False
+  memcache.set_multi(digests)
+  return True
+  
+
+def record(hit, seconds):
+  """Counts a cache lookup and how long answering the search took."""
+  millis = int(seconds * 1000)
+  if hit:
+    memcache.offset_multi({_HITS: 1, _HIT_MILLIS: millis}, initial_value=0)
+  else:
+    memcache.offset_multi({_MISSES: 1, _MISS_MILLIS: millis}, initial_value=0)
+    
+    
+def stats():
+  """Returns the cache's metrics since memcache last evicted them.
+  
+  Returns:
+    A dict of the hits, misses, hit ratio, average milliseconds to answer a
+    hit and a miss, and the estimated milliseconds saved by the hits."""
+  counters = memcache.get_multi([_HITS, _MISSES, _HIT_MILLIS, _MISS_MILLIS])
+  hits = counters.get(_HITS, 0)
+  misses = counters.get(_MISSES, 0)
+  hit_millis = float(counters.get(_HIT_MILLIS, 0)) / hits if hits else 0.0
+  miss_millis = float(counters.get(_MISS_MILLIS, 0)) / misses if misses else 0.0
+  return {
+    'hits': hits,
+    'misses': misses,
+    'hit_ratio': float(hits) / (hits + misses) if hits + misses else 0.0,
+    'average_hit_ms': hit_millis,
+    'average_miss_ms': miss_millis,
+    'latency_saved_ms': max(0.0, hits * (miss_millis - hit_millis)),
+  }
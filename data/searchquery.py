@@ -0,0 +1,286 @@
+"""Compiles the search box's query syntax into search API queries.
+
+Besides free text, a query may contain field terms:
+
+  tag:horde             monsters tagged Horde
+  damage_tag:forceful   monsters whose damage is tagged Forceful
+  hp>=10                HP (also armor, score) compared with >, >=, <, <=, =
+                        or :
+  created>=2013-06-01   monsters created on or after a date
+  sort:score            order by score (also hp, armor, created), descending;
+                        sort:hp:asc for ascending
+
+Values with spaces are quoted: tag:"hard to kill". Terms that don't parse as
+field terms are searched as plain text, so a query always compiles. The text
+may use the search API's operators: AND, OR, NOT, parentheses and ~ for
+stemmed words.
+
+Searches also count their matches by the values of the FACETS, which
+refine() turns back into field terms."""
+from google.appengine.api import search
+from collections import OrderedDict
+import datetime
+import re
+
+# The search box's field names, mapped to the document fields they filter.
+ATOM_FIELDS = {
+  'tag': 'tag',
+  'damage_tag': 'damage_tag',
+}
+NUMBER_FIELDS = {
+  'hp': 'hp_value',
+  'armor': 'armor_value',
+  'score': 'score',
+}
+DATE_FIELDS = {
+  'created': 'created',
+}
+
+# Sortable names, mapped to a document field and the value used for
+# documents without that field.
+SORTS = {
+  'score': ('score', 0.0),
+  'hp': ('hp_value', 0),
+  'armor': ('armor_value', 0),
+  'created': ('created', datetime.date(1970, 1, 1)),
+}
+
+# Facets counted for each search, mapped to the search box field that
+# refines a query by one of their values. The values counted are the ones
+# CoreMonsterBuilder's options can produce, see facet_vocabulary.
+FACETS = OrderedDict([
+  ('organization', 'tag'),
+  ('size', 'tag'),
+  ('tag', 'tag'),
+  ('damage_tag', 'damage_tag'),
+])
+
+# Documents the index sorts per query; the search API's maximum.
+SORT_LIMIT = 10000
+
+_vocabulary = None
+
+_TERM = re.compile(
+  r'(?:(?P<field>\w+)(?P<op>:|>=|<=|>|<|=))?(?P<value>"[^"]*"|\S+)', re.UNICODE)
+_DATE = re.compile(r'^\d{4}-\d{2}-\d{2}$')
+_NUMBER = re.compile(r'^-?\d+(\.\d+)?$')
+_WORD = re.compile(r'^\w+$', re.UNICODE)
+
+# Free text terms passed through to the search API unquoted.
+_OPERATORS = frozenset(['AND', 'OR', 'NOT'])
+
+
+class ParsedQuery(object):
+  """The parts of a search box query.
+
+  Attributes:
+    text: the free text terms.
+    filters: (document field, operator, value) tuples, values unquoted.
+    sort: a (document field, default value, descending) tuple, or None."""
+
+  def __init__(self):
+    self.text = []
+    self.filters = []
+    self.sort = None
+
+  def canonical(self):
+    """Returns a string that's the same for queries with the same meaning,
+    whatever the case of their words or, without operators, the order of
+    their terms."""
+    text = [term if term in _OPERATORS else term.lower() 
+            for term in self.text]
+    if not any(term in _OPERATORS or term.strip('()') != term 
+               for term in text):
+      text.sort()
+    return repr((text, sorted(self.filters), self.sort))
+
+  def to_query_string(self):
+    """Returns the search API query string for the text and filters.
+
+    Operators in the text are kept, dropping the ones that would leave the
+    query malformed, and parentheses are balanced."""
+    query = _text_query(self.text)
+    if query and self.filters and any(word in query.split() 
+                                      for word in _OPERATORS):
+      query = "(%s)" % query
+    parts = [query] if query else []
+    for field, op, value in self.filters:
+      if field in DATE_FIELDS.values() or field in NUMBER_FIELDS.values():
+        parts.append("%s%s%s" % (field, op, value))
+      else:
+        parts.append("%s:%s" % (field, _quote(value)))
+    return " ".join(parts)
+
+
+def _quote(value):
+  return '"%s"' % value.replace('"', '')
+
+
+def _text_word(word):
+  """Returns a free text word for a query string: operators and words that
+  need no escaping bare, and any ~ before the quotes of others."""
+  if word in _OPERATORS:
+    return word
+  stem = ''
+  if word.startswith('~') and len(word) > 1:
+    stem, word = '~', word[1:]
+  if not _WORD.match(word):
+    word = _quote(word)
+  return stem + word
+
+
+def _text_query(text):
+  """Returns the query string for free text terms, dropping operators and
+  parentheses that would leave it malformed."""
+  tokens = []
+  for term in text:
+    body = term.lstrip('(')
+    word = body.rstrip(')')
+    tokens.extend('(' * (len(term) - len(body)))
+    if word:
+      tokens.append(_text_word(word))
+    tokens.extend(')' * (len(body) - len(word)))
+
+  parts = []
+  depth = 0
+  for token in tokens + [')'] * len(tokens):
+    if token == '(':
+      parts.append(token)
+      depth += 1
+    elif token == ')':
+      while parts and parts[-1] in _OPERATORS:
+        parts.pop()
+      if not depth:
+        continue
+      depth -= 1
+      if parts[-1] == '(':
+        parts.pop()
+      else:
+        parts.append(token)
+    elif token in _OPERATORS:
+      if token == 'NOT' and (not parts or parts[-1] != 'NOT'):
+        parts.append(token)
+      elif parts and parts[-1] not in _OPERATORS and parts[-1] != '(':
+        parts.append(token)
+    else:
+      parts.append(token)
+  while parts and parts[-1] in _OPERATORS:
+    parts.pop()
+
+  query = ""
+  for part in parts:
+    if query and part != ')' and not query.endswith('('):
+      query += " "
+    query += part
+  return query
+
+
+def _unquote(value):
+  if len(value) > 1 and value.startswith('"') and value.endswith('"'):
+    return value[1:-1]
+  return value
+
+
+def normalize_atom(value):
+  """Returns the form tags are stored and queried in: lower case, single
+  spaced."""
+  return " ".join(value.lower().split())
+
+
+def facet_vocabulary():
+  """Returns the values counted for each of the FACETS, normalized.
+  
+  The values are the tags CoreMonsterBuilder's option deltas add, see
+  CoreMonsterBuilder.tag_vocabulary. They're computed once per instance."""
+  global _vocabulary
+  if _vocabulary is None:
+    # Imported here as the builder imports the models, which import this.
+    from monsterrules.core.builder import CoreMonsterBuilder
+    tags = CoreMonsterBuilder.tag_vocabulary()
+    _vocabulary = OrderedDict(
+      (name, [normalize_atom(tag) for tag in tags[name]]) for name in FACETS)
+  return _vocabulary
+  
+  
+def refine(text, facet, value):
+  """Returns the search box query text narrowed to a value of a facet."""
+  term = '%s:%s' % (FACETS[facet], _quote(value))
+  if text:
+    return "%s %s" % (text, term)
+  return term
+
+
+def parse(text):
+  """Splits a search box query into a ParsedQuery."""
+  parsed = ParsedQuery()
+  for match in _TERM.finditer(text or ""):
+    field, op = match.group('field'), match.group('op')
+    value = _unquote(match.group('value'))
+    if field:
+      field = field.lower()
+    if not value:
+      continue
+
+    if field == 'sort' and op == ':':
+      name, _, direction = value.lower().partition(':')
+      if name in SORTS:
+        sort_field, default = SORTS[name]
+        parsed.sort = (sort_field, default, direction != 'asc')
+        continue
+    elif field in ATOM_FIELDS and op == ':':
+      parsed.filters.append((ATOM_FIELDS[field], ':', normalize_atom(value)))
+      continue
+    elif field in NUMBER_FIELDS and _NUMBER.match(value):
+      parsed.filters.append((NUMBER_FIELDS[field], op.replace(':', '='), value))
+      continue
+    elif field in DATE_FIELDS and op != ':' and _DATE.match(value):
+      parsed.filters.append((DATE_FIELDS[field], op, value))
+      continue
+
+    parsed.text.append(_unquote(match.group(0)))
+  return parsed
+
+
+def compile_query(text, limit=20, cursor=None, returned_fields=None,
+                  restriction=None, facets=False):
+  """Compiles a search box query into a search.Query.
+
+  Args:
+    text: the query as typed into the search box.
+    limit: the maximum number of results to return.
+    cursor: the web-safe string of the cursor to continue from, or None for
+      the first page.
+    returned_fields: the document fields to return.
+    restriction: a query string ANDed with the user's query, e.g. to hide
+      documents they may not see.
+    facets: whether to count the matches by the values of the FACETS.
+
+  Returns:
+    The search.Query, which asks for a cursor to the next page."""
+  parsed = parse(text)
+  query_string = parsed.to_query_string()
+  if restriction:
+    query_string = ("(%s) %s" % (query_string, restriction) if query_string
+                    else restriction)
+
+  sort_options = None
+  if parsed.sort:
+    field, default, descending = parsed.sort
+    sort_options = search.SortOptions(
+      expressions=[search.SortExpression(
+        expression=field, default_value=default,
+        direction=(search.SortExpression.DESCENDING if descending
+                   else search.SortExpression.ASCENDING))],
+      limit=SORT_LIMIT)
+
+  options = search.QueryOptions(
+    limit=limit,
+    cursor=search.Cursor(web_safe_string=cursor) if cursor else search.Cursor(),
+    sort_options=sort_options,
+    returned_fields=returned_fields)
+  return_facets = None
+  if facets:
+    return_facets = [search.FacetRequest(name, values=values) 
+                     for name, values in facet_vocabulary().items()]
+  return search.Query(query_string=query_string, options=options, 
+                      return_facets=return_facets)
@@ -0,0 +1,102 @@
+import webapp2
+from google.appengine.api import taskqueue
+from data import imports
+from data import indexing
+from data import searchcache
+import data.migrations
+import json
+
+
+class MigrationHandler(webapp2.RequestHandler):
+  """Runs a data migration as a chain of tasks.
+  
+  Subclasses set step to a function that takes a cursor, migrates one batch
+  and returns the cursor for the next batch (or None when done). Each request
+  runs one step and enqueues the next, so migrations of any size stay inside
+  the request deadline.
+  
+  Admin-only, see app.yaml."""
+  
+  step = None
+  
+  def get(self):
+    """HTML GET handler.
+    
+    Starts the migration."""
+    
+    taskqueue.add(url=self.request.path)
+    self.response.write("Migration started.")
+    
+  def post(self):
+    """HTML POST handler.
+    
+    Runs one step of the migration and chains the next."""
+    
+    cursor = self.step(self.request.get('cursor') or None)
+    if cursor:
+      taskqueue.add(url=self.request.path, params={'cursor': cursor})
+
+
+class RekeyVotesHandler(MigrationHandler):
+  """Moves Votes to deterministic key names."""
+  
+  step = staticmethod(data.migrations.rekey_votes)
+
+
+class RekeyProfilesHandler(MigrationHandler):
+  """Moves Profiles to key names from their account's user_id()."""
+  
+  step = staticmethod(data.migrations.rekey_profiles)
+
+
+class StatsHandler(webapp2.RequestHandler):
+  """Reports operational metrics as JSON."""
+  
+  def get(self):
+    """HTML GET handler.
+    
+    Write the current metrics."""
+    
+    stats = {}
+    stats['search_index_lag_seconds'] = indexing.lag()
+    stats['search_cache'] = searchcache.stats()
+    self.response.headers['Content-Type'] = 'application/json'
+    self.response.write(json.dumps(stats))
+
+
+class ReindexHandler(webapp2.RequestHandler):
+  """Starts and reports on rebuilds of the monster search index."""
+  
+  def get(self):
+    """HTML GET handler.
+    
+    Write the progress of the job in the job parameter, or start a new job
+    if there isn't one."""
+    
+    job_id = self.request.get('job')
+    if job_id:
+      job = indexing.ReindexJob.get_by_key_name(job_id)
+      if not job:
+        self.response.set_status(404)
+        return
+    else:
+      job = indexing.start_reindex(
+        int(self.request.get('shards') or 8))
+    self.response.headers['Content-Type'] = 'application/json'
+    self.response.write(json.dumps(job.get_progress()))
+
+
+class ImportBenchmarkHandler(webapp2.RequestHandler):
+  """Compares how fast each upload format is read, see
+  data.imports.benchmark. The rates leave out writing the monsters, which
+  is the same for every format."""
+  
+  def get(self):
+    """HTML GET handler.
+    
+    Write the rate of each format for the number of monsters in the count
+    parameter, as JSON."""
+    
+    results = imports.benchmark(int(self.request.get('count') or 1000))
+    self.response.headers['Content-Type'] = 'application/json'
+    self.response.write(json.dumps(results))
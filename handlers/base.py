@@ -1,11 +1,17 @@
 import webapp2
+from google.appengine.api import memcache
 from google.appengine.api import users
-from data.models import Profile
+from data.models import Monster, Profile, cursor_digest
 import configuration.site
+import urllib
 
 USER_KEY = "user"
 PROFILE_KEY = "profile"
 LOGIN_URL_KEY = "login_url"
+VOTES_KEY = "votes"
+
+# Seconds to remember which page led to which, for "Previous" links.
+PAGINATION_TTL = 24 * 60 * 60
 
 class LoggedInRequestHandler(webapp2.RequestHandler):
       
@@ -35,17 +41,62 @@ class LoggedInRequestHandler(webapp2.RequestHandler):
     format_urls['monster.delete_url'] = self.uri_for('monster.delete', entity_id=r'%d')
     format_urls['monster.up_url'] = self.uri_for('monster.upvote', entity_id=r'%d')
     format_urls['monster.down_url'] = self.uri_for('monster.downvote', entity_id=r'%d')
-    format_urls['profile'] = self.uri_for('profile', profile_id=r'%d')
+    format_urls['profile'] = self.uri_for('profile', profile_id=r'%s')
     format_urls['product'] = self.uri_for('product', entity_id=r'%d')
     format_urls['product.update'] = self.uri_for('product.update', entity_id=r'%d')
+    format_urls['product.delete'] = self.uri_for('product.delete', entity_id=r'%d')
     format_urls['profile.add'] = self.uri_for('profile.add', access_code=r'%s')
     template_values['format_urls'] = format_urls
     
     template_values['licenses'] = configuration.site.licenses
+    template_values[VOTES_KEY] = {}
     
     self.template_values = template_values
     return template_values
     
+  def prefetch_votes(self, monsters):
+    """Resolves the current profile's votes on monsters in one batch.
+    
+    The votes are merged into the vote map in the template values, where the
+    statblock macro looks them up by monster id."""
+    profile = self.template_values[PROFILE_KEY]
+    if profile:
+      self.template_values[VOTES_KEY].update(profile.get_vote_map(monsters))
+    return self.template_values[VOTES_KEY]
+    
+  def prefetch_monsters(self, monsters):
+    """Prepares a list of monsters for rendering as statblocks.
+    
+    Resolves their creators, products and the current profile's votes on
+    them in batches, so rendering the statblocks does no further I/O."""
+    Monster.prefetch_references(monsters)
+    return self.prefetch_votes(monsters)
+    
+  def paginate(self, url, cursor, next_cursor):
+    """Sets the next and prev links of a cursor-paginated listing.
+    
+    Each page remembers the cursor of the page that linked to it, so the
+    prev link can point back without carrying the whole history in the URL.
+    If that's been forgotten, prev goes to the first page.
+    
+    Args:
+      url: the listing's URL, without a cursor parameter.
+      cursor: the cursor the current page started at, None on the first page.
+      next_cursor: the cursor the next page starts at, None on the last page."""
+    separator = "&" if "?" in url else "?"
+    if next_cursor:
+      self.template_values['next'] = (
+        url+separator+"cursor="+urllib.quote(next_cursor))
+      memcache.set("prev-cursor:%s" % cursor_digest(next_cursor), 
+                   cursor or "", PAGINATION_TTL)
+    if cursor:
+      prev_cursor = memcache.get("prev-cursor:%s" % cursor_digest(cursor))
+      if prev_cursor:
+        self.template_values['prev'] = (
+          url+separator+"cursor="+urllib.quote(prev_cursor))
+      else:
+        self.template_values['prev'] = url
+    
   def forbidden(self):
     self.response.set_status(403)
     template = configuration.site.jinja_environment.get_template('errors/forbidden.html')
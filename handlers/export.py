@@ -0,0 +1,118 @@
+from data.models import Product, Profile
+from data import exports
+import handlers.base
+import json
+
+
+class ExportHandler(handlers.base.LoggedInRequestHandler):
+  """Exports monsters as XML that UploadHandler accepts, or as NDJSON.
+  
+  Exports the public codex, a product or a creator's monsters, see
+  data.exports. GET streams the export; POST writes it in the background
+  and redirects to the ExportJobHandler for it."""
+  
+  def get_query(self, scope, scope_id):
+    """Returns the query for the export, or None after responding with an
+    error if the current user can't have it."""
+    profile = self.template_values[handlers.base.PROFILE_KEY]
+    if scope == exports.PRODUCT:
+      try:
+        product = Product.get_by_id(int(scope_id))
+      except ValueError:
+        product = None
+      if not product:
+        self.not_found()
+        return None
+      if not profile or not profile.has_product(product):
+        self.forbidden()
+        return None
+    elif scope == exports.CREATOR and not Profile.get_by_id_safe(scope_id):
+      self.not_found()
+      return None
+    return exports.build_query(scope, scope_id, profile)
+  
+  def get(self, scope, export_format, scope_id=None):
+    """HTML GET handler.
+    
+    Stream the export, a batch of monsters at a time."""
+    
+    self.build_template_values()
+    
+    query = self.get_query(scope, scope_id)
+    if not query:
+      return
+    self.response.headers['Content-Type'] = exports.CONTENT_TYPES[export_format]
+    self.response.headers['Content-Disposition'] = (
+      'attachment; filename="%s.%s"' % (scope_id or scope, export_format))
+    self.response.app_iter = exports.iter_export(query, export_format)
+    
+  def post(self, scope, export_format, scope_id=None):
+    """HTML POST handler.
+    
+    Start writing the export in the background."""
+    
+    template_values = self.build_template_values()
+    
+    if not template_values[handlers.base.PROFILE_KEY]:
+      return self.forbidden()
+    if not self.get_query(scope, scope_id):
+      return
+    job = exports.start_export(scope, scope_id, export_format, 
+                               template_values[handlers.base.PROFILE_KEY])
+    self.redirect(self.uri_for('export.job', job_id=job.key().name()))
+
+
+class ExportJobHandler(handlers.base.LoggedInRequestHandler):
+  """Reports on and downloads exports written in the background.
+  
+  A finished export is downloaded a chunk at a time, since one response
+  can't hold an export too big to stream in one request."""
+  
+  def get_job(self, job_id):
+    """Returns the ExportJob with job_id if it's the current user's, after
+    responding with an error if not."""
+    job = exports.ExportJob.get_by_key_name(job_id)
+    if not job:
+      self.not_found()
+      return None
+    profile = self.template_values[handlers.base.PROFILE_KEY]
+    if (not profile or 
+        profile.key() != exports.ExportJob.requester.get_value_for_datastore(job)):
+      self.forbidden()
+      return None
+    return job
+  
+  def get(self, job_id=None, chunk=None):
+    """HTML GET handler.
+    
+    Without a chunk, write the progress of the export with the specified
+    job ID as JSON: 202 while it's being written, then 200 with the URLs of
+    its chunks in 'chunk_urls'. With a chunk, download that piece of the
+    finished export."""
+    
+    self.build_template_values()
+    
+    job = self.get_job(job_id)
+    if not job:
+      return
+    
+    if chunk is None:
+      progress = job.get_progress()
+      if job.done:
+        progress['chunk_urls'] = [
+          self.uri_for('export.job.chunk', job_id=job_id, chunk=index) 
+          for index in xrange(job.chunks)]
+      else:
+        self.response.set_status(202)
+      self.response.headers['Content-Type'] = 'application/json'
+      return self.response.write(json.dumps(progress))
+    
+    data = job.get_chunk(int(chunk)) if job.done else None
+    if data is None:
+      return self.not_found()
+    self.response.headers['Content-Type'] = (
+      exports.CONTENT_TYPES[job.export_format])
+    self.response.headers['Content-Disposition'] = (
+      'attachment; filename="%s.%s.%s"' % (job.scope_id or job.scope, chunk,
+                                           job.export_format))
+    self.response.write(data)
@@ -3,14 +3,15 @@ import jinja2
 from google.appengine.ext import db
 from google.appengine.api import users
 from data.models import Monster, Profile
+from data import leaderboards
 import handlers.base
 import configuration.site
 
 class HomeHandler(handlers.base.LoggedInRequestHandler):
   """Renders the main page.
   
-  Retrieves monsters to be displayed in promotional areas. Currently that
-  means the 10 most recent.
+  Retrieves monsters to be displayed in promotional areas: the best rated and
+  most recent monsters the user can see, from the precomputed leaderboards.
   
   Templates used: index.html"""
   
@@ -21,8 +22,9 @@ class HomeHandler(handlers.base.LoggedInRequestHandler):
     them to the index.html template. Does not accept any query parameters"""
     
     template_values = self.build_template_values()
-    template_values['popular_monsters'] = Monster.get_top_rated(5, user=template_values[handlers.base.PROFILE_KEY])
-    template_values['recent_monsters'] = Monster.get_recent(5, user=template_values[handlers.base.PROFILE_KEY])
+    template_values['popular_monsters'] = Monster.get_leaderboard(leaderboards.TOP, 5, user=template_values[handlers.base.PROFILE_KEY])
+    template_values['recent_monsters'] = Monster.get_leaderboard(leaderboards.RECENT, 5, user=template_values[handlers.base.PROFILE_KEY])
+    self.prefetch_monsters(template_values['popular_monsters'] + template_values['recent_monsters'])
    
     template = configuration.site.jinja_environment.get_template('index.html')
     self.response.write(template.render(template_values))
\ No newline at end of file
@@ -26,7 +26,7 @@ class CreateHandler(handlers.base.LoggedInRequestHandler):
     being used."""
     
     template_values = self.build_template_values()
-    template_values['questions']= CoreMonsterBuilder.questions()
+    template_values['questions']= CoreMonsterBuilder.registry.questions
     
     product = self.request.get('product')
     if product:
@@ -38,32 +38,6 @@ class CreateHandler(handlers.base.LoggedInRequestHandler):
     template = configuration.site.jinja_environment.get_template('monster/create.html')
     self.response.write(template.render(template_values))
   
-  def answer(self, question, context=""):
-    """Helper method to retrieve the answer to a question.
-    
-    Given a question object with correct metadata, check the request for a
-    matching parameter. If present, apply the answer and check for answers
-    to any subquestions."""
-    
-    if hasattr(question, "expectsMultiple"):
-      for optionorder, option in enumerate(question.options.values()):
-        userinput = cgi.escape(
-          self.request.get(context+str(question.order)+"."+str(optionorder)))
-        if userinput:
-          question(self.___builder, option.value)
-          for subquestion in option.subquestions.values():
-            self.answer(subquestion, 
-              context+str(question.order)+"."+str(optionorder)+"-")
-    elif hasattr(question, "expectsOne"):
-      userinput = cgi.escape(self.request.get(context+str(question.order)))
-      if userinput:
-        key = question.options.keys()[int(userinput)]
-        question(self.___builder, question.options[key].value)
-        # TODO: Handle subquestions
-    else:
-      question(self.___builder, 
-        cgi.escape(self.request.get(context+str(question.order))))
-  
   def post(self):
     """HTML POST handler.
     
@@ -73,11 +47,12 @@ class CreateHandler(handlers.base.LoggedInRequestHandler):
 
     template_values = self.build_template_values()
     if template_values[handlers.base.PROFILE_KEY]:
-      self.___builder = CoreMonsterBuilder()
-      for question in CoreMonsterBuilder.questions():
-        self.answer(question)
+      builder = CoreMonsterBuilder()
+      CoreMonsterBuilder.answer_plan.apply(builder, 
+        ((field, cgi.escape(value)) 
+         for field, value in self.request.POST.items()))
     
-      monster = self.___builder.Build()
+      monster = builder.Build()
       monster.creator = template_values[handlers.base.PROFILE_KEY]
       
       product = self.request.get('product')
@@ -114,7 +89,7 @@ class DeleteHandler(handlers.base.LoggedInRequestHandler):
       monster = Monster.get_by_id_safe(int(entity_id), template_values[handlers.base.PROFILE_KEY])
       if monster:
         if monster.creator.account == template_values[handlers.base.USER_KEY]:
-          monster.delete()
+          template_values['deletion'] = monster.delete()
         else:
           return self.forbidden()
       else:
@@ -259,12 +234,11 @@ class ViewHandler(handlers.base.LoggedInRequestHandler):
       self.redirect("/view/"+str(Monster.all().order("-creation_time").get().key().id()))
       return
     
-    if handlers.base.PROFILE_KEY in template_values:
-      template_values['vote'] = Vote.all().filter("monster = ", template_values['monster']).filter("voter = ", template_values[handlers.base.PROFILE_KEY]).get()
+    template_values['vote'] = self.prefetch_votes([monster]).get(monster.key().id())
     
     template_values['edit_url'] = self.uri_for('monster.edit', entity_id=r'%s')
     template_values['delete_url'] = self.uri_for('monster.delete', entity_id=entity_id)
-    template_values['profile_url'] = self.uri_for('profile', profile_id=monster.creator.key().id())
+    template_values['profile_url'] = self.uri_for('profile', profile_id=monster.creator.key().id_or_name())
     
     template = configuration.site.jinja_environment.get_template('monster/view.html')
     self.response.write(template.render(template_values))
@@ -282,43 +256,14 @@ class UpVoteHandler(webapp2.RequestHandler):
     Otherwise, error."""
     
     user = users.get_current_user()
-    profile = Profile.all().filter("account = ", user).get()
+    profile = Profile.for_user(user)
     monster = Monster.get_by_id_safe(int(entity_id), profile)
     
     if (not monster) or (not profile):
       return self.forbidden()
       
-    previous_vote = Vote.all().filter("voter = ", profile).filter("monster = ",monster).get()
-    if previous_vote and previous_vote.is_up:
+    if Vote.cast(profile, monster, True) is True:
       return self.response.set_status(500)
-    elif previous_vote:
-      previous_vote.is_up = True
-      previous_vote.put()
-      
-      if monster.downs:
-        monster.downs -= 1
-      else:
-        monster.downs = 0
-        
-      if monster.ups:
-        monster.ups += 1
-      else:
-        monster.ups = 1
-      
-      monster.compute_score()
-      monster.put()
-    else:
-      vote = Vote()
-      vote.voter = profile
-      vote.monster = monster
-      vote.put()
-      
-      if monster.ups:
-        monster.ups += 1
-      else:
-        monster.ups = 1
-      monster.compute_score()
-      monster.put()
 
 
 class DownVoteHandler(webapp2.RequestHandler):
@@ -333,44 +278,14 @@ class DownVoteHandler(webapp2.RequestHandler):
     Otherwise, error."""
     
     user = users.get_current_user()
-    profile = Profile.all().filter("account = ", user).get()
+    profile = Profile.for_user(user)
     monster = Monster.get_by_id_safe(int(entity_id), profile)
     
     if (not monster) or (not profile):
       return self.forbidden()
       
-    previous_vote = Vote.all().filter("voter = ", profile).filter("monster = ",monster).get()
-    if previous_vote and previous_vote.is_up:
-      previous_vote.is_up = False
-      previous_vote.put()
-      
-      if monster.downs:
-        monster.downs += 1
-      else:
-        monster.downs = 1
-        
-      if monster.ups:
-        monster.ups -= 1
-      else:
-        monster.ups = 0
-        
-      monster.compute_score()
-      monster.put()
-    elif previous_vote:
-      return self.response_set_status(500)
-    else:
-      vote = Vote()
-      vote.voter = profile
-      vote.monster = monster
-      vote.is_up = False
-      vote.put()
-      
-      if monster.downs:
-        monster.downs += 1
-      else:
-        monster.downs = 1
-      monster.compute_score()
-      monster.put()
+    if Vote.cast(profile, monster, False) is False:
+      return self.response.set_status(500)
 
 
 class ProductCreateHandler(handlers.base.LoggedInRequestHandler):
@@ -498,14 +413,11 @@ class AllHandler(handlers.base.LoggedInRequestHandler):
     them. Easy enough, right?"""
     
     template_values = self.build_template_values()
-    skip = int(self.request.get("skip", default_value=0))
-    template_values['monsters'] = Monster.get_recent_public(skip=skip)
+    cursor = self.request.get("cursor") or None
+    template_values['monsters'], next_cursor = Monster.get_recent_public(cursor)
+    self.prefetch_monsters(template_values['monsters'])
     
-    if len(template_values['monsters']) >= 10:
-      template_values['next'] = str(self.uri_for('monster.all'))+"?skip="+str(skip+10)
-      
-    if skip >= 10:
-      template_values['prev'] = str(self.uri_for('monster.all'))+"?skip="+str(skip-10)
+    self.paginate(str(self.uri_for('monster.all')), cursor, next_cursor)
    
     template = configuration.site.jinja_environment.get_template('monster/all.html')
     self.response.write(template.render(template_values))
\ No newline at end of file
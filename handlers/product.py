@@ -3,9 +3,10 @@ import jinja2
 from google.appengine.ext import db
 from google.appengine.api import users
 from data.models import Monster, Profile, Vote, Product
+from data import deletion
+from data import imports
 import handlers.base
 import configuration.site
-import xml.etree.ElementTree as ET
 from google.appengine.ext import blobstore
 from google.appengine.ext.webapp import blobstore_handlers
 import logging
@@ -161,7 +162,11 @@ class UploadHandler(handlers.base.LoggedInRequestHandler, blobstore_handlers.Blo
   def post(self):
     """HTML POST handler. 
 
-    Parse ALL THE MONSTERS."""
+    Validate the upload, then import ALL THE MONSTERS, see data.imports.
+    Uploads that fail validation or are only being checked (the dry_run
+    parameter) go to their report instead, and ones that take longer than
+    the request finish in the background, so those go to a progress page
+    that shows the report once it's ready."""
 
     template_values = self.build_template_values()
 
@@ -169,59 +174,128 @@ class UploadHandler(handlers.base.LoggedInRequestHandler, blobstore_handlers.Blo
       return self.forbidden()
 
     upload_files = self.get_uploads('file_upload')
-    blob_info = upload_files[0]
-    blob_key = blob_info.key()
-    blob_reader = blobstore.BlobReader(blob_key)
-    root = ET.parse(blob_reader)
-    
     product = int(self.request.get('product'))
-    
-    for upload_monster in root.iter('monster'):
-      monster = Monster()
-      
-      if product == -1:
-        monster.is_core = True
-      else:
-        monster.product = product
-      monster.creator = template_values[handlers.base.PROFILE_KEY]
-      
-      monster.name = upload_monster.findtext('name')
-      
-      monster.description = upload_monster.findtext('description')
-      
-      monster.instinct = upload_monster.findtext('instinct')
-      
-      tags = upload_monster.find('tags')
-      if tags and len(tags):
-        for tag in tags:
-          monster.tags.append(tag.text.encode('utf-8'))
-        
-      monster.damage = upload_monster.findtext('damage')
-      
-      monster.hp = upload_monster.findtext('hp')
-      
-      monster.armor = upload_monster.findtext('armor')
-      
-      damage_tags = upload_monster.find('damage_tags')
-      if damage_tags and len(damage_tags):
-        for tag in damage_tags:
-          monster.damage_tags.append(tag.text)
-      
-      special_qualities = upload_monster.find('special_qualities')
-      if special_qualities and len(special_qualities): 
-        for special_quality in special_qualities:
-          monster.special_qualities.append(special_quality.text)
-        
-      for move in upload_monster.find('moves'):
-        monster.moves.append(move.text)
-      
-      try:  
-        monster.put()
-      except:
-        print monster
-        raise
+    job = imports.validate_upload(upload_files[0], product, 
+                                  template_values[handlers.base.PROFILE_KEY],
+                                  dry_run=bool(self.request.get('dry_run')))
+    if not job.done:
+      return self.redirect(self.uri_for('product.import', 
+                                        job_id=job.key().name()))
     
     if product == -1:
       return self.redirect(self.uri_for('home'))
     self.redirect(self.uri_for('product', entity_id=product))
-    
\ No newline at end of file
+    
+
+class ImportHandler(handlers.base.LoggedInRequestHandler):
+  """Shows the validation report and progress of an upload.
+
+  Templates used: product/import.html"""
+
+  def get_job(self, job_id):
+    """Returns the ImportJob with job_id if it's the current user's, after
+    responding with an error if not."""
+    job = imports.ImportJob.get_by_key_name(job_id)
+    if not job:
+      self.not_found()
+      return None
+    profile = self.template_values[handlers.base.PROFILE_KEY]
+    creator_key = imports.ImportJob.creator.get_value_for_datastore(job)
+    if not profile or profile.key() != creator_key:
+      self.forbidden()
+      return None
+    return job
+
+  def done(self, job):
+    if job.product == -1:
+      return self.redirect(self.uri_for('home'))
+    return self.redirect(self.uri_for('product', entity_id=job.product))
+
+  def get(self, job_id=None):
+    """HTML GET handler.
+
+    Display the report and progress of the import with the specified job ID,
+    or go to the product once it's done."""
+
+    template_values = self.build_template_values()
+
+    job = self.get_job(job_id)
+    if not job:
+      return
+    if job.done:
+      return self.done(job)
+
+    template_values['job'] = job
+    template_values['report'] = job.get_report()
+    template_values['progress'] = job.get_progress()
+    template = configuration.site.jinja_environment.get_template('product/import.html')
+    self.response.write(template.render(template_values))
+
+  def post(self, job_id=None):
+    """HTML POST handler.
+
+    Import an upload that passed a dry run."""
+
+    self.build_template_values()
+
+    job = self.get_job(job_id)
+    if not job:
+      return
+    if not job.validated:
+      return self.forbidden()
+    job = imports.start_import(job)
+    if job.done:
+      return self.done(job)
+    return self.redirect(self.uri_for('product.import', job_id=job_id))
+
+
+class DeleteHandler(handlers.base.LoggedInRequestHandler):
+  """Deletes a product with all its monsters.
+  
+  Templates used: product/delete.html"""
+  
+  def get_product(self, entity_id):
+    """Returns the product with entity_id if the current user created it,
+    after responding with an error if not."""
+    try:
+      product = Product.get_by_id(int(entity_id))
+    except ValueError:
+      product = None
+    if not product:
+      self.not_found()
+      return None
+    if product.creator.account != self.template_values[handlers.base.USER_KEY]:
+      self.forbidden()
+      return None
+    return product
+  
+  def get(self, entity_id=None):
+    """HTML GET handler.
+    
+    Ask the creator of the product with the specified ID to confirm."""
+    
+    template_values = self.build_template_values()
+    
+    product = self.get_product(entity_id)
+    if not product:
+      return
+    template_values['product'] = product
+    template = configuration.site.jinja_environment.get_template('product/delete.html')
+    self.response.write(template.render(template_values))
+    
+  def post(self, entity_id=None):
+    """HTML POST handler.
+    
+    Delete the product with the specified ID. Large products finish in the
+    background, see data.deletion."""
+    
+    template_values = self.build_template_values()
+    
+    product = self.get_product(entity_id)
+    if not product:
+      return
+    template_values['product'] = product
+    template_values['deletion'] = deletion.delete_product(product)
+    template_values['deleted'] = True
+    template = configuration.site.jinja_environment.get_template('product/delete.html')
+    self.response.write(template.render(template_values))
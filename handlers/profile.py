@@ -26,9 +26,8 @@ class EditHandler(handlers.base.LoggedInRequestHandler):
     
     template_values = self.build_template_values()
     if not template_values[handlers.base.PROFILE_KEY]:
-      profile = Profile()
+      profile = Profile.new_for_user(template_values[handlers.base.USER_KEY])
       profile.display_name = "A Person With No Name"
-      profile.account = template_values[handlers.base.USER_KEY]
       profile.put()
       template_values[handlers.base.PROFILE_KEY] = profile
       template_values['new'] = True
@@ -43,9 +42,8 @@ class EditHandler(handlers.base.LoggedInRequestHandler):
     if user:
       profile = Profile.for_user(user)
       if not profile:
-        profile = Profile()
+        profile = Profile.new_for_user(user)
       profile.display_name = self.request.get('display_name')
-      profile.account = user
       profile.put()
       return self.redirect(self.uri_for('profile.me'))
     else:
@@ -65,19 +63,19 @@ class FavoritesHandler(handlers.base.LoggedInRequestHandler):
     them to the index.html template. Does not accept any query parameters"""
     
     template_values = self.build_template_values()
-    skip = int(self.request.get("skip", default_value=0))
-    favoriter = Profile.get_by_id(int(profile_id))
+    cursor = self.request.get("cursor") or None
+    favoriter = Profile.get_by_id_safe(profile_id)
+    if not favoriter:
+      return self.not_found()
     template_values['favoriter'] = favoriter
-    template_values['monsters'] = favoriter.get_favorites(
+    template_values['monsters'], next_cursor = favoriter.get_favorites(
       10,
       user=template_values[handlers.base.PROFILE_KEY],
-      skip=skip)
+      cursor=cursor)
+    self.prefetch_monsters(template_values['monsters'])
     
-    if len(template_values['monsters']) >= 10:
-      template_values['next'] = str(self.uri_for('profile.monster.all', profile_id=profile_id))+"?skip="+str(skip+10)
-      
-    if skip >= 10:
-      template_values['prev'] = str(self.uri_for('profile.monster.all', profile_id=profile_id))+"?skip="+str(skip-10)
+    self.paginate(str(self.uri_for('favorites', profile_id=profile_id)), 
+                  cursor, next_cursor)
    
     template = configuration.site.jinja_environment.get_template('monster/all.html')
     self.response.write(template.render(template_values))
@@ -100,12 +98,14 @@ class ProfileHandler(handlers.base.LoggedInRequestHandler):
     
     template_values = self.build_template_values()
     
-    if profile_id and template_values[handlers.base.PROFILE_KEY] and int(profile_id) == template_values[handlers.base.PROFILE_KEY].key().id():
+    if profile_id and template_values[handlers.base.PROFILE_KEY] and profile_id == template_values[handlers.base.PROFILE_KEY].key().name():
       template_values['viewed_profile'] = template_values[handlers.base.PROFILE_KEY]
     elif profile_id:
-      template_values['viewed_profile'] = Profile.get_by_id(int(profile_id))
+      template_values['viewed_profile'] = Profile.get_by_id_safe(profile_id)
+      if not template_values['viewed_profile']:
+        return self.not_found()
     elif template_values[handlers.base.PROFILE_KEY]:
-      return self.redirect(self.uri_for("profile", profile_id=template_values[handlers.base.PROFILE_KEY].key().id()))
+      return self.redirect(self.uri_for("profile", profile_id=template_values[handlers.base.PROFILE_KEY].key().id_or_name()))
     else:
       return self.forbidden()
     
@@ -116,6 +116,8 @@ class ProfileHandler(handlers.base.LoggedInRequestHandler):
     created =   Monster.get_recent(1, creator=template_values['viewed_profile'], user=template_values[handlers.base.PROFILE_KEY])
     if created:
       template_values['recent_monster'] = created[0]
+    self.prefetch_monsters([template_values.get('recent_up_monster'), 
+                            template_values.get('recent_monster')])
     template = configuration.site.jinja_environment.get_template('profile/view.html')
     return self.response.write(template.render(template_values))
       
@@ -158,20 +160,20 @@ class AllHandler(handlers.base.LoggedInRequestHandler):
     them. Easy enough, right?"""
     
     template_values = self.build_template_values()
-    skip = int(self.request.get("skip", default_value=0))
-    creator = Profile.get_by_id(int(profile_id))
+    cursor = self.request.get("cursor") or None
+    creator = Profile.get_by_id_safe(profile_id)
+    if not creator:
+      return self.not_found()
     template_values['creator'] = creator
-    template_values['monsters'] = Monster.get_recent(
+    template_values['monsters'], next_cursor = Monster.get_recent_page(
       10,
       creator=creator,
       user=template_values[handlers.base.PROFILE_KEY],
-      skip=skip)
+      cursor=cursor)
+    self.prefetch_monsters(template_values['monsters'])
     
-    if len(template_values['monsters']) >= 10:
-      template_values['next'] = str(self.uri_for('profile.monster.all', profile_id=profile_id))+"?skip="+str(skip+10)
-      
-    if skip >= 10:
-      template_values['prev'] = str(self.uri_for('profile.monster.all', profile_id=profile_id))+"?skip="+str(skip-10)
+    self.paginate(str(self.uri_for('profile.monster.all', profile_id=profile_id)), 
+                  cursor, next_cursor)
    
     template = configuration.site.jinja_environment.get_template('monster/all.html')
     self.response.write(template.render(template_values))
\ No newline at end of file
@@ -2,11 +2,15 @@ import webapp2
 import jinja2
 from google.appengine.ext import db
 from google.appengine.api import users
-from data.models import Monster, Profile, _MONSTER_INDEX
+from data.models import Monster, Profile
+from data import searchquery
 import handlers.base
 import configuration.site
-import cgi
-from google.appengine.api import search
+import json
+import urllib
+
+# Number of results per page of search results.
+SEARCH_PAGE_SIZE = 20
 
 class SearchHandler(handlers.base.LoggedInRequestHandler):
   """Renders the search page.
@@ -18,15 +22,60 @@ class SearchHandler(handlers.base.LoggedInRequestHandler):
   def get(self):
     """HTML GET handler.
     
-    Renders a response to a GET. Queries monsters to feature and renders
-    them to the index.html template. Does not accept any query parameters"""
+    Renders a page of the monsters matching the query in the q parameter,
+    starting at the one in the optional cursor parameter. See
+    data.searchquery for the query syntax."""
     
     template_values = self.build_template_values()
-    query = cgi.escape(self.request.get('q'))
+    query = self.request.get('q')
+    cursor = self.request.get('cursor') or None
     if query:
-      template_values['results'] = Monster.search(query)
+      template_values['query'] = query
+      template_values['results'], next_cursor, facets = Monster.search(
+        query, template_values[handlers.base.PROFILE_KEY], 
+        SEARCH_PAGE_SIZE, cursor)
+      template_values['facets'] = self.build_refinements(query, facets)
+      self.prefetch_votes(template_values['results'])
+      self.paginate(self.uri_for('search')+"?q="+urllib.quote(
+                      query.encode('utf-8')), 
+                    cursor, next_cursor)
       if len(template_values['results']) == 0:
         template_values['results'] = 1
    
     template = configuration.site.jinja_environment.get_template('search.html')
-    self.response.write(template.render(template_values))
\ No newline at end of file
+    self.response.write(template.render(template_values))
+    
+  def build_refinements(self, query, facets):
+    """Returns the refinement links for the facet counts of a search.
+    
+    Returns:
+      A list of (facet name, [(value, count, url)]) tuples, one for each facet
+      with matches, where url searches for query narrowed to the value."""
+    refinements = []
+    for name, values in facets.items():
+      links = [(value, count, self.uri_for('search') + "?q=" + urllib.quote(
+                 searchquery.refine(query, name, value).encode('utf-8')))
+               for value, count in values if count]
+      if links:
+        refinements.append((name, links))
+    return refinements
+
+
+class SuggestHandler(webapp2.RequestHandler):
+  """Completes monster names as they're typed into the search box.
+  
+  Writes a JSON list of {"id", "name", "url"} objects."""
+  
+  def get(self):
+    """HTML GET handler.
+    
+    Suggest monsters for the text in the q parameter."""
+    
+    profile = Profile.for_user(users.get_current_user())
+    suggestions = Monster.suggest(self.request.get('q'), profile)
+    self.response.headers['Content-Type'] = 'application/json'
+    self.response.write(json.dumps(
+      [{'id': monster_id, 
+        'name': name, 
+        'url': self.uri_for('monster', entity_id=monster_id)} 
+       for monster_id, name in suggestions]))
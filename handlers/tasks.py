@@ -0,0 +1,169 @@
+import webapp2
+from google.appengine.api import taskqueue
+from data.models import Monster, Product
+from data import deletion
+from data import exports
+from data import imports
+from data import indexing
+from data import leaderboards
+
+
+class FoldVotesHandler(webapp2.RequestHandler):
+  """Folds a monster's pending vote counts into the monster.
+  
+  Enqueued by data.counters.schedule_fold. Admin-only, see app.yaml."""
+  
+  def post(self):
+    """HTML POST handler.
+    
+    Fold the shards of the monster in the monster_id parameter."""
+    
+    Monster.fold_votes(int(self.request.get('monster_id')))
+
+
+class RebuildLeaderboardsHandler(webapp2.RequestHandler):
+  """Rebuilds the leaderboards from scratch.
+  
+  Incremental updates to a contended board can be dropped, so cron runs this
+  periodically (see cron.yaml). Admin-only, see app.yaml."""
+  
+  def get(self):
+    """HTML GET handler.
+    
+    Rebuild the public boards and enqueue a rebuild of each product's."""
+    
+    Monster.rebuild_leaderboards(-1)
+    for product_key in Product.all(keys_only=True):
+      taskqueue.add(url=self.request.path, 
+                    params={'product': product_key.id()})
+                    
+  def post(self):
+    """HTML POST handler.
+    
+    Rebuild the boards of the product in the product parameter."""
+    
+    Monster.rebuild_leaderboards(int(self.request.get('product')))
+
+
+class ApplyLeaderboardsHandler(webapp2.RequestHandler):
+  """Applies queued leaderboard updates in batches.
+  
+  Enqueued by data.leaderboards.schedule_apply. Admin-only, see app.yaml."""
+  
+  def post(self):
+    """HTML POST handler.
+    
+    Apply the queued updates, handing off to the next window's application
+    if they aren't all applied in time."""
+    
+    if not leaderboards.apply_pending():
+      leaderboards.schedule_apply()
+
+
+class DrainSearchIndexHandler(webapp2.RequestHandler):
+  """Applies pending search index updates in batches.
+  
+  Enqueued by data.indexing.schedule_drain. Admin-only, see app.yaml."""
+  
+  def post(self):
+    """HTML POST handler.
+    
+    Drain the queue, handing off to the next window's drain if it isn't
+    emptied in time. That drain is named, so a drain that keeps failing
+    can't start a chain of its own alongside it."""
+    
+    if not indexing.drain():
+      indexing.schedule_drain()
+
+
+class ReindexSliceHandler(webapp2.RequestHandler):
+  """Re-indexes one slice of a shard of a bulk re-index.
+  
+  Enqueued by data.indexing.start_reindex. Admin-only, see app.yaml."""
+  
+  def post(self):
+    """HTML POST handler.
+    
+    Re-index the slice parameter's slice of the shard in the job and shard
+    parameters."""
+    
+    slice_number = self.request.get('slice')
+    indexing.reindex_slice(self.request.get('job'), 
+                           int(self.request.get('shard')),
+                           int(slice_number) if slice_number else None)
+
+
+class BuildSearchSnapshotHandler(webapp2.RequestHandler):
+  """Rebuilds the snapshot searches fall back to, see
+  data.indexing.start_snapshot.
+  
+  Cron runs this periodically (see cron.yaml), and each slice of the rebuild
+  is a task for it. Admin-only, see app.yaml."""
+  
+  def get(self):
+    """HTML GET handler.
+    
+    Start the rebuild."""
+    
+    indexing.start_snapshot()
+    
+  def post(self):
+    """HTML POST handler.
+    
+    Snapshot the slice in the slice parameter of the job in the job
+    parameter."""
+    
+    indexing.snapshot_slice(self.request.get('job'), 
+                            int(self.request.get('slice')))
+
+
+class ImportUploadHandler(webapp2.RequestHandler):
+  """Imports the next part of an upload.
+  
+  Enqueued by data.imports.run_import. Admin-only, see app.yaml."""
+  
+  def post(self):
+    """HTML POST handler.
+    
+    Continue the import in the job parameter."""
+    
+    imports.run_import(self.request.get('job'))
+
+
+class ValidateUploadHandler(webapp2.RequestHandler):
+  """Validates the next part of an upload.
+  
+  Enqueued by data.imports.run_validation. Admin-only, see app.yaml."""
+  
+  def post(self):
+    """HTML POST handler.
+    
+    Continue validating the upload in the job parameter."""
+    
+    imports.run_validation(self.request.get('job'))
+
+
+class WriteExportHandler(webapp2.RequestHandler):
+  """Writes the next part of a background export.
+  
+  Enqueued by data.exports.start_export. Admin-only, see app.yaml."""
+  
+  def post(self):
+    """HTML POST handler.
+    
+    Continue the export in the job parameter."""
+    
+    exports.run_export(self.request.get('job'))
+
+
+class DeleteHandler(webapp2.RequestHandler):
+  """Deletes the next part of a large deletion.
+  
+  Enqueued by data.deletion. Admin-only, see app.yaml."""
+  
+  def post(self):
+    """HTML POST handler.
+    
+    Continue the deletion in the job parameter."""
+    
+    deletion.run_deletion(self.request.get('job'))
@@ -1,12 +1,22 @@
 #!/usr/bin/env python
 import configuration.site
+import data.counters
+import data.deletion
+import data.exports
+import data.identity
+import data.imports
+import data.indexing
+import data.leaderboards
 import jinja2
+import handlers.admin
 import handlers.auth
+import handlers.export
 import handlers.home
 import handlers.monster
 import handlers.product
 import handlers.profile
 import handlers.search
+import handlers.tasks
 import os
 import webapp2
 
@@ -15,8 +25,8 @@ configuration.site.jinja_environment = jinja2.Environment(
   loader=jinja2.FileSystemLoader(os.path.join(os.path.dirname(__file__), 
                                  "templates")))
 
-# Define the app
-app = webapp2.WSGIApplication([
+# Define the app. Each request gets its own identity map, see data.identity.
+app = data.identity.IdentityMapMiddleware(webapp2.WSGIApplication([
   webapp2.Route(r'/', handler=handlers.home.HomeHandler, name='home'),
   webapp2.Route(
     r'/monster', 
@@ -87,6 +97,10 @@ app = webapp2.WSGIApplication([
     r'/product/upload', 
     handler=handlers.product.UploadHandler, 
     name='product.upload'),
+  webapp2.Route(
+    r'/product/import/<job_id:[\w]+>', 
+    handler=handlers.product.ImportHandler, 
+    name='product.import'),
   webapp2.Route(
     r'/product/<entity_id:[\d\w%]+>', 
     handler=handlers.product.ViewHandler, 
@@ -95,12 +109,96 @@ app = webapp2.WSGIApplication([
     r'/product/<entity_id:[\d\w%]+>/update', 
     handler=handlers.product.UpdateHandler, 
     name='product.update'),
+  webapp2.Route(
+    r'/product/<entity_id:[\d\w%]+>/delete', 
+    handler=handlers.product.DeleteHandler, 
+    name='product.delete'),
   webapp2.Route(
     r'/search', 
     handler=handlers.search.SearchHandler, 
     name='search'),
+  webapp2.Route(
+    r'/search/suggest', 
+    handler=handlers.search.SuggestHandler, 
+    name='search.suggest'),
+  webapp2.Route(
+    r'/export/<scope:codex>.<export_format:xml|ndjson>', 
+    handler=handlers.export.ExportHandler, 
+    name='export.codex'),
+  webapp2.Route(
+    r'/export/<scope:product|creator>/<scope_id:[\d\w%]+>.<export_format:xml|ndjson>', 
+    handler=handlers.export.ExportHandler, 
+    name='export'),
+  webapp2.Route(
+    r'/export/jobs/<job_id:[\w]+>', 
+    handler=handlers.export.ExportJobHandler, 
+    name='export.job'),
+  webapp2.Route(
+    r'/export/jobs/<job_id:[\w]+>/<chunk:\d+>', 
+    handler=handlers.export.ExportJobHandler, 
+    name='export.job.chunk'),
   webapp2.Route(
     r'/publish', 
     handler=handlers.monster.ProductCreateHandler, 
-    name='publish')],
-  )
+    name='publish'),
+  webapp2.Route(
+    r'/admin/migrate/votes', 
+    handler=handlers.admin.RekeyVotesHandler, 
+    name='admin.migrate.votes'),
+  webapp2.Route(
+    r'/admin/migrate/profiles', 
+    handler=handlers.admin.RekeyProfilesHandler, 
+    name='admin.migrate.profiles'),
+  webapp2.Route(
+    r'/admin/stats', 
+    handler=handlers.admin.StatsHandler, 
+    name='admin.stats'),
+  webapp2.Route(
+    r'/admin/reindex', 
+    handler=handlers.admin.ReindexHandler, 
+    name='admin.reindex'),
+  webapp2.Route(
+    r'/admin/benchmark/import', 
+    handler=handlers.admin.ImportBenchmarkHandler, 
+    name='admin.benchmark.import'),
+  webapp2.Route(
+    data.counters.FOLD_URL, 
+    handler=handlers.tasks.FoldVotesHandler, 
+    name='tasks.fold_votes'),
+  webapp2.Route(
+    r'/tasks/leaderboards/rebuild', 
+    handler=handlers.tasks.RebuildLeaderboardsHandler, 
+    name='tasks.leaderboards.rebuild'),
+  webapp2.Route(
+    data.leaderboards.APPLY_URL, 
+    handler=handlers.tasks.ApplyLeaderboardsHandler, 
+    name='tasks.leaderboards.apply'),
+  webapp2.Route(
+    data.indexing.DRAIN_URL, 
+    handler=handlers.tasks.DrainSearchIndexHandler, 
+    name='tasks.search_index.drain'),
+  webapp2.Route(
+    data.indexing.REINDEX_URL, 
+    handler=handlers.tasks.ReindexSliceHandler, 
+    name='tasks.search_index.reindex'),
+  webapp2.Route(
+    data.indexing.SNAPSHOT_URL, 
+    handler=handlers.tasks.BuildSearchSnapshotHandler, 
+    name='tasks.search_index.snapshot'),
+  webapp2.Route(
+    data.imports.IMPORT_URL, 
+    handler=handlers.tasks.ImportUploadHandler, 
+    name='tasks.import'),
+  webapp2.Route(
+    data.imports.VALIDATE_URL, 
+    handler=handlers.tasks.ValidateUploadHandler, 
+    name='tasks.import.validate'),
+  webapp2.Route(
+    data.exports.EXPORT_URL, 
+    handler=handlers.tasks.WriteExportHandler, 
+    name='tasks.export'),
+  webapp2.Route(
+    data.deletion.DELETE_URL, 
+    handler=handlers.tasks.DeleteHandler, 
+    name='tasks.delete')],
+  ))
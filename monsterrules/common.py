@@ -1,5 +1,5 @@
 import datetime
-from collections import OrderedDict
+from collections import OrderedDict, namedtuple
 
 
 class Option(object):
@@ -114,24 +114,202 @@ def Required(func):
   func.required = True
   return func
 
+
+class RegisteredQuestion(namedtuple('RegisteredQuestion',
+                                     'question field options')):
+  """A question in a QuestionRegistry.
+  
+  Attributes:
+    question: the question method, as decorated with @Question.
+    field: the name of the form field that answers it. Checkboxes of an
+      ExpectsMultiple question are named after it, see RegisteredOption.
+    options: a tuple of RegisteredOptions, empty unless the question expects
+      one or multiple of its options."""
+  __slots__ = ()
+
+
+class RegisteredOption(namedtuple('RegisteredOption',
+                                  'label option value field subquestions')):
+  """An option of a question in a QuestionRegistry.
+  
+  Attributes:
+    label: the text presented to the user.
+    option: the Option.
+    value: the form value that selects it, its index as a string.
+    field: the name of the form field that selects it: a checkbox of its own
+      for ExpectsMultiple questions, or the question's radio buttons.
+    subquestions: a tuple of RegisteredQuestions for the option's
+      subquestions, whose fields are prefixed with "<field>.<value>-"."""
+  __slots__ = ()
+
+
+def _register(question, context=""):
+  """Returns the RegisteredQuestion for question and its subquestions."""
+  field = context + str(question.order)
+  options = []
+  for index, (label, option) in enumerate(
+      getattr(question, 'options', {}).items()):
+    value = str(index)
+    option_field = field
+    if hasattr(question, 'expectsMultiple'):
+      option_field = field + "." + value
+    subquestions = tuple(
+      _register(subquestion, field + "." + value + "-")
+      for order, subquestion in sorted(option.subquestions.items()))
+    options.append(RegisteredOption(label, option, value, option_field,
+                                    subquestions))
+  return RegisteredQuestion(question, field, tuple(options))
+
+
+class QuestionRegistry(object):
+  """The questions of a MonsterBuilder class, resolved once.
+  
+  Attributes:
+    questions: a tuple of RegisteredQuestions for the top-level questions, in
+      order."""
+  
+  def __init__(self, builder_class):
+    questions = []
+    for name in dir(builder_class):
+      attribute = getattr(builder_class, name)
+      if callable(attribute) and hasattr(attribute, 'is_question'):
+        questions.append(attribute)
+    questions.sort(key=lambda question: question.order)
+    self.questions = tuple(_register(question) for question in questions)
+    self._by_field = dict((entry.field, entry) for entry in self.walk())
+    
+  def walk(self):
+    """Yields every RegisteredQuestion, each followed by its options'
+    subquestions, depth first."""
+    stack = list(reversed(self.questions))
+    while stack:
+      entry = stack.pop()
+      yield entry
+      for option in reversed(entry.options):
+        stack.extend(reversed(option.subquestions))
+        
+  def get(self, field):
+    """Returns the RegisteredQuestion answered by a form field, or None."""
+    return self._by_field.get(field)
+
+
+class AnswerStep(namedtuple('AnswerStep',
+                             'rank field question option choices parent')):
+  """A form field of an AnswerPlan and how to apply its answer.
+  
+  Attributes:
+    rank: the step's position in the plan; answers are applied in rank order.
+    field: the name of the form field.
+    question: the question method the field answers.
+    option: for an ExpectsMultiple option's checkbox, the Option it selects.
+    choices: for an ExpectsOne question's radio buttons, a dict of each
+      value to the Option it selects.
+    parent: None for top-level questions. For subquestions, the (field,
+      value) of the option they belong to, value being None for a
+      checkbox."""
+  __slots__ = ()
+
+
+def _plan(entry, parent, steps):
+  """Appends the AnswerSteps for a RegisteredQuestion and its subquestions
+  to steps."""
+  question = entry.question
+  if hasattr(question, 'expectsMultiple'):
+    for option in entry.options:
+      steps.append(AnswerStep(len(steps), option.field, question,
+                              option.option, None, parent))
+      for subquestion in option.subquestions:
+        _plan(subquestion, (option.field, None), steps)
+  elif hasattr(question, 'expectsOne'):
+    choices = dict((option.value, option.option) for option in entry.options)
+    steps.append(AnswerStep(len(steps), entry.field, question, None, choices,
+                            parent))
+    for option in entry.options:
+      for subquestion in option.subquestions:
+        _plan(subquestion, (entry.field, option.value), steps)
+  else:
+    steps.append(AnswerStep(len(steps), entry.field, question, None, None,
+                            parent))
+
+
+class AnswerPlan(object):
+  """A flat table of every form field of a MonsterBuilder's questions,
+  compiled from its QuestionRegistry.
+  
+  Attributes:
+    steps: a tuple of AnswerSteps, in the order answers are applied: each
+      question, then its options in order, each followed by its
+      subquestions."""
+  
+  def __init__(self, registry):
+    steps = []
+    for entry in registry.questions:
+      _plan(entry, None, steps)
+    self.steps = tuple(steps)
+    self._by_field = dict((step.field, step) for step in self.steps)
+    
+  def apply(self, builder, fields):
+    """Answers a builder's questions with the fields of a submitted form.
+    
+    Blank fields, fields that aren't in the plan and all but the first of a
+    repeated field are ignored, as are subquestions of options that weren't
+    selected.
+    
+    Args:
+      builder: the MonsterBuilder instance.
+      fields: (name, value) pairs of the submitted form."""
+    answers = {}
+    for field, value in fields:
+      if value and field in self._by_field and field not in answers:
+        answers[field] = value
+    
+    applied = {}
+    for step in sorted((self._by_field[field] for field in answers),
+                       key=lambda step: step.rank):
+      if step.parent:
+        parent_field, parent_value = step.parent
+        if (parent_field not in applied or
+            parent_value not in (None, applied[parent_field])):
+          continue
+      value = answers[step.field]
+      if step.choices is not None:
+        if value not in step.choices:
+          continue
+        step.question(builder, step.choices[value].value)
+      elif step.option:
+        step.question(builder, step.option.value)
+      else:
+        step.question(builder, value)
+      applied[step.field] = value
+
+
+class MonsterBuilderType(type):
+  """Metaclass of MonsterBuilder, which registers each builder class's
+  questions and compiles its AnswerPlan when the class is defined."""
+  
+  def __init__(cls, name, bases, attributes):
+    super(MonsterBuilderType, cls).__init__(name, bases, attributes)
+    cls.registry = QuestionRegistry(cls)
+    cls.answer_plan = AnswerPlan(cls.registry)
+
+
 class MonsterBuilder(object):
   """Common case class for monster building rules.
   
   A subclass of MonsterBuilder is a set of rules for building a monster. It
   contains one or more methods decorated with the @Question annotation. When
   the monster is created each of these of these methods will be called if the
-  user has answered it."""
+  user has answered it.
+  
+  Each class's questions are found once, when it's defined, and kept in its
+  registry attribute. Its answer_plan applies a submitted form's answers."""
+  __metaclass__ = MonsterBuilderType
   
   # Questions to answer
   @classmethod
-  def questions(self):
-    """Returns all top-level questions of this builder."""
-    questions = sorted([getattr(self, method)
-          for method in dir(self) 
-          if (callable(getattr(self, method)) and hasattr(getattr(self, method), 'is_question'))],
-          key=lambda question: question.order);
-          
-    return questions
+  def questions(cls):
+    """Returns all top-level questions of this builder, in order."""
+    return [entry.question for entry in cls.registry.questions]
     
     
 class DiceBuilder(object):
@@ -127,7 +127,36 @@ class CoreMonsterBuilder(MonsterBuilder):
       self.damage.IncreaseDieSize()
     for i in xrange(0, delta.die_size_decreases):
       self.damage.DecreaseDieSize()
-  
+
+  # Vocabulary
+  @classmethod
+  def tag_vocabulary(cls):
+    """Returns the tags that the options' deltas can add.
+
+    Returns:
+      An OrderedDict mapping 'tag' and 'damage_tag' to every tag and damage
+      tag an option can add, and 'organization' and 'size' to the tags added
+      by the answers to those questions. Tags are in option order."""
+    def option_tags(options, attribute):
+      tags = []
+      for option in options:
+        for tag in getattr(option.value, attribute):
+          if tag not in tags:
+            tags.append(tag)
+      return tags
+
+    all_options = []
+    for question in cls.questions():
+      if hasattr(question, 'options'):
+        all_options.extend(question.options.values())
+    return OrderedDict([
+      ('tag', option_tags(all_options, 'tags_to_add')),
+      ('damage_tag', option_tags(all_options, 'damage_tags_to_add')),
+      ('organization', option_tags(cls.organizationOptions.values(), 
+                                   'tags_to_add')),
+      ('size', option_tags(cls.sizeOptions.values(), 'tags_to_add')),
+    ])
+
   # Questions
   @Question(0)
   @Prompt("What is it called?")
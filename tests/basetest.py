@@ -1,6 +1,8 @@
+import os
 import unittest
 from google.appengine.ext import db
 from google.appengine.ext import testbed
+from google.appengine.datastore import datastore_stub_util
 from google.appengine.api import users
 
 
@@ -11,8 +13,15 @@ class BaseTestCase(unittest.TestCase):
     
     self.testbed.activate()
     
-    self.testbed.init_datastore_v3_stub()
+    # Cross-group transactions need the High Replication datastore.
+    self.policy = datastore_stub_util.PseudoRandomHRConsistencyPolicy(
+      probability=1)
+    self.testbed.init_datastore_v3_stub(consistency_policy=self.policy)
     self.testbed.init_user_stub()
+    self.testbed.init_memcache_stub()
+    # Loads queue.yaml, for the search-index pull queue.
+    self.testbed.init_taskqueue_stub(
+      root_path=os.path.join(os.path.dirname(__file__), '..'))
     
   def tearDown(self):
     self.testbed.deactivate()
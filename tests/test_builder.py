@@ -0,0 +1,73 @@
+import unittest
+import basetest
+from monsterrules.common import MonsterBuilder, Question, ExpectsShortText
+from monsterrules.core.builder import CoreMonsterBuilder
+
+
+class QuestionRegistryTestCase(unittest.TestCase):
+
+  def test_questions_in_order(self):
+    questions = CoreMonsterBuilder.questions()
+    self.assertEqual([question.order for question in questions],
+                     [0, 1, 2, 3, 4, 5, 6, 7, 8, 9, 11])
+    self.assertEqual(
+      [entry.field for entry in CoreMonsterBuilder.registry.questions],
+      [str(question.order) for question in questions])
+
+  def test_subquestion_fields(self):
+    registry = CoreMonsterBuilder.registry
+    reputation = registry.get("6")
+    adaptation = reputation.options[6]
+    self.assertEqual(adaptation.label, "A useful adaptation")
+    self.assertEqual(adaptation.field, "6.6")
+    self.assertEqual([entry.field for entry in adaptation.subquestions],
+                     ["6.6-1"])
+    self.assertTrue(registry.get("6.6-1") is adaptation.subquestions[0])
+    organization = registry.get("3")
+    self.assertEqual(set(option.field for option in organization.options),
+                     set(["3"]))
+    self.assertEqual(registry.get("nonsense"), None)
+
+  def test_subclasses_are_registered(self):
+    class ExtendedBuilder(CoreMonsterBuilder):
+      @Question(12)
+      @ExpectsShortText
+      def epithet(self, value):
+        pass
+
+    self.assertEqual(ExtendedBuilder.questions()[-1].order, 12)
+    self.assertEqual(len(ExtendedBuilder.questions()),
+                     len(CoreMonsterBuilder.questions()) + 1)
+    self.assertEqual(MonsterBuilder.questions(), [])
+
+
+class AnswerPlanTestCase(basetest.BaseTestCase):
+
+  def test_applies_answers_in_question_order(self):
+    builder = CoreMonsterBuilder()
+    CoreMonsterBuilder.answer_plan.apply(builder, [
+      ("6.6-1", "Slimy"),
+      ("6.5-1", "Sneaks up"),
+      ("6.6", "1"),
+      ("0", "Goblin"),
+      ("1", "Stabs"),
+      ("3", "0"),
+      ("4", "99"),
+      ("11", ""),
+      ("license", "cc-by"),
+    ])
+    monster = builder.Build()
+    self.assertEqual(monster.name, "Goblin")
+    self.assertEqual(monster.moves, ["Stabs"])
+    self.assertEqual(monster.special_qualities, ["Slimy"])
+    self.assertEqual(monster.tags, ["Horde"])
+    self.assertEqual(monster.description, None)
+
+  def test_plan_covers_every_field(self):
+    plan = CoreMonsterBuilder.answer_plan
+    self.assertEqual(
+      sorted(step.field for step in plan.steps if step.option is None),
+      sorted(entry.field for entry in CoreMonsterBuilder.registry.walk()
+             if not hasattr(entry.question, 'expectsMultiple')))
+    self.assertEqual([step.rank for step in plan.steps],
+                     range(len(plan.steps)))
@@ -0,0 +1,71 @@
+from data import deletion
+from data.models import Monster, Product, Profile, Vote
+import basetest
+
+
+class DeletionTestCase(basetest.BaseTestCase):
+
+  def setUp(self):
+    super(DeletionTestCase, self).setUp()
+    self.batch_size = deletion.BATCH_SIZE
+    self.inline_steps = deletion.INLINE_STEPS
+    
+  def tearDown(self):
+    deletion.BATCH_SIZE = self.batch_size
+    deletion.INLINE_STEPS = self.inline_steps
+    super(DeletionTestCase, self).tearDown()
+    
+  def make_monster(self, name, product=-1, votes=0):
+    monster = Monster(name=name, product=product)
+    monster.put_unsearchable()
+    for i in xrange(votes):
+      voter = Profile(key_name="voter%d" % i)
+      voter.put()
+      Vote.cast(voter, monster, True)
+    return monster
+
+  def test_deletes_small_monster_inline(self):
+    monster = self.make_monster("Goblin", votes=3)
+    kept = self.make_monster("Orc", votes=1)
+    
+    self.assertEqual(monster.delete(), None)
+    
+    self.assertEqual(Monster.get_by_id(monster.key().id()), None)
+    self.assertEqual(Vote.all().count(), 1)
+    self.assertTrue(Monster.get_by_id(kept.key().id()))
+    self.assertEqual(deletion.DeletionJob.all().count(), 0)
+    
+  def test_finishes_large_deletion_in_tasks(self):
+    deletion.BATCH_SIZE = 2
+    deletion.INLINE_STEPS = 1
+    monster = self.make_monster("Dragon", votes=5)
+    
+    job = monster.delete()
+    
+    self.assertTrue(job)
+    self.assertTrue(Monster.get_by_id(monster.key().id()))
+    # The inline batch is checkpointed before the request returns.
+    self.assertEqual(
+      deletion.DeletionJob.get_by_key_name(job.key().name()).votes, 2)
+    deletion.run_deletion(job.key().name())
+    job = deletion.DeletionJob.get_by_key_name(job.key().name())
+    self.assertTrue(job.done)
+    self.assertEqual(job.votes, 5)
+    self.assertEqual(Monster.get_by_id(monster.key().id()), None)
+    self.assertEqual(Vote.all().count(), 0)
+    
+  def test_deletes_product(self):
+    product = Product(name="Bestiary")
+    product.put()
+    product_id = product.key().id()
+    owner = Profile(key_name="owner", products=[-1, product_id])
+    owner.put()
+    for i in xrange(3):
+      self.make_monster("Monster %d" % i, product=product_id, votes=1)
+    self.make_monster("Public")
+    
+    self.assertEqual(deletion.delete_product(product), None)
+    
+    self.assertEqual(Product.get_by_id(product_id), None)
+    self.assertEqual([monster.name for monster in Monster.all()], ["Public"])
+    self.assertEqual(Profile.get_by_key_name("owner").products, [-1])
@@ -0,0 +1,89 @@
+import StringIO
+import json
+from data import exports
+from data import imports
+from data.models import Monster, Profile
+import basetest
+
+
+class ExportTestCase(basetest.BaseTestCase):
+
+  def setUp(self):
+    super(ExportTestCase, self).setUp()
+    self.profile = Profile(key_name="creator")
+    self.profile.put()
+    
+  def make_monster(self, name, product=-1):
+    monster = Monster(name=name, product=product, creator=self.profile, 
+                      hp="6", armor="1", damage="d8", instinct=u"To h\xfcnt",
+                      tags=["Solitary", "Large"], moves=["Roar", "Bite"])
+    monster.put_unsearchable()
+    return monster
+    
+  def export(self, query, export_format):
+    return "".join(exports.iter_export(query, export_format))
+
+  def test_xml_export_reimports(self):
+    original = self.make_monster("Owlbear")
+    
+    output = self.export(exports.build_query(exports.CODEX), exports.XML)
+    
+    records = list(imports.iter_records(StringIO.StringIO(output), 
+                                        imports.XML))
+    self.assertEqual(len(records), 1)
+    monster = imports.monster_from_record(records[0], -1, self.profile)
+    for field in ('name', 'hp', 'armor', 'damage', 'instinct', 'tags', 
+                  'moves', 'special_qualities'):
+      self.assertEqual(getattr(monster, field), getattr(original, field))
+      
+  def test_ndjson_export_reimports(self):
+    original = self.make_monster("Owlbear")
+    
+    output = self.export(exports.build_query(exports.CODEX), exports.NDJSON)
+    
+    record = next(imports.iter_records(StringIO.StringIO(output), 
+                                       imports.NDJSON))
+    monster = imports.monster_from_record(record, -1, self.profile)
+    self.assertEqual(monster.instinct, original.instinct)
+    self.assertEqual(monster.tags, original.tags)
+    
+  def test_ndjson_export_has_a_line_per_monster(self):
+    for i in xrange(exports.BATCH_SIZE + 3):
+      self.make_monster("Monster %d" % i)
+    
+    output = self.export(exports.build_query(exports.CODEX), exports.NDJSON)
+    
+    names = [json.loads(line)['name'] for line in output.splitlines()]
+    self.assertEqual(len(names), exports.BATCH_SIZE + 3)
+    self.assertEqual(len(set(names)), exports.BATCH_SIZE + 3)
+    
+  def test_creator_export_hides_products_from_others(self):
+    self.make_monster("Public")
+    self.make_monster("Private", product=7)
+    
+    def names(user):
+      query = exports.build_query(exports.CREATOR, "creator", user)
+      return sorted(json.loads(line)['name'] for line in 
+                    self.export(query, exports.NDJSON).splitlines())
+    
+    self.assertEqual(names(None), ["Public"])
+    self.assertEqual(names(self.profile), ["Private", "Public"])
+    
+  def test_background_export_matches_streamed_export(self):
+    for i in xrange(exports.BATCH_SIZE * 2 + 3):
+      self.make_monster("Monster %d" % i)
+    chunk_size = exports.CHUNK_SIZE
+    exports.CHUNK_SIZE = 1
+    try:
+      job = exports.start_export(exports.CODEX, None, exports.XML, self.profile)
+      while not job.done:
+        job = exports.write_chunk(job)
+    finally:
+      exports.CHUNK_SIZE = chunk_size
+      
+    self.assertEqual(job.chunks, 3)
+    self.assertEqual(job.records, exports.BATCH_SIZE * 2 + 3)
+    self.assertEqual(
+      "".join(job.get_chunk(index) for index in xrange(job.chunks)),
+      self.export(exports.build_query(exports.CODEX), exports.XML))
+    self.assertEqual(job.get_chunk(job.chunks), None)
@@ -0,0 +1,209 @@
+import StringIO
+from data import imports
+from data import leaderboards
+from data.models import Monster, Profile
+import basetest
+
+
+MONSTER = ("<monster><name>%s</name><hp>3</hp><armor>1</armor>"
+           "<damage>d6</damage><instinct>To eat</instinct>"
+           "<tags><tag>%s</tag></tags><moves><move>Bite</move></moves>"
+           "</monster>")
+
+
+def make_upload(count):
+  monsters = "".join(MONSTER % ("Monster %d" % i, "Horde") 
+                     for i in xrange(count))
+  return "<product><monsters>%s</monsters></product>" % monsters
+
+
+class ImportTestCase(basetest.BaseTestCase):
+
+  def setUp(self):
+    super(ImportTestCase, self).setUp()
+    self.profile = Profile()
+    self.profile.put()
+    
+  def make_job(self):
+    job = imports.ImportJob(key_name="job", product=7, creator=self.profile,
+                            validated=True, started=True)
+    job.put()
+    return job
+
+  def test_iter_monsters_clears_parsed_elements(self):
+    seen = []
+    for element in imports.iter_monsters(StringIO.StringIO(make_upload(3))):
+      seen.append(element)
+      self.assertEqual(element.findtext('name'), "Monster %d" % (len(seen) - 1))
+    self.assertTrue(all(len(element) == 0 for element in seen))
+    
+  def test_maps_records_to_monsters(self):
+    record = next(imports.iter_records(StringIO.StringIO(make_upload(1)), 
+                                       imports.XML))
+    monster = imports.monster_from_record(record, -1, self.profile)
+    self.assertTrue(monster.is_core)
+    self.assertEqual(monster.name, "Monster 0")
+    self.assertEqual(monster.tags, ["Horde"])
+    self.assertEqual(monster.moves, ["Bite"])
+    self.assertEqual(monster.special_qualities, [])
+    
+  def test_normalizes_tags(self):
+    upload = MONSTER % ("Goblin", "  hoRDe ")
+    record = next(imports.iter_records(StringIO.StringIO(upload), imports.XML))
+    monster = imports.monster_from_record(record, 7, self.profile)
+    self.assertEqual(monster.tags, ["Horde"])
+    
+  def test_validates_clean_upload(self):
+    report = imports.validate(StringIO.StringIO(make_upload(3)), 7)
+    
+    self.assertTrue(report['ok'])
+    self.assertEqual(report['records'], 3)
+    self.assertEqual(report['problems'], [])
+    self.assertEqual(Monster.all().count(), 0)
+    
+  def test_reports_problems_per_record(self):
+    existing = Monster(name="Dragon", product=7)
+    existing.put_unsearchable()
+    upload = "<monsters>%s%s%s%s</monsters>" % (
+      MONSTER % ("Goblin", " horde"),
+      "<monster><name>Orc</name></monster>",
+      MONSTER % ("goblin", "Horde"),
+      MONSTER % ("Dragon", "Solitary"))
+    
+    report = imports.validate(StringIO.StringIO(upload), 7)
+    
+    self.assertFalse(report['ok'])
+    self.assertEqual(report['records'], 4)
+    problems = dict((problem['record'], problem) 
+                    for problem in report['problems'])
+    self.assertEqual(problems[1]['errors'], [])
+    self.assertEqual(len(problems[1]['warnings']), 1)
+    self.assertEqual(len(problems[2]['errors']), 5)
+    self.assertEqual(problems[3]['errors'], ["Same name as record 1"])
+    self.assertEqual(problems[4]['errors'], ["Already in the product"])
+    
+  def test_validation_resumes_from_checkpoint(self):
+    upload = "<monsters>%s%s%s</monsters>" % (
+      MONSTER % ("Goblin", "Horde"),
+      MONSTER % ("Orc", "Horde"),
+      MONSTER % ("goblin", "Horde"))
+    report = imports.new_report(imports.XML)
+    seen = {}
+    
+    # Each call checks at least one record before the deadline stops it.
+    self.assertFalse(imports.check_records(
+      report, seen, set(), StringIO.StringIO(upload), 0))
+    self.assertEqual(report['records'], 1)
+    
+    job = self.make_job()
+    job.set_seen(seen)
+    seen = job.get_seen()
+    while not imports.check_records(report, seen, set(), 
+                                    StringIO.StringIO(upload), 0):
+      pass
+    
+    self.assertEqual(report['records'], 3)
+    self.assertFalse(report['ok'])
+    self.assertEqual(report['problems'][0]['errors'], 
+                     ["Same name as record 1"])
+    
+  def test_reports_malformed_xml(self):
+    upload = make_upload(2)[:-40]
+    
+    report = imports.validate(StringIO.StringIO(upload), 7)
+    
+    self.assertFalse(report['ok'])
+    self.assertEqual(report['records'], 1)
+    self.assertTrue(report['parse_error'])
+    
+  def test_formats_read_the_same_records(self):
+    records = list(imports.iter_records(StringIO.StringIO(make_upload(3)), 
+                                        imports.XML))
+    for import_format in (imports.CSV, imports.NDJSON):
+      upload = imports.encode_records(records, import_format)
+      self.assertEqual(
+        list(imports.iter_records(StringIO.StringIO(upload), import_format)),
+        records)
+        
+  def test_csv_cells_hold_lists(self):
+    upload = ('name,hp,armor,damage,instinct,tags,moves,notes\r\n'
+              'Goblin,3,1,d6,To steal,"horde, Small","Bite\nFlee",x\r\n')
+    
+    report = imports.validate(StringIO.StringIO(upload), 7, imports.CSV)
+    record = next(imports.iter_records(StringIO.StringIO(upload), imports.CSV))
+    monster = imports.monster_from_record(record, 7, self.profile)
+    
+    self.assertTrue(report['ok'])
+    self.assertEqual(monster.tags, ["Horde", "Small"])
+    self.assertEqual(monster.moves, ["Bite", "Flee"])
+    
+  def test_reports_bad_ndjson_line(self):
+    upload = imports.encode_records(
+      list(imports.iter_records(StringIO.StringIO(make_upload(2)), 
+                                imports.XML)), imports.NDJSON) + "{oops\n"
+    
+    report = imports.validate(StringIO.StringIO(upload), 7, imports.NDJSON)
+    
+    self.assertFalse(report['ok'])
+    self.assertEqual(report['records'], 2)
+    self.assertTrue(report['parse_error'].startswith("Line 3"))
+    
+  def test_benchmark_times_every_format(self):
+    results = imports.benchmark(10)
+    self.assertEqual(sorted(results['formats']),
+                     sorted([imports.XML, imports.CSV, imports.NDJSON]))
+    self.assertFalse(results['includes_writes'])
+    
+  def test_starts_import_once(self):
+    job = self.make_job()
+    job.started = False
+    job.put()
+    stale = imports.ImportJob.get_by_key_name("job")
+    
+    self.assertTrue(imports.start_import(job, 0).started)
+    imports.start_import(stale, 0)
+    
+    tasks = self.testbed.get_stub(basetest.testbed.TASKQUEUE_SERVICE_NAME)
+    self.assertEqual(len(tasks.get_filtered_tasks(url=imports.IMPORT_URL)), 1)
+    
+  def test_imports_in_batches(self):
+    job = self.make_job()
+    count = imports.BATCH_SIZE + 5
+    
+    self.assertTrue(imports.import_records(
+      job, StringIO.StringIO(make_upload(count)), float('inf')))
+    
+    self.assertEqual(job.records, count)
+    self.assertTrue(job.done)
+    self.assertEqual(Monster.all().filter('product =', 7).count(), count)
+    board = leaderboards.get_entries(leaderboards.RECENT, [7])[7]
+    self.assertEqual(len(board), leaderboards.BOARD_SIZE)
+    
+  def test_retried_batch_overwrites_its_monsters(self):
+    job = self.make_job()
+    count = imports.BATCH_SIZE * 2 + 5
+    
+    # Stop after the first batch, as if the task ran out of time.
+    self.assertFalse(imports.import_records(
+      job, StringIO.StringIO(make_upload(count)), 0))
+    self.assertEqual(job.records, imports.BATCH_SIZE)
+    
+    # Then fail after writing the second batch, before checkpointing it.
+    def crash(monsters):
+      put_multi(monsters)
+      raise RuntimeError()
+    put_multi = Monster.put_multi
+    Monster.put_multi = staticmethod(crash)
+    try:
+      self.assertRaises(RuntimeError, imports.import_records, job, 
+                        StringIO.StringIO(make_upload(count)), float('inf'))
+    finally:
+      Monster.put_multi = staticmethod(put_multi)
+    
+    job = imports.ImportJob.get_by_key_name("job")
+    self.assertTrue(imports.import_records(
+      job, StringIO.StringIO(make_upload(count)), float('inf')))
+    
+    names = [monster.name for monster in Monster.all().filter('product =', 7)]
+    self.assertEqual(len(names), count)
+    self.assertEqual(len(set(names)), count)
@@ -0,0 +1,71 @@
+import unittest
+from data import localsearch
+from data import searchquery
+
+
+class LocalIndexTestCase(unittest.TestCase):
+
+  def setUp(self):
+    self.index = localsearch.LocalIndex()
+    self.index.add("1", "Goblin goblin goblin horde", [('tag', "horde")], 
+                   {'hp_value': 3}, {'name': "Goblin"})
+    self.index.add("2", "Goblin king, a solitary goblin", 
+                   [('tag', "solitary")], {'hp_value': 12}, 
+                   {'name': "Goblin King"})
+    self.index.add("3", "Dragon", [('tag', "solitary")], {'hp_value': 16}, 
+                   {'name': "Dragon"})
+    
+  def search(self, text, **kwargs):
+    hits, total, _ = self.index.search(searchquery.parse(text), **kwargs)
+    return [doc_id for doc_id, fields in hits]
+    
+  def test_ranks_by_bm25(self):
+    self.assertEqual(self.search("goblin"), ["1", "2"])
+    self.assertEqual(self.search("goblin king"), ["2"])
+    
+  def test_filters_and_sorts(self):
+    self.assertEqual(self.search("tag:solitary sort:hp:asc"), ["2", "3"])
+    self.assertEqual(self.search("hp>=10 sort:hp"), ["3", "2"])
+    self.assertEqual(self.search("sort:hp", limit=1, offset=1), ["2"])
+    
+  def test_delete_and_replace(self):
+    self.index.delete(["1"])
+    self.index.add("3", "Goblin dragon", [], {}, {})
+    self.assertEqual(sorted(self.search("goblin")), ["2", "3"])
+    self.assertEqual(self.search("tag:solitary"), ["2"])
+    
+  def test_snapshot_round_trip(self):
+    self.index.delete(["2"])
+    restored = localsearch.LocalIndex.loads(self.index.dumps())
+    self.assertEqual(len(restored), 2)
+    hits, total, _ = restored.search(searchquery.parse("goblin"))
+    self.assertEqual(hits, [("1", {'name': "Goblin"})])
+    self.assertEqual(
+      [doc_id for doc_id, fields in 
+       restored.search(searchquery.parse("hp>=10"))[0]], ["3"])
+    
+  def test_concat_snapshots(self):
+    other = localsearch.LocalIndex()
+    other.add("4", "Goblin shaman", [('tag', "horde")], {'hp_value': 6}, 
+              {'name': "Goblin Shaman"})
+    restored = localsearch.LocalIndex.loads(localsearch.LocalIndex.concat(
+      [self.index.dumps(), other.dumps()]))
+    self.assertEqual(len(restored), 4)
+    self.index.add("4", "Goblin shaman", [('tag', "horde")], {'hp_value': 6}, 
+                   {'name': "Goblin Shaman"})
+    for text in ["goblin", "tag:horde sort:hp"]:
+      self.assertEqual(restored.search(searchquery.parse(text)), 
+                       self.index.search(searchquery.parse(text)))
+    
+  def test_ranks_only_text_fields(self):
+    from google.appengine.api import search
+    index = localsearch.LocalIndex(text_fields=['stats'])
+    index.put(search.Document(doc_id="1", fields=[
+      search.TextField(name='stats', value="Goblin horde"),
+      search.TextField(name='name', value="Goblin")]))
+    
+    self.assertEqual(index._total_length, 2)
+    hits, total, _ = index.search(searchquery.parse("goblin"))
+    self.assertEqual(hits, [("1", {'stats': "Goblin horde", 
+                                   'name': "Goblin"})])
+    self.assertEqual(index.search(searchquery.parse("name"))[1], 0)
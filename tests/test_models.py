@@ -0,0 +1,499 @@
+import unittest
+from google.appengine.api import apiproxy_stub_map
+from google.appengine.api import search
+from google.appengine.api import users
+from data import generations
+from data import identity
+from data import indexing
+from data import leaderboards
+from data import localsearch
+from data import nameindex
+from data import searchcache
+from data import searchquery
+from data.models import Monster, Product, Profile, Vote, _MONSTER_INDEX
+from data.models import _SEARCHED_FIELDS
+import basetest
+
+
+class GetRecentTestCase(basetest.BaseTestCase):
+
+  def make_monster(self, name, product=-1):
+    monster = Monster()
+    monster.name = name
+    monster.product = product
+    monster.put_unsearchable()
+    return monster
+
+  def test_hides_product_monsters(self):
+    self.make_monster("Public")
+    self.make_monster("Private", product=7)
+    
+    names = [monster.name for monster in Monster.get_recent(10)]
+    self.assertEqual(names, ["Public"])
+    
+  def test_shows_owned_product_monsters(self):
+    self.make_monster("Private", product=7)
+    profile = Profile()
+    profile.products = [-1, 7]
+    
+    names = [monster.name for monster in Monster.get_recent(10, user=profile)]
+    self.assertEqual(names, ["Private"])
+    
+  def test_pages_follow_cursors(self):
+    for i in xrange(25):
+      self.make_monster("Monster %d" % i)
+    self.make_monster("Private", product=7)
+      
+    seen = []
+    monsters, cursor = Monster.get_recent_page(10)
+    while cursor:
+      seen.extend(monsters)
+      monsters, cursor = Monster.get_recent_page(10, cursor=cursor)
+    seen.extend(monsters)
+    
+    self.assertEqual(len(seen), 25)
+    self.assertEqual(len(set(monster.key() for monster in seen)), 25)
+    
+  def test_full_last_page_has_no_cursor(self):
+    for i in xrange(20):
+      self.make_monster("Monster %d" % i)
+      
+    monsters, cursor = Monster.get_recent_page(10)
+    self.assertTrue(cursor)
+    monsters, cursor = Monster.get_recent_page(10, cursor=cursor)
+    self.assertEqual(len(monsters), 10)
+    self.assertEqual(cursor, None)
+    
+  def test_delete_invalidates_cached_pages(self):
+    self.make_monster("Kept")
+    doomed = self.make_monster("Deleted")
+    self.assertEqual(len(Monster.get_recent_public()[0]), 2)
+    self.assertEqual(len(Monster.get_recent(10)), 2)
+    
+    doomed.delete()
+    
+    self.assertEqual(len(Monster.get_recent_public()[0]), 1)
+    self.assertEqual(len(Monster.get_recent(10)), 1)
+
+
+class VoteTestCase(basetest.BaseTestCase):
+
+  def setUp(self):
+    super(VoteTestCase, self).setUp()
+    self.profile = Profile()
+    self.profile.put()
+    self.monster = Monster()
+    self.monster.put_unsearchable()
+    
+  def test_cast_keeps_one_vote_per_voter(self):
+    self.assertEqual(Vote.cast(self.profile, self.monster, True), None)
+    self.assertEqual(Vote.cast(self.profile, self.monster, True), True)
+    self.assertEqual(Vote.cast(self.profile, self.monster, False), True)
+    
+    self.assertEqual(Vote.all().count(), 1)
+    self.assertTrue(Vote.get_for(self.profile, self.monster).is_down())
+    
+  def test_get_map(self):
+    other = Monster()
+    other.put_unsearchable()
+    Vote.cast(self.profile, self.monster, True)
+    
+    votes = Vote.get_map(self.profile, [self.monster, other, None])
+    self.assertEqual(votes.keys(), [self.monster.key().id()])
+
+
+class FoldVotesTestCase(basetest.BaseTestCase):
+
+  def test_fold_applies_pending_votes_once(self):
+    monster = Monster()
+    monster.put_unsearchable()
+    for i in xrange(3):
+      voter = Profile()
+      voter.put()
+      Vote.cast(voter, monster, i != 0)
+      
+    monster_id = monster.key().id()
+    Monster.fold_votes(monster_id)
+    Monster.fold_votes(monster_id)
+    
+    monster = Monster.get_by_id(monster_id)
+    self.assertEqual((monster.ups, monster.downs), (2, 1))
+    self.assertTrue(monster.score > 0)
+
+
+class ProfileTestCase(basetest.BaseTestCase):
+
+  def test_for_user(self):
+    user = users.User(email="someone@example.com", _user_id="1234")
+    Profile.new_for_user(user).put()
+    
+    profile = Profile.for_user(user)
+    self.assertEqual(profile.key().name(), "1234")
+    self.assertEqual(Profile.for_user(user).key(), profile.key())
+    
+  def test_get_by_id_safe(self):
+    user = users.User(email="someone@example.com", _user_id="1234")
+    key = Profile.new_for_user(user).put()
+    
+    self.assertEqual(Profile.get_by_id_safe("1234").key(), key)
+    self.assertEqual(Profile.get_by_id_safe("5678"), None)
+    
+  def test_finds_legacy_profiles(self):
+    user = users.User(email="someone@example.com", _user_id="1234")
+    self.assertEqual(Profile.for_user(user), None)
+    key = Profile(account=user).put()
+    
+    self.assertEqual(Profile.for_user(user).key(), key)
+    self.assertEqual(Profile.get_by_id_safe(str(key.id())).key(), key)
+    self.assertEqual(Profile.get_by_id_safe(key.id()).key(), key)
+    
+  def test_warm_cache_needs_no_datastore_calls(self):
+    legacy = users.User(email="legacy@example.com", 
+                        _user_id="123456789012345678901")
+    Profile(account=legacy).put()
+    visitor = users.User(email="new@example.com", 
+                         _user_id="123456789012345678902")
+    Profile.for_user(legacy)
+    Profile.for_user(visitor)
+    
+    calls = []
+    apiproxy_stub_map.apiproxy.GetPreCallHooks().Append(
+      'count', lambda service, call, request, response: calls.append(call), 
+      'datastore_v3')
+    self.assertEqual(Profile.for_user(legacy).account, legacy)
+    self.assertEqual(Profile.for_user(visitor), None)
+    self.assertEqual(calls, [])
+
+
+class IdentityMapTestCase(basetest.BaseTestCase):
+
+  def test_map_is_request_scoped(self):
+    monster = Monster()
+    monster.put_unsearchable()
+    seen = []
+    
+    def app(environ, start_response):
+      seen.append(Monster.get_by_id_safe(monster.key().id()))
+      seen.append(Monster.get_by_ids_safe([monster.key().id()])[0])
+      start_response('200 OK', [])
+      return []
+    identity.IdentityMapMiddleware(app).get_response('/')
+    
+    self.assertTrue(seen[0] is seen[1])
+    self.assertEqual(identity.get(monster.key()), None)
+
+
+class PrefetchReferencesTestCase(basetest.BaseTestCase):
+
+  def test_attaches_creator_and_product(self):
+    creator = Profile()
+    creator.put()
+    product = Product()
+    product.name = "Bestiary"
+    product.put()
+    monster = Monster()
+    monster.creator = creator
+    monster.product = product.key().id()
+    monster.put_unsearchable()
+    
+    monster = Monster.get_by_id(monster.key().id())
+    Monster.prefetch_references([monster, None])
+    
+    self.assertEqual(monster.creator.key(), creator.key())
+    self.assertEqual(monster.get_product().name, "Bestiary")
+    
+  def test_primed_reference_follows_reassignment(self):
+    first = Profile()
+    first.put()
+    second = Profile()
+    second.put()
+    monster = Monster()
+    monster.creator = first
+    Monster.creator.prime(monster, first)
+    self.assertTrue(monster.creator is first)
+    
+    monster.creator = second
+    self.assertEqual(monster.creator.key(), second.key())
+
+
+class LeaderboardTestCase(basetest.BaseTestCase):
+
+  def make_monster(self, score, product=-1):
+    monster = Monster()
+    monster.score = score
+    monster.product = product
+    monster.put_unsearchable()
+    return monster
+    
+  def test_feed_merges_visible_boards(self):
+    self.make_monster(0.5)
+    self.make_monster(0.9, product=7)
+    self.make_monster(0.7, product=8)
+    for product in (-1, 7, 8):
+      Monster.rebuild_leaderboards(product)
+    profile = Profile()
+    profile.products = [-1, 7]
+    
+    scores = [monster.score for monster in 
+              Monster.get_leaderboard(leaderboards.TOP, 5, user=profile)]
+    self.assertEqual(scores, [0.9, 0.5])
+    
+  def test_update_reorders_board(self):
+    low = self.make_monster(0.1)
+    high = self.make_monster(0.5)
+    Monster.rebuild_leaderboards(-1)
+    
+    # Updates are queued, and only applied in a batch.
+    leaderboards.update(leaderboards.TOP, -1, low.key().id(), 0.8)
+    self.assertEqual(leaderboards.merged(leaderboards.TOP, [-1], 1), 
+                     [high.key().id()])
+    leaderboards.apply_pending()
+    
+    self.assertEqual(leaderboards.merged(leaderboards.TOP, [-1], 1), 
+                     [low.key().id()])
+    
+  def test_monster_falling_below_cutoff_leaves_full_board(self):
+    monsters = [self.make_monster(0.5)
+                for i in xrange(leaderboards.BOARD_SIZE)]
+    Monster.rebuild_leaderboards(-1)
+    falling = monsters[0].key().id()
+    
+    leaderboards.update(leaderboards.TOP, -1, falling, 0.1)
+    leaderboards.apply_pending()
+    
+    board = leaderboards.get_entries(leaderboards.TOP, [-1])[-1]
+    self.assertEqual(len(board), leaderboards.BOARD_SIZE - 1)
+    self.assertFalse(falling in [monster_id for value, monster_id in board])
+
+
+class IndexingTestCase(basetest.BaseTestCase):
+
+  def setUp(self):
+    super(IndexingTestCase, self).setUp()
+    self.testbed.init_search_stub()
+    
+  def test_flush_applies_latest_update(self):
+    index = search.Index(name=_MONSTER_INDEX)
+    monster = Monster()
+    monster.name = "Goblin"
+    monster.put()
+    monster.put()
+    
+    indexing.flush()
+    self.assertEqual(len(index.get_range(ids_only=True).results), 1)
+    self.assertEqual(indexing.lag(), 0.0)
+    
+    monster.delete()
+    indexing.flush()
+    self.assertEqual(len(index.get_range(ids_only=True).results), 0)
+    
+  def test_search_renders_from_document(self):
+    monster = Monster()
+    monster.name = "Goblin"
+    monster.tags = ["horde", "small"]
+    monster.moves = ["Charge!", "Call more goblins"]
+    monster.put()
+    private = Monster()
+    private.name = "Goblin King"
+    private.product = 7
+    private.put()
+    indexing.flush()
+    
+    results, _, _ = Monster.search("goblin")
+    self.assertEqual([result.name for result in results], ["Goblin"])
+    self.assertEqual(results[0].key(), monster.key())
+    self.assertEqual(results[0].get_tags(), "horde, small")
+    self.assertEqual(results[0].moves, ["Charge!", "Call more goblins"])
+    
+    profile = Profile()
+    profile.products = [-1, 7]
+    self.assertEqual(len(Monster.search("goblin", profile)[0]), 2)
+    
+  def test_structured_search(self):
+    for name, hp, tags in [("Goblin", "3 HP", ["Horde", "Small"]), 
+                           ("Ogre", "10 HP", ["Group", "Large"]), 
+                           ("Dragon", "16 HP", ["Solitary", "Huge"])]:
+      monster = Monster()
+      monster.name = name
+      monster.hp = hp
+      monster.tags = tags
+      monster.put()
+    indexing.flush()
+    
+    results, _, _ = Monster.search("hp>=10 sort:hp")
+    self.assertEqual([result.name for result in results], ["Dragon", "Ogre"])
+    results, _, facets = Monster.search("tag:horde")
+    self.assertEqual([result.name for result in results], ["Goblin"])
+    self.assertEqual(facets['organization'], [("horde", 1)])
+    self.assertEqual(facets['size'], [("small", 1)])
+    
+    first_page, cursor, _ = Monster.search("sort:hp:asc", limit=2)
+    self.assertEqual([result.name for result in first_page], 
+                     ["Goblin", "Ogre"])
+    second_page, _, _ = Monster.search("sort:hp:asc", limit=2, cursor=cursor)
+    self.assertEqual([result.name for result in second_page], ["Dragon"])
+    
+  def test_search_cache(self):
+    monster = Monster()
+    monster.name = "Goblin"
+    monster.put()
+    indexing.flush()
+    
+    Monster.search("goblin")
+    results, _, _ = Monster.search("Goblin")
+    self.assertEqual([result.name for result in results], ["Goblin"])
+    self.assertEqual(searchcache.stats()['hits'], 1)
+    
+    chief = Monster()
+    chief.name = "Goblin Chief"
+    chief.put()
+    indexing.flush()
+    results, _, _ = Monster.search("goblin")
+    self.assertEqual(len(results), 2)
+    self.assertEqual(searchcache.stats()['misses'], 2)
+    
+  def test_unchanged_documents_keep_cache(self):
+    monster = Monster()
+    monster.name = "Goblin"
+    monster.put()
+    indexing.flush()
+    generation = generations.get(searchcache.NAMESPACE)
+    
+    indexing.enqueue([monster.key().id()])
+    indexing.flush()
+    indexing.reindex_slice(indexing.start_reindex(1).key().name(), 0)
+    self.assertEqual(generations.get(searchcache.NAMESPACE), generation)
+    
+    monster.name = "Goblin Chief"
+    monster.put()
+    indexing.flush()
+    self.assertNotEqual(generations.get(searchcache.NAMESPACE), generation)
+    
+  def test_folded_votes_reorder_score_sort(self):
+    liked = Monster()
+    liked.name = "Goblin"
+    liked.put()
+    other = Monster()
+    other.name = "Orc"
+    other.put()
+    indexing.flush()
+    
+    for i in xrange(3):
+      voter = Profile()
+      voter.put()
+      Vote.cast(voter, liked, True)
+    Monster.fold_votes(liked.key().id())
+    indexing.flush()
+    
+    results, _, _ = Monster.search("sort:score")
+    self.assertEqual([result.name for result in results], ["Goblin", "Orc"])
+    self.assertTrue(results[0].score > 0)
+    
+  def test_reindex_slices_checkpoint(self):
+    index = search.Index(name=_MONSTER_INDEX)
+    for name in ["Goblin", "Orc", "Troll"]:
+      monster = Monster()
+      monster.name = name
+      monster.put_unsearchable()
+    
+    job = indexing.start_reindex(1)
+    job_id = job.key().name()
+    old_slice_size = indexing.REINDEX_SLICE_SIZE
+    indexing.REINDEX_SLICE_SIZE = 2
+    try:
+      indexing.reindex_slice(job_id, 0, 0)
+      self.assertEqual(len(index.get_range(ids_only=True).results), 2)
+      # A retry of the checkpointed slice doesn't count it again.
+      indexing.reindex_slice(job_id, 0, 0)
+      self.assertEqual(job.get_progress()['documents'], 2)
+      indexing.reindex_slice(job_id, 0, 1)
+    finally:
+      indexing.REINDEX_SLICE_SIZE = old_slice_size
+      
+    self.assertEqual(len(index.get_range(ids_only=True).results), 3)
+    progress = job.get_progress()
+    self.assertEqual(progress['documents'], 3)
+    self.assertEqual(progress['shards_done'], 1)
+
+
+class LocalSearchTestCase(basetest.BaseTestCase):
+
+  def setUp(self):
+    super(LocalSearchTestCase, self).setUp()
+    indexing.use_local_index(localsearch.LocalIndex(
+      text_fields=_SEARCHED_FIELDS))
+    # Drop any name index an earlier test's datastore left in memory.
+    nameindex._index = None
+    
+  def tearDown(self):
+    indexing.use_local_index(None)
+    super(LocalSearchTestCase, self).tearDown()
+    
+  def test_search_uses_local_index(self):
+    for name, tags, product in [("Goblin", ["Horde"], -1), 
+                                ("Goblin Chief", ["Solitary"], -1), 
+                                ("Goblin Spy", ["Horde"], 7)]:
+      monster = Monster()
+      monster.name = name
+      monster.tags = tags
+      monster.product = product
+      monster.put()
+    indexing.flush()
+    
+    results, next_cursor, facets = Monster.search("goblin", limit=1)
+    self.assertEqual(len(results), 1)
+    results, next_cursor, _ = Monster.search("goblin", cursor=next_cursor)
+    self.assertEqual(len(results), 1)
+    self.assertEqual(next_cursor, None)
+    self.assertEqual(facets['organization'], [("horde", 1), ("solitary", 1)])
+    
+  def test_suggest_follows_writes(self):
+    goblin = Monster()
+    goblin.name = "Goblin"
+    goblin.put()
+    indexing.flush()
+    self.assertEqual(Monster.suggest("goblinn"), 
+                     [(goblin.key().id(), "Goblin")])
+    
+    goblin.delete()
+    indexing.flush()
+    self.assertEqual(Monster.suggest("gob"), [])
+    
+  def test_snapshot(self):
+    monster = Monster()
+    monster.name = "Dragon"
+    monster.put_unsearchable()
+    job = indexing.start_snapshot()
+    indexing.snapshot_slice(job.key().name(), 0)
+    indexing._snapshot = None
+    
+    snapshot = indexing.load_snapshot()
+    self.assertEqual(len(snapshot), 1)
+    hits, _, _ = snapshot.search(searchquery.parse("dragon"))
+    self.assertEqual(hits[0][1]['name'], "Dragon")
+    
+  def test_snapshot_slices_checkpoint_and_cap(self):
+    for name in ["Goblin", "Orc", "Troll", "Dragon"]:
+      monster = Monster()
+      monster.name = name
+      monster.put_unsearchable()
+    
+    indexing._snapshot = None
+    job_id = indexing.start_snapshot().key().name()
+    old_sizes = indexing.SNAPSHOT_SLICE_SIZE, indexing.SNAPSHOT_MAX_DOCUMENTS
+    indexing.SNAPSHOT_SLICE_SIZE, indexing.SNAPSHOT_MAX_DOCUMENTS = 2, 3
+    try:
+      indexing.snapshot_slice(job_id, 0)
+      # A retry of the checkpointed slice doesn't read it again.
+      indexing.snapshot_slice(job_id, 0)
+      self.assertEqual(indexing.load_snapshot(), None)
+      indexing.snapshot_slice(job_id, 1)
+    finally:
+      indexing.SNAPSHOT_SLICE_SIZE, indexing.SNAPSHOT_MAX_DOCUMENTS = old_sizes
+      
+    job = indexing.SnapshotJob.get_by_key_name(job_id)
+    self.assertTrue(job.done)
+    self.assertEqual(job.documents, 3)
+    self.assertEqual(len(indexing.load_snapshot()), 3)
+    self.assertEqual(indexing.load_blob(
+      indexing.SnapshotJob.part_name_for(job_id, 0)), None)
@@ -0,0 +1,47 @@
+import unittest
+from data import nameindex
+
+
+class NameIndexTestCase(unittest.TestCase):
+
+  def setUp(self):
+    self.index = nameindex.NameIndex()
+    self.index.add(1, "Goblin", "public")
+    self.index.add(2, "Goblin Orc-Hunter", "public")
+    self.index.add(3, "Red Dragon", "public")
+    self.index.add(4, "Dragon Turtle", "product-7")
+    
+  def suggest(self, text, access_atoms=("public",)):
+    return [monster_id for monster_id, name in 
+            self.index.suggest(text, access_atoms)]
+    
+  def test_prefixes(self):
+    self.assertEqual(self.suggest("gob"), [1, 2])
+    self.assertEqual(self.suggest("drag"), [3])
+    self.assertEqual(self.suggest("drag", ["public", "product-7"]), [4, 3])
+    
+  def test_typos(self):
+    self.assertEqual(self.suggest("goblinn")[0], 1)
+    self.assertEqual(self.suggest("dragn"), [3])
+    self.assertEqual(self.suggest("xyzzy"), [])
+    
+  def test_remove_and_snapshot(self):
+    self.index.remove(1)
+    self.index.add(3, "Blue Dragon", "public")
+    restored = nameindex.NameIndex.loads(self.index.dumps())
+    self.assertEqual(len(restored), 3)
+    self.assertEqual(restored.suggest("blue", ["public"]), 
+                     [(3, "Blue Dragon")])
+    self.assertEqual(restored.suggest("red", ["public"]), [])
+    
+  def test_copy_is_independent(self):
+    copy = self.index.copy()
+    copy.remove(1)
+    copy.add(5, "Goblin Chief", "public")
+    self.assertEqual(self.suggest("gob"), [1, 2])
+    self.assertEqual([monster_id for monster_id, name in 
+                      copy.suggest("gob", ["public"])], [5, 2])
+    
+  def test_edit_distance(self):
+    self.assertEqual(nameindex.edit_distance("kitten", "sitting", 5), 3)
+    self.assertEqual(nameindex.edit_distance("kitten", "sitting", 1), 2)
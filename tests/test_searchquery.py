@@ -0,0 +1,33 @@
+import unittest
+from data import searchquery
+
+
+class ParseTestCase(unittest.TestCase):
+
+  def test_field_terms(self):
+    parsed = searchquery.parse('goblin tag:"Hard To Kill" hp>=10 sort:score')
+    self.assertEqual(parsed.text, ["goblin"])
+    self.assertEqual(parsed.filters, [('tag', ':', "hard to kill"), 
+                                      ('hp_value', '>=', "10")])
+    self.assertEqual(parsed.sort, ('score', 0.0, True))
+    self.assertEqual(parsed.to_query_string(), 
+                     'goblin tag:"hard to kill" hp_value>=10')
+
+  def test_operators_pass_through(self):
+    parsed = searchquery.parse('(goblin OR orc-kin) NOT ~undead tag:horde')
+    self.assertEqual(parsed.to_query_string(),
+                     '((goblin OR "orc-kin") NOT ~undead) tag:"horde"')
+    self.assertEqual(searchquery.parse('OR ((goblin NOT').to_query_string(),
+                     '((goblin))')
+
+  def test_canonical_keeps_operator_order(self):
+    self.assertEqual(searchquery.parse('Orc goblin').canonical(),
+                     searchquery.parse('goblin orc').canonical())
+    self.assertNotEqual(searchquery.parse('a OR b c').canonical(),
+                        searchquery.parse('a b OR c').canonical())
+    
+  def test_malformed_terms_are_text(self):
+    parsed = searchquery.parse('hp>=lots sort:cuteness')
+    self.assertEqual(parsed.text, ["hp>=lots", "sort:cuteness"])
+    self.assertEqual(parsed.filters, [])
+    self.assertEqual(parsed.sort, None)